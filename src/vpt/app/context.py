@@ -1,6 +1,8 @@
 import copy
+import queue
+import threading
 from pathlib import Path
-from typing import Callable, Dict, Iterable, List, Optional
+from typing import Any, Callable, Dict, Iterable, List, Optional
 
 from vpt_core import log
 from vpt_core.io.vzgfs import initialize_filesystem
@@ -171,6 +173,63 @@ class Context:
 
                     return result
 
+    def pipeline_run(self, proc: Callable, items: Iterable, consume: Callable[[Any], None], *shared_args) -> None:
+        """
+        Streams the items through the workers: proc(item, *shared_args) is computed in parallel while the items
+        are still being produced, and consume is called with the results in the order of the items. The shared
+        arguments are sent to every worker once, and the number of items in flight is bounded by the workers count.
+        """
+        workers = self.get_workers_count()
+        if workers == 1:
+            for item in items:
+                consume(proc(item, *shared_args))
+            return
+
+        with self.get_cluster() as cluster:
+            with self.get_client(cluster) as client:
+                shared_futures = [client.scatter([arg], broadcast=True)[0] for arg in shared_args]
+                cnt_args = self.arguments()
+                children: List[Dict] = []
+
+                def _context_wrapper(item_cnt_args: Dict, item, *proc_args):
+                    with Context(**item_cnt_args):
+                        return proc(item, *proc_args)
+
+                pending: queue.Queue = queue.Queue(maxsize=workers)
+                failed = threading.Event()
+                errors: List[BaseException] = []
+
+                def ordered_consumer():
+                    while True:
+                        future = pending.get()
+                        if future is None:
+                            return
+                        if failed.is_set():
+                            continue
+                        try:
+                            consume(future.result())
+                        except BaseException as e:
+                            errors.append(e)
+                            failed.set()
+                        finally:
+                            future.release()
+
+                consumer = threading.Thread(target=ordered_consumer, daemon=True)
+                consumer.start()
+                try:
+                    for i, item in enumerate(items):
+                        if failed.is_set():
+                            break
+                        children.append(Context.modify_context_as_sub(cnt_args, i))
+                        pending.put(client.submit(_context_wrapper, children[-1], item, *shared_futures, pure=False))
+                finally:
+                    pending.put(None)
+                    consumer.join()
+
+                if errors:
+                    raise errors[0]
+                self.update_with_children(children)
+
 
 def current_context() -> Context:
     return _contexts[-1] if len(_contexts) > 0 else None
@@ -181,3 +240,11 @@ def parallel_run(tasks: Iterable[Task]) -> List:
         return current_context().parallel_run(tasks)
     else:
         return [t.proc(t.args) for t in tasks]
+
+
+def pipeline_run(proc: Callable, items: Iterable, consume: Callable[[Any], None], *shared_args) -> None:
+    if current_context():
+        current_context().pipeline_run(proc, items, consume, *shared_args)
+    else:
+        for item in items:
+            consume(proc(item, *shared_args))
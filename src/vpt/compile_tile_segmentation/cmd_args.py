@@ -11,6 +11,7 @@ class CompileTileSegmentationArgs:
     parameters_json_path: str
     max_row_group_size: int
     overwrite: bool
+    spatial_row_groups: bool = False
 
 
 def validate_cmd_args(args: CompileTileSegmentationArgs):
@@ -43,6 +44,14 @@ def get_parser():
         help="Maximum number of rows in row groups inside output parquet files. Cannot be less "
         f"than {MIN_ROW_GROUP_SIZE}",
     )
+    opt.add_argument(
+        "--spatial-row-groups",
+        action="store_true",
+        default=False,
+        required=False,
+        help="Set flag to sort the Entities along a Hilbert curve into spatially compact row groups and to add the "
+        "per-row bbox covering column (GeoParquet 1.1), so that readers can skip the row groups outside a region.",
+    )
     opt.add_argument(
         "--overwrite",
         action="store_true",
@@ -18,6 +18,7 @@ from vpt.compile_tile_segmentation.cmd_args import CompileTileSegmentationArgs,
 from vpt.compile_tile_segmentation.parameters import IOPaths, extract_parameters_from_spec, CompileParameters
 from vpt.entity.relationships import create_entity_relationships, EntityRelationships
 from vpt.run_segmentation_on_tile.output_utils import make_entity_output_filename
+from vpt.utils.geoparquet import save_spatial_segmentation_results, without_bbox_column
 from vpt.utils.validate import validate_does_not_exist, validate_experimental
 
 AdapterType = Callable[[int], SegmentationResult]
@@ -172,7 +173,12 @@ def compile_tile_segmentation(args):
     # Suppress parquet / Arrow warnings
     warnings.filterwarnings("ignore", category=UserWarning)
 
-    args = CompileTileSegmentationArgs(args.input_segmentation_parameters, args.max_row_group_size, args.overwrite)
+    args = CompileTileSegmentationArgs(
+        args.input_segmentation_parameters,
+        args.max_row_group_size,
+        args.overwrite,
+        getattr(args, "spatial_row_groups", False),
+    )
     validate_cmd_args(args)
     log.info("Compile tile segmentation started")
 
@@ -222,19 +228,25 @@ def compile_tile_segmentation(args):
         if not result.df[result.parent_id_field].isna().all():
             result.df[result.parent_id_field] = result.df[result.parent_id_field].astype("Int64")
         save_compiled_results(
-            result, etype_to_paths[result.entity_type], params.micron_to_mosaic_matrix, args.max_row_group_size
+            result,
+            etype_to_paths[result.entity_type],
+            params.micron_to_mosaic_matrix,
+            args.max_row_group_size,
+            args.spatial_row_groups,
         )
 
     log.info("Compile tile segmentation finished")
 
 
-def save_compiled_results(result, output_paths, m2m_transform, max_row_group_size):
-    save_segmentation_results(result.df, output_paths.micron_output_file, max_row_group_size)
+def save_compiled_results(result, output_paths, m2m_transform, max_row_group_size, spatial_row_groups=False):
+    save = save_spatial_segmentation_results if spatial_row_groups else save_segmentation_results
+    result.df = without_bbox_column(result.df)
+    save(result.df, output_paths.micron_output_file, max_row_group_size)
     log.info(f"Saved compiled dataframe for entity {result.entity_type} in micron space")
 
     result.transform_geoms(m2m_transform)
 
-    save_segmentation_results(result.df, output_paths.mosaic_output_file, max_row_group_size)
+    save(result.df, output_paths.mosaic_output_file, max_row_group_size)
     log.info(f"Saved compiled dataframe for entity {result.entity_type} in mosaic space")
 
 
@@ -22,6 +22,7 @@ class ConvertGeometryArgs:
     id_mapping_file: str
     max_row_group_size: int
     overwrite: bool
+    spatial_row_groups: bool = False
 
 
 def validate_args_with_input(args: ConvertGeometryArgs, input_path: str):
@@ -151,6 +152,14 @@ def get_parser():
         help=f"Maximum number of rows in row groups inside output parquet files. Cannot be less "
         f"than {MIN_ROW_GROUP_SIZE}",
     )
+    opt.add_argument(
+        "--spatial-row-groups",
+        action="store_true",
+        default=False,
+        required=False,
+        help="Set flag to sort the Entities along a Hilbert curve into spatially compact row groups and to add the "
+        "per-row bbox covering column (GeoParquet 1.1), so that readers can skip the row groups outside a region.",
+    )
     opt.add_argument(
         "--overwrite",
         action="store_true",
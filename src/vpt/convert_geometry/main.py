@@ -24,6 +24,7 @@ from vpt.convert_geometry.cmd_args import (
     validate_cmd_args,
 )
 from vpt.convert_geometry.factory import read_segmentation_result
+from vpt.utils.geoparquet import save_spatial_segmentation_results, without_bbox_column
 from vpt.utils.input_utils import read_micron_to_mosaic_transform
 from vpt.utils.validate import validate_exists
 
@@ -74,15 +75,23 @@ def convert_geometry(args: argparse.Namespace):
         seg_res.transform_geoms(mosaic_to_micron_matrix)
         log.info("Mosaic-to-micron transformation finished!")
 
-    save_parquet(seg_res, convert_args.output_boundaries, convert_args.max_row_group_size)
+    save_parquet(
+        seg_res, convert_args.output_boundaries, convert_args.max_row_group_size, convert_args.spatial_row_groups
+    )
     log.info("Convert geometry finished")
 
 
-def save_parquet(seg_res: SegmentationResult, output_path: str, max_grow_group_size: int):
+def save_parquet(
+    seg_res: SegmentationResult, output_path: str, max_grow_group_size: int, spatial_row_groups: bool = False
+):
     if not output_path.endswith(".parquet"):
         output_path = f"{output_path}.parquet"
-    gdf = seg_res.df
-    save_segmentation_results(gdf, output_path, max_grow_group_size)
+    # a bbox covering column of the input boundaries is only rewritten by the spatial writer
+    gdf = without_bbox_column(seg_res.df)
+    if spatial_row_groups:
+        save_spatial_segmentation_results(gdf, output_path, max_grow_group_size)
+    else:
+        save_segmentation_results(gdf, output_path, max_grow_group_size)
 
 
 def save_ids_map_csv(output_path: str, data: List[List]):
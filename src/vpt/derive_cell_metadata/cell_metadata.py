@@ -1,34 +1,104 @@
 import os
-from typing import List, Optional, Union
+from typing import List, Optional, Tuple, Union
 
 import numpy as np
 import pandas as pd
-from shapely import geometry
+import shapely
 
 from vpt.utils.cellsreader import CellsReader, cell_reader_factory
 from vpt_core import log
 
 from vpt.utils.boundaries import Boundaries
+from vpt.utils.raw_cell import EntitiesGeometry
 from vpt_core.io.vzgfs import initialize_filesystem, io_with_retries
 
 
-def polygons_generator(geometries):
-    for planeGeometry in geometries:
-        yield from planeGeometry.geoms
-
-
-def anisotropy_calculation(multi_poly):
-    bounding_rectangle = multi_poly.minimum_rotated_rectangle
-    rectangle_points = list(zip(*bounding_rectangle.exterior.xy))
-
-    sides = []
-    for p1, p2 in zip(rectangle_points[:-1], rectangle_points[1:]):
-        distance = np.sqrt((p1[0] - p2[0]) ** 2 + (p1[1] - p2[1]) ** 2)
-        sides.append(distance)
-
-    major_axis = np.max(sides)
-    minor_axis = np.min(sides)
-    anisotropy = major_axis / minor_axis
+METADATA_COLUMNS = [
+    "fov",
+    "EntityID",
+    "volume",
+    "center_x",
+    "center_y",
+    "min_x",
+    "min_y",
+    "max_x",
+    "max_y",
+    "anisotropy",
+    "transcript_count",
+    "perimeter_area_ratio",
+    "solidity",
+]
+
+# Polygons with a smaller area are left out of the volume, position, size and shape of the Entity
+MIN_POLYGON_AREA = 1e-9
+
+
+# Maximum number of (hull edge, hull point) pairs projected at once by the anisotropy calculation
+ANISOTROPY_CHUNK_PAIRS = 1 << 22
+
+
+def _rectangle_sides(coords: np.ndarray, ring_sizes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Sides of the minimum area rectangle of every convex ring, the ring coordinates are concatenated. Every edge
+    direction of the ring is tried and the first rectangle with the smallest area is kept, as in
+    shapely.oriented_envelope.
+    """
+    ring_starts = np.cumsum(ring_sizes) - ring_sizes
+    edges_count = ring_sizes - 1
+    edge_ring = np.repeat(np.arange(len(ring_sizes)), edges_count)
+    edge_start = (
+        np.repeat(ring_starts, edges_count)
+        + np.arange(len(edge_ring))
+        - np.repeat(np.cumsum(edges_count) - edges_count, edges_count)
+    )
+    direction = coords[edge_start + 1] - coords[edge_start]
+    direction /= np.sqrt(direction[:, 0] ** 2 + direction[:, 1] ** 2)[:, None]
+
+    # every edge is paired with all the points of its ring, the points are projected on the edge and its normal
+    pairs_count = ring_sizes[edge_ring]
+    pair_edge = np.repeat(np.arange(len(edge_ring)), pairs_count)
+    pair_starts = np.cumsum(pairs_count) - pairs_count
+    pair_point = ring_starts[edge_ring][pair_edge] + np.arange(len(pair_edge)) - pair_starts[pair_edge]
+    points, u = coords[pair_point], direction[pair_edge]
+    along = u[:, 0] * points[:, 0] + u[:, 1] * points[:, 1]
+    across = -u[:, 1] * points[:, 0] + u[:, 0] * points[:, 1]
+    width = np.maximum.reduceat(along, pair_starts) - np.minimum.reduceat(along, pair_starts)
+    height = np.maximum.reduceat(across, pair_starts) - np.minimum.reduceat(across, pair_starts)
+
+    area = width * height
+    edge_starts = np.cumsum(edges_count) - edges_count
+    smallest = np.flatnonzero(area == np.minimum.reduceat(area, edge_starts)[edge_ring])
+    _, first = np.unique(edge_ring[smallest], return_index=True)
+    best = smallest[first]
+    return width[best], height[best]
+
+
+def get_anisotropy(convex_hulls: np.ndarray, entity_idx: np.ndarray, entities_count: int) -> np.ndarray:
+    """
+    Ratio of the major and minor sides of the minimum rotated rectangle of all the polygons of every Entity, given
+    the convex hulls of the polygons sorted by Entity. NaN for the Entities without polygons or with a degenerate
+    rectangle.
+    """
+    entities, collection_idx = np.unique(entity_idx, return_inverse=True)
+    hulls = shapely.convex_hull(shapely.geometrycollections(convex_hulls, indices=collection_idx))
+
+    # the rectangle of a point or a line hull is degenerate
+    is_polygon = shapely.get_type_id(hulls) == shapely.GeometryType.POLYGON
+    hulls, entities = hulls[is_polygon], entities[is_polygon]
+    rings_size = shapely.get_num_coordinates(hulls)
+
+    anisotropy = np.full(entities_count, np.nan)
+    pairs = np.cumsum((rings_size - 1) * rings_size)
+    start = 0
+    while start < len(hulls):
+        offset = pairs[start - 1] if start > 0 else 0
+        stop = max(int(np.searchsorted(pairs, offset + ANISOTROPY_CHUNK_PAIRS, side="right")), start + 1)
+        # the convex hull has no interior rings
+        coords = shapely.get_coordinates(hulls[start:stop])
+        width, height = _rectangle_sides(coords, rings_size[start:stop])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            anisotropy[entities[start:stop]] = np.maximum(width, height) / np.minimum(width, height)
+        start = stop
     return anisotropy
 
 
@@ -46,113 +116,101 @@ def create_input_metadata(build_folder: str, input_boundaries: str, feature_name
 
 
 def create_metadata_table(
-    bnds: Boundaries, zDepthList: Union[List, np.ndarray], barcodesCountPerCell: Optional[np.ndarray] = None
+    bnds: Boundaries,
+    zDepthList: Union[List, np.ndarray],
+    barcodesCountPerCell: Optional[Union[np.ndarray, pd.Series]] = None,
 ) -> pd.DataFrame:
-    cell_metadata = []
-    min_x, min_y, max_x, max_y, center_x, center_y = 0, 0, 0, 0, 0, 0
-
-    for featureIdx, feature in enumerate(bnds.features):
-        barcodeCount = np.nan if barcodesCountPerCell is None else barcodesCountPerCell[featureIdx]
-        cell_volume = 0
-        firstPoly = True
-        polysCount = 0
-        paRatio = 0
-        for polyIdx, poly in enumerate(feature.shapes):
-            if poly is None or poly.is_empty or poly.area < 1e-9:
-                continue
-            if firstPoly:
-                min_x = poly.bounds[0]
-                min_y = poly.bounds[1]
-                max_x = poly.bounds[2]
-                max_y = poly.bounds[3]
-                center_x = poly.centroid.x
-                center_y = poly.centroid.y
-                firstPoly = False
-            else:
-                min_x = min(min_x, poly.bounds[0])
-                min_y = min(min_y, poly.bounds[1])
-                max_x = max(max_x, poly.bounds[2])
-                max_y = max(max_y, poly.bounds[3])
-                center_x += poly.centroid.x
-                center_y += poly.centroid.y
-
-            cell_volume += poly.area * zDepthList[polyIdx]
-            paRatio += poly.length / poly.area
-            polysCount += 1
-
-        # If an empty feature is found, append a blank row to the output
-        if polysCount == 0:
-            meta = {
-                "fov": np.nan,
-                "EntityID": np.int64(feature.get_feature_id()),
-                "volume": np.nan,
-                "center_x": np.nan,
-                "center_y": np.nan,
-                "min_x": np.nan,
-                "min_y": np.nan,
-                "max_x": np.nan,
-                "max_y": np.nan,
-                "anisotropy": np.nan,
-                "transcript_count": np.nan,
-                "perimeter_area_ratio": np.nan,
-                "solidity": np.nan,
-            }
-            cell_metadata.append(meta)
-            continue
+    return get_entities_metadata(bnds.get_entities_geometry(), zDepthList, barcodesCountPerCell)
+
 
-        allPlanesMultipolygon = geometry.MultiPolygon(polygons_generator(feature.get_true_polygons()))
-
-        try:
-            anisotropy = anisotropy_calculation(allPlanesMultipolygon)
-        except AttributeError:
-            log.info(f"Anisotropy of Entity {feature.get_feature_id()} could not be calculated")
-            anisotropy = np.nan
-
-        try:
-            convex_hull_area = sum(z_poly.convex_hull.area for z_poly in feature.get_true_polygons())
-            z_polygons_area = sum(z_poly.area for z_poly in feature.get_true_polygons())
-            solidity = z_polygons_area / convex_hull_area
-        except ZeroDivisionError:
-            log.info(f"Solidity of Entity {feature.get_feature_id()} could not be calculated")
-            solidity = np.nan
-
-        meta = {
-            "fov": np.nan,
-            "EntityID": np.int64(feature.get_feature_id()),
-            "volume": cell_volume,
-            "center_x": center_x / polysCount,
-            "center_y": center_y / polysCount,
-            "min_x": min_x,
-            "min_y": min_y,
-            "max_x": max_x,
-            "max_y": max_y,
-            "anisotropy": anisotropy,
-            "transcript_count": barcodeCount,
-            "perimeter_area_ratio": paRatio / polysCount,
-            "solidity": solidity,
-        }
-        cell_metadata.append(meta)
-
-    if cell_metadata:
-        output = pd.DataFrame(cell_metadata)
+def get_entities_metadata(
+    entities: EntitiesGeometry,
+    zDepthList: Union[List, np.ndarray],
+    barcodesCountPerCell: Optional[Union[np.ndarray, pd.Series]] = None,
+) -> pd.DataFrame:
+    """
+    Metadata of every Entity. The transcript counts are either a Series indexed by EntityID, the Entities missing
+    from it get NaN, or an array ordered as the Entities.
+    """
+    count = entities.get_entities_count()
+    z_depth = np.asarray(zDepthList)
+
+    polys_count = np.zeros(count, dtype=np.int64)
+    volume, pa_ratio = np.zeros(count), np.zeros(count)
+    center_x, center_y = np.zeros(count), np.zeros(count)
+    min_x, min_y = np.full(count, np.inf), np.full(count, np.inf)
+    max_x, max_y = np.full(count, -np.inf), np.full(count, -np.inf)
+    polygons_area, convex_hull_area = np.zeros(count), np.zeros(count)
+    hulls_idx, hulls = [], []
+
+    for z, geometries in enumerate(entities.geometries):
+        present = ~shapely.is_missing(geometries)
+        area = shapely.area(geometries)
+        z_hulls = shapely.convex_hull(geometries[present])
+        polygons_area[present] += area[present]
+        convex_hull_area[present] += shapely.area(z_hulls)
+        hulls_idx.append(np.flatnonzero(present))
+        hulls.append(z_hulls)
+
+        valid = present & ~shapely.is_empty(geometries) & (area >= MIN_POLYGON_AREA)
+        if not valid.any():
+            continue
+        bounds = shapely.bounds(geometries[valid])
+        min_x[valid] = np.minimum(min_x[valid], bounds[:, 0])
+        min_y[valid] = np.minimum(min_y[valid], bounds[:, 1])
+        max_x[valid] = np.maximum(max_x[valid], bounds[:, 2])
+        max_y[valid] = np.maximum(max_y[valid], bounds[:, 3])
+        centroids = shapely.get_coordinates(shapely.centroid(geometries[valid]))
+        center_x[valid] += centroids[:, 0]
+        center_y[valid] += centroids[:, 1]
+        volume[valid] += area[valid] * z_depth[z]
+        pa_ratio[valid] += shapely.length(geometries[valid]) / area[valid]
+        polys_count += valid
+
+    entity_idx = np.concatenate(hulls_idx) if hulls_idx else np.empty(0, dtype=np.int64)
+    order = np.argsort(entity_idx, kind="stable")
+    all_hulls = np.concatenate(hulls)[order] if hulls else np.empty(0, dtype=object)
+    anisotropy = get_anisotropy(all_hulls, entity_idx[order], count)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        solidity = np.where(convex_hull_area > 0, polygons_area / convex_hull_area, np.nan)
+        center_x /= polys_count
+        center_y /= polys_count
+        pa_ratio /= polys_count
+
+    # the Entities without polygons have a blank row
+    located = polys_count > 0
+    if (located & np.isnan(anisotropy)).any():
+        log.info(f"Anisotropy of {np.sum(located & np.isnan(anisotropy))} Entities could not be calculated")
+    if (located & np.isnan(solidity)).any():
+        log.info(f"Solidity of {np.sum(located & np.isnan(solidity))} Entities could not be calculated")
+
+    if barcodesCountPerCell is None:
+        transcript_count = np.full(count, np.nan)
+    elif isinstance(barcodesCountPerCell, pd.Series):
+        transcript_count = barcodesCountPerCell.reindex(entities.entity_ids).to_numpy(dtype=float)
     else:
-        output = pd.DataFrame(
-            columns=[
-                "fov",
-                "EntityID",
-                "volume",
-                "center_x",
-                "center_y",
-                "min_x",
-                "min_y",
-                "max_x",
-                "max_y",
-                "anisotropy",
-                "transcript_count",
-                "perimeter_area_ratio",
-                "solidity",
-            ]
-        )
+        transcript_count = np.asarray(barcodesCountPerCell)[np.arange(count)]
+        if not located.all():
+            transcript_count = np.where(located, transcript_count, np.nan)
+
+    columns = {
+        "volume": volume,
+        "center_x": center_x,
+        "center_y": center_y,
+        "min_x": min_x,
+        "min_y": min_y,
+        "max_x": max_x,
+        "max_y": max_y,
+        "anisotropy": anisotropy,
+        "perimeter_area_ratio": pa_ratio,
+        "solidity": solidity,
+    }
+    output = pd.DataFrame({column: np.where(located, values, np.nan) for column, values in columns.items()})
+    output["fov"] = np.nan
+    output["EntityID"] = entities.entity_ids
+    output["transcript_count"] = transcript_count
+    output = output[METADATA_COLUMNS]
 
     output.set_index("EntityID", inplace=True)
     output = output.sort_index()
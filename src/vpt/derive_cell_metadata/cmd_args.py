@@ -39,7 +39,12 @@ def get_parser() -> ArgumentParser:
     )
 
     opt = parser.add_argument_group("Optional arguments")
-    opt.add_argument("--input-entity-by-gene", required=False, type=str, help="Path to an existing entity by gene csv.")
+    opt.add_argument(
+        "--input-entity-by-gene",
+        required=False,
+        type=str,
+        help="Path to an existing entity by gene csv, mtx, h5ad or parquet file.",
+    )
     opt.add_argument(
         "--overwrite",
         action="store_true",
@@ -0,0 +1,99 @@
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from vpt_core import log
+
+from vpt.app.context import parallel_run
+from vpt.app.task import Task
+from vpt.derive_cell_metadata.cell_metadata import get_entities_metadata
+from vpt.utils.cellsreader.parquet_reader import CellsParquetReader
+
+# Row groups are joined into tasks of at least this number of polygon rows
+ROWS_PER_TASK = 200000
+
+
+@dataclass(frozen=True)
+class MetadataTask:
+    """
+    Entities whose first polygon row is in one range of row groups, read from all the row groups that hold their
+    polygons
+    """
+
+    boundaries_path: str
+    row_groups: List[int]
+    entity_ids: np.ndarray
+    z_depth: np.ndarray
+    barcodes: Optional[pd.Series] = None
+
+
+def calculate_metadata(task: MetadataTask) -> pd.DataFrame:
+    log.info(f"metadata of {len(task.entity_ids)} Entities from row groups {task.row_groups} started")
+    entities = CellsParquetReader(task.boundaries_path).read_entities_geometry(task.row_groups)
+    return get_entities_metadata(entities.select(task.entity_ids), task.z_depth, task.barcodes)
+
+
+def split_by_row_groups(
+    reader: CellsParquetReader, rows_per_task: int = ROWS_PER_TASK
+) -> Tuple[np.ndarray, List[Tuple[List[int], np.ndarray]]]:
+    """
+    EntityIDs in the order of CellsParquetReader.read_entities_geometry, and the row groups to read and the indexes
+    of the Entities to compute for every task. Every Entity belongs to the task of its first row group, a task also
+    reads the later row groups that hold the rest of the polygons of its Entities.
+    """
+    groups_ids = [
+        np.sort(reader.read_row_group_entity_ids(i), kind="stable") for i in range(reader.get_row_groups_count())
+    ]
+    if sum(len(ids) for ids in groups_ids) == 0:
+        return np.array([], dtype=np.int64), []
+    row_group = np.repeat(np.arange(len(groups_ids)), [len(ids) for ids in groups_ids])
+    codes, entity_ids = pd.factorize(np.concatenate(groups_ids))
+
+    # consecutive row groups are joined until the task is large enough
+    group_task = np.cumsum([len(ids) for ids in groups_ids]) // max(rows_per_task, 1)
+    _, group_task = np.unique(np.concatenate([[0], group_task[:-1]]), return_inverse=True)
+
+    _, first_rows = np.unique(codes, return_index=True)
+    entity_task = group_task[row_group[first_rows]]
+    row_task = entity_task[codes]
+
+    tasks = []
+    for task_i in range(entity_task.max() + 1):
+        entity_idx = np.flatnonzero(entity_task == task_i)
+        if len(entity_idx) > 0:
+            tasks.append((np.unique(row_group[row_task == task_i]).tolist(), entity_idx))
+    return np.asarray(entity_ids, dtype=np.int64), tasks
+
+
+def create_metadata_table_by_row_groups(
+    boundaries_path: str, barcodesCountPerCell: Optional[pd.Series] = None, rows_per_task: int = ROWS_PER_TASK
+) -> pd.DataFrame:
+    """
+    The metadata table of a parquet boundaries file, computed by independent tasks over its row groups. The
+    transcript counts are indexed by EntityID, since the row groups are not necessarily ordered by EntityID.
+    """
+    reader = CellsParquetReader(boundaries_path)
+    entity_ids, tasks = split_by_row_groups(reader, rows_per_task)
+    log.info(f"{len(tasks)} tasks prepared for {len(entity_ids)} Entities")
+
+    results = parallel_run(
+        [
+            Task(
+                calculate_metadata,
+                MetadataTask(
+                    boundaries_path,
+                    row_groups,
+                    entity_ids[entity_idx],
+                    reader.get_z_depth_per_level(),
+                    None if barcodesCountPerCell is None else barcodesCountPerCell.reindex(entity_ids[entity_idx]),
+                ),
+            )
+            for row_groups, entity_idx in tasks
+        ]
+    )
+    if not results:
+        return get_entities_metadata(
+            reader.read_entities_geometry(), reader.get_z_depth_per_level(), barcodesCountPerCell
+        )
+    return pd.concat(results).sort_index()
@@ -8,8 +8,11 @@ from vpt_core.io.vzgfs import io_with_retries
 
 from vpt.derive_cell_metadata.cell_metadata import create_metadata_table
 from vpt.derive_cell_metadata.cmd_args import validate_args, DeriveMetadataArgs
+from vpt.derive_cell_metadata.row_group_metadata import create_metadata_table_by_row_groups
 from vpt.utils.boundaries import Boundaries
 from vpt.utils.cellsreader import CellsReader, cell_reader_factory
+from vpt.utils.entity_by_gene_io import read_entity_by_gene
+from vpt.utils.input_utils import is_parquet_path
 
 
 def main_derive_cell_metadata(args: argparse.Namespace) -> None:
@@ -18,14 +21,17 @@ def main_derive_cell_metadata(args: argparse.Namespace) -> None:
     log.info("Derive cell metadata started")
     barcodesSumList = None
     if args.input_entity_by_gene:
-        cellByGeneDf = io_with_retries(args.input_entity_by_gene, "r", pd.read_csv)
-        cellByGeneNp = cellByGeneDf.to_numpy()
-        barcodesSumList = np.array([np.sum(row[1:]) for row in cellByGeneNp])
-
-    cellsReader: CellsReader = cell_reader_factory(args.input_boundaries)
-    bnds = Boundaries(cellsReader)
-
-    meta = create_metadata_table(bnds, cellsReader.get_z_depth_per_level(), barcodesSumList)
+        # the counts are matched to the Entities by EntityID, the boundaries may be ordered differently
+        entity_by_gene = read_entity_by_gene(args.input_entity_by_gene)
+        entity_ids = np.asarray(pd.to_numeric(entity_by_gene.entity_ids), dtype=np.int64)
+        barcodesSumList = pd.Series(entity_by_gene.get_entity_sums(), index=entity_ids)
+
+    if is_parquet_path(args.input_boundaries):
+        # the row groups are processed in parallel
+        meta = create_metadata_table_by_row_groups(args.input_boundaries, barcodesSumList)
+    else:
+        cellsReader: CellsReader = cell_reader_factory(args.input_boundaries)
+        meta = create_metadata_table(Boundaries(cellsReader), cellsReader.get_z_depth_per_level(), barcodesSumList)
 
     make_parent_dirs(args.output_metadata)
     io_with_retries(args.output_metadata, "w", lambda f: meta.to_csv(f, sep=","))
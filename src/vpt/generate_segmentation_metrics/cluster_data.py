@@ -1,21 +1,23 @@
 import anndata
+import numpy as np
 import pandas as pd
 import scanpy as sc
 import vpt.generate_segmentation_metrics.metrics_settings as metrics_settings
+from vpt.utils.entity_by_gene_io import EntityByGeneMatrix
 
 
 def cell_by_gene_norm(
-    cell_by_gene: pd.DataFrame,
+    cell_by_gene: EntityByGeneMatrix,
     cell_metadata: pd.DataFrame,
     min_genes_per_cell=0,
     min_count_per_cell=0,
 ) -> anndata._core.anndata.AnnData:
-    cell_x_gene_no_blanks = cell_by_gene.loc[:, ["Blank" not in c for c in cell_by_gene.columns]]
+    cell_x_gene_no_blanks = cell_by_gene.reindex_genes([c for c in cell_by_gene.genes if "Blank" not in c])
 
     expr_ann = anndata.AnnData(
-        X=cell_x_gene_no_blanks.to_numpy(),
-        obs=cell_x_gene_no_blanks.join(cell_metadata)[["volume", "center_x", "center_y"]],
-        var=pd.DataFrame(index=cell_x_gene_no_blanks.columns),
+        X=cell_x_gene_no_blanks.matrix.astype(np.float32),
+        obs=cell_metadata.reindex(cell_x_gene_no_blanks.entity_ids)[["volume", "center_x", "center_y"]],
+        var=pd.DataFrame(index=cell_x_gene_no_blanks.genes),
     )
 
     sc.pp.filter_cells(expr_ann, min_counts=min_count_per_cell)
@@ -52,7 +54,7 @@ def cluster_expression_data(
 
 
 def cluster_data(
-    cell_by_gene_filtered: pd.DataFrame, cell_metadata_filtered: pd.DataFrame
+    cell_by_gene_filtered: EntityByGeneMatrix, cell_metadata_filtered: pd.DataFrame
 ) -> anndata._core.anndata.AnnData:
     expr_ann = cell_by_gene_norm(
         cell_by_gene_filtered,
@@ -6,6 +6,7 @@ from typing import Dict, List
 import pandas as pd
 import geopandas as gpd
 from vpt.generate_segmentation_metrics.metrics_settings import OUTPUT_FILE_NAME1, OUTPUT_FILE_NAME2
+from vpt.utils.entity_by_gene_io import read_entity_by_gene
 from vpt.utils.validate import validate_does_not_exist, validate_exists
 from vpt_core.io.regex_tools import parse_images_str
 from vpt_core.io.vzgfs import filesystem_path_split, io_with_retries
@@ -95,7 +96,7 @@ def check_entities_exist(args: GenerateSegMetricsArgs) -> bool:
     from vpt.generate_segmentation_metrics.compute_metrics import filter_cell_data
 
     cell_polys = gpd.GeoDataFrame(columns=["EntityID"])
-    cell_by_gene: pd.DataFrame = io_with_retries(args.input_entity_by_gene, "r", lambda f: pd.read_csv(f, index_col=0))
+    cell_by_gene = read_entity_by_gene(args.input_entity_by_gene)
     cell_metadata: pd.DataFrame = io_with_retries(args.input_metadata, "r", lambda f: pd.read_csv(f, index_col=0))
     _, _, cell_metadata_filtered = filter_cell_data(
         cell_polys, cell_by_gene, cell_metadata, args.transcript_count_filter_threshold, args.volume_filter_threshold
@@ -115,7 +116,7 @@ def get_parser() -> ArgumentParser:
         "--input-entity-by-gene",
         required=True,
         type=str,
-        help="Path to the Entity by gene csv file.",
+        help="Path to the Entity by gene csv, mtx, h5ad or parquet file.",
     )
     required.add_argument(
         "--input-metadata",
@@ -127,7 +128,7 @@ def get_parser() -> ArgumentParser:
         "--input-transcripts",
         required=True,
         type=str,
-        help="Path to an existing transcripts csv file.",
+        help="Path to an existing transcripts csv or parquet file.",
     )
     required.add_argument(
         "--input-boundaries",
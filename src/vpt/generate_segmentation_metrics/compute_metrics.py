@@ -11,13 +11,14 @@ import vpt.generate_segmentation_metrics.metrics_settings as metrics_settings
 from pretty_html_table import build_table
 from vpt.generate_segmentation_metrics.cmd_args import GenerateSegMetricsArgs
 from vpt.generate_segmentation_metrics.output_tools import save_to_parquets
-from vpt.utils.input_utils import read_micron_to_mosaic_transform
+from vpt.utils.entity_by_gene_io import EntityByGeneMatrix, read_entity_by_gene
+from vpt.utils.input_utils import read_micron_to_mosaic_transform, read_transcripts
 from vpt_core.io.input_tools import read_parquet
 from vpt_core.io.vzgfs import io_with_retries
 
 
-def total_cell_count(cell_by_gene: pd.DataFrame) -> int:
-    num_cells = cell_by_gene.shape[0]
+def total_cell_count(cell_by_gene: EntityByGeneMatrix) -> int:
+    num_cells = cell_by_gene.get_entities_count()
     return round(num_cells, 1)
 
 
@@ -27,22 +28,24 @@ def cell_volume(cell_metadata: pd.DataFrame) -> Tuple:
     return round(cell_volume_mean, 1), round(cell_volume_median, 1)
 
 
-def transcripts_per_cell(cell_by_gene: pd.DataFrame) -> Tuple:
-    trans_per_cell = cell_by_gene.sum(axis=1).to_numpy()
+def transcripts_per_cell(cell_by_gene: EntityByGeneMatrix) -> Tuple:
+    trans_per_cell = cell_by_gene.get_entity_sums()
     trans_per_cell_mean = trans_per_cell.mean()
     trans_per_cell_median = np.median(trans_per_cell)
     return round(trans_per_cell_mean, 1), round(trans_per_cell_median, 1)
 
 
-def unique_genes_per_cell(cell_by_gene: pd.DataFrame) -> Tuple:
-    unique_tpc = np.count_nonzero(cell_by_gene, axis=1)
+def unique_genes_per_cell(cell_by_gene: EntityByGeneMatrix) -> Tuple:
+    unique_tpc = cell_by_gene.get_entity_genes_count()
     unique_tpc_mean = unique_tpc.mean()
     unique_tpc_median = np.median(unique_tpc)
     return round(unique_tpc_mean, 1), round(unique_tpc_median, 1)
 
 
-def percent_transcripts_in_cell(cell_by_gene: pd.DataFrame, detected_transcripts: pd.DataFrame) -> Union[int, float]:
-    transcripts_per_cell = cell_by_gene.sum(axis=1).to_numpy()
+def percent_transcripts_in_cell(
+    cell_by_gene: EntityByGeneMatrix, detected_transcripts: pd.DataFrame
+) -> Union[int, float]:
+    transcripts_per_cell = cell_by_gene.get_entity_sums()
     percent_in_cell = transcripts_per_cell.sum() / detected_transcripts.shape[0]
     return round(100 * percent_in_cell, 1)
 
@@ -79,16 +82,16 @@ def density_low_quality_cells(
 
 def filter_cell_data(
     gdf: gpd.GeoDataFrame,
-    cell_by_gene: pd.DataFrame,
+    cell_by_gene: EntityByGeneMatrix,
     cell_metadata: pd.DataFrame,
     transcript_count_filter_threshold: int,
     volume_filter_threshold: int,
 ) -> Tuple:
-    transcripts_per_cell = cell_by_gene.sum(axis=1).to_numpy()
+    transcripts_per_cell = cell_by_gene.get_entity_sums()
     tpc_filtered = np.where(transcripts_per_cell >= transcript_count_filter_threshold)[0]
     cv_filtered = np.where(cell_metadata["volume"] >= volume_filter_threshold)[0]
     keeps = np.intersect1d(tpc_filtered, cv_filtered)
-    cell_by_gene = cell_by_gene.iloc[keeps]
+    cell_by_gene = cell_by_gene.select_entities(keeps)
     cell_metadata = cell_metadata.iloc[keeps]
     gdf = gdf[gdf["EntityID"].isin(cell_metadata.index)]
     return gdf, cell_by_gene, cell_metadata
@@ -228,8 +231,8 @@ def make_clustering_results(extract_args: GenerateSegMetricsArgs, adata: anndata
 def get_metrics(
     cell_polys: gpd.GeoDataFrame,
     cell_polys_filtered: gpd.GeoDataFrame,
-    cell_by_gene: pd.DataFrame,
-    cell_by_gene_filtered: pd.DataFrame,
+    cell_by_gene: EntityByGeneMatrix,
+    cell_by_gene_filtered: EntityByGeneMatrix,
     cell_metadata: pd.DataFrame,
     cell_metadata_filtered: pd.DataFrame,
     detected_transcripts: pd.DataFrame,
@@ -257,8 +260,8 @@ def get_metrics(
     metrics["Filtered out cell density (1/100µm²)"] = density_low_quality_cells(
         detected_transcripts,
         m2m_transform,
-        num_cells=cell_by_gene.shape[0],
-        high_quality_cells=cell_by_gene_filtered.shape[0],
+        num_cells=cell_by_gene.get_entities_count(),
+        high_quality_cells=cell_by_gene_filtered.get_entities_count(),
     )
 
     metrics_df = pd.DataFrame(metrics, index=["Cells after filtering", "All cells"])
@@ -278,8 +281,8 @@ def get_metrics(
         density_low_quality_cells(
             detected_transcripts,
             m2m_transform,
-            num_cells=cell_by_gene.shape[0],
-            high_quality_cells=cell_by_gene.shape[0],
+            num_cells=cell_by_gene.get_entities_count(),
+            high_quality_cells=cell_by_gene.get_entities_count(),
         ),
     ]
     metrics_df = metrics_df.sort_index(level=["All cells", "Cells after filtering"])
@@ -298,13 +301,11 @@ def get_metrics(
 
 def compute_metrics(extract_args: GenerateSegMetricsArgs):
     cell_polys = read_parquet(extract_args.input_boundaries)
-    cell_by_gene: pd.DataFrame = io_with_retries(
-        extract_args.input_entity_by_gene, "r", lambda f: pd.read_csv(f, index_col=0)
-    )
+    cell_by_gene = read_entity_by_gene(extract_args.input_entity_by_gene)
     cell_metadata: pd.DataFrame = io_with_retries(
         extract_args.input_metadata, "r", lambda f: pd.read_csv(f, index_col=0)
     )
-    detected_transcripts: pd.DataFrame = io_with_retries(extract_args.input_transcripts, "r", lambda f: pd.read_csv(f))
+    detected_transcripts = read_transcripts(extract_args.input_transcripts, metrics_settings.TRANSCRIPTS_COLUMNS)
     m2m_transform = read_micron_to_mosaic_transform(extract_args.input_micron_to_mosaic)
 
     (
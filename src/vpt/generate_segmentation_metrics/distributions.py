@@ -30,10 +30,10 @@ class Distributions:
         self.preview_locations: List[List] = []
 
         self.marker_size = 1.0
-        if self.cell_by_gene.shape[0] > 5e5:
+        if self.cell_by_gene.get_entities_count() > 5e5:
             self.marker_size = 0.05
-        if self.cell_by_gene.shape[0] < 1e5:
-            self.marker_size = round(np.linspace(3, 1, num=int(1e5))[self.cell_by_gene.shape[0]], 2)
+        if self.cell_by_gene.get_entities_count() < 1e5:
+            self.marker_size = round(np.linspace(3, 1, num=int(1e5))[self.cell_by_gene.get_entities_count()], 2)
 
         self.font = "Gill Sans, sans-serif"
         self.leiden_res = [item for item in self.adata.obs.columns if item.startswith("leiden")][0]
@@ -93,9 +93,9 @@ class Distributions:
                     continue
                 seg_polys = crop_segmentation(extract_args_converted, self.gdf)
 
-                tpc_sample = self.cell_by_gene_filtered.loc[
-                    self.cell_by_gene_filtered.index.isin(seg_polys["EntityID"].unique())
-                ].sum(axis=1)
+                tpc_sample = self.cell_by_gene_filtered.get_entity_sums()[
+                    np.isin(self.cell_by_gene_filtered.entity_ids, seg_polys["EntityID"].unique())
+                ]
                 if len(tpc_sample) > 0:
                     self.preview_locations.append([center_x, center_y, size_x, size_y])
                     break
@@ -222,12 +222,12 @@ class Distributions:
             x0=self.extract_args.volume_filter_threshold,
             x1=self.extract_args.volume_filter_threshold,
             y0=0,
-            y1=0.02 * self.cell_by_gene.shape[0],
+            y1=0.02 * self.cell_by_gene.get_entities_count(),
             line=dict(color="gray", width=2, dash="dash"),
         )
         cv.add_annotation(
             x=np.log10(self.extract_args.volume_filter_threshold),
-            y=0.02 * self.cell_by_gene.shape[0],
+            y=0.02 * self.cell_by_gene.get_entities_count(),
             text="volume_filter_threshold",
             font=dict(size=12, color="black"),
             xanchor="left",
@@ -245,7 +245,7 @@ class Distributions:
     def make_tpc_hist(self):
         tpc = go.Figure()
         trace = go.Histogram(
-            x=self.cell_by_gene.sum(axis=1), marker=dict(color="#1f77b4"), name="All cells", nbinsx=100
+            x=self.cell_by_gene.get_entity_sums(), marker=dict(color="#1f77b4"), name="All cells", nbinsx=100
         )
         tpc.add_trace(trace)
         tpc.update_xaxes(title_text="Transcripts per cell")
@@ -265,12 +265,12 @@ class Distributions:
             x0=self.extract_args.transcript_count_filter_threshold,
             x1=self.extract_args.transcript_count_filter_threshold,
             y0=1,
-            y1=0.015 * self.cell_by_gene.shape[0],
+            y1=0.015 * self.cell_by_gene.get_entities_count(),
             line=dict(color="gray", width=2, dash="dash"),
         )
         tpc.add_annotation(
             x=self.extract_args.transcript_count_filter_threshold,
-            y=np.log10(0.015 * self.cell_by_gene.shape[0]),
+            y=np.log10(0.015 * self.cell_by_gene.get_entities_count()),
             text="transcript_count_filter_threshold",
             font=dict(size=12, color="black"),
             xanchor="left",
@@ -278,7 +278,7 @@ class Distributions:
             showarrow=False,
         )
         trace2 = go.Histogram(
-            x=self.cell_by_gene_filtered.sum(axis=1) + 1,
+            x=self.cell_by_gene_filtered.get_entity_sums() + 1,
             marker=dict(color="#ff7f0e"),
             name="Filtered cells",
             nbinsx=100,
@@ -291,7 +291,7 @@ class Distributions:
     def make_unique_tpc_hist(self):
         unique_tpc = go.Figure()
         trace = go.Histogram(
-            x=np.count_nonzero(self.cell_by_gene, axis=1), marker=dict(color="#1f77b4"), name="All cells", nbinsx=100
+            x=self.cell_by_gene.get_entity_genes_count(), marker=dict(color="#1f77b4"), name="All cells", nbinsx=100
         )
         unique_tpc.add_trace(trace)
         unique_tpc.update_xaxes(title_text="Unique genes per cell")
@@ -308,7 +308,7 @@ class Distributions:
             yaxis=dict(gridcolor="black"),
         )
         trace2 = go.Histogram(
-            x=np.count_nonzero(self.cell_by_gene_filtered, axis=1),
+            x=self.cell_by_gene_filtered.get_entity_genes_count(),
             marker=dict(color="#ff7f0e"),
             name="Filtered cells",
             nbinsx=100,
@@ -322,7 +322,7 @@ class Distributions:
         tpc_cv = go.Figure()
         tpc_cv_trace = go.Scatter(
             x=self.cell_metadata["volume"],
-            y=self.cell_by_gene.sum(axis=1),
+            y=self.cell_by_gene.get_entity_sums(),
             mode="markers",
             marker=dict(size=self.marker_size, color="#1f77b4"),
             name="All cells",
@@ -381,7 +381,7 @@ class Distributions:
             mode="markers",
             marker=dict(
                 size=self.marker_size,
-                color=np.log10(self.cell_by_gene.sum(axis=1).to_numpy() + 1),
+                color=np.log10(self.cell_by_gene.get_entity_sums() + 1),
                 colorscale="Viridis",
                 colorbar=dict(title="Transcript count (log<sub>10</sub>)", title_side="right", len=1.0, thickness=15),
             ),
@@ -406,7 +406,7 @@ class Distributions:
             mode="markers",
             marker=dict(
                 size=self.marker_size,
-                color=np.log10(np.count_nonzero(self.cell_by_gene, axis=1) + 1),
+                color=np.log10(self.cell_by_gene.get_entity_genes_count() + 1),
                 colorscale="Viridis",
                 colorbar=dict(title="Unique genes count (log<sub>10</sub>)", title_side="right", len=1.0, thickness=15),
             ),
@@ -477,7 +477,7 @@ class Distributions:
         umap2 = px.scatter(
             x=self.adata.obsm["X_umap"][:, 0],
             y=self.adata.obsm["X_umap"][:, 1],
-            color=np.log10(self.cell_by_gene_filtered.sum(axis=1).to_numpy()),
+            color=np.log10(self.cell_by_gene_filtered.get_entity_sums()),
             color_continuous_scale="Viridis",
             render_mode="webgl",
         )
@@ -500,7 +500,7 @@ class Distributions:
         umap3 = px.scatter(
             x=self.adata.obsm["X_umap"][:, 0],
             y=self.adata.obsm["X_umap"][:, 1],
-            color=np.log10(np.count_nonzero(self.cell_by_gene_filtered, axis=1) + 1),
+            color=np.log10(self.cell_by_gene_filtered.get_entity_genes_count() + 1),
             color_continuous_scale="Viridis",
         )
         umap3.update_traces(marker_size=self.marker_size)
@@ -551,11 +551,11 @@ class Distributions:
 
     def make_top_20_genes(self):
         gene_counts = self.detected_transcripts["gene"].value_counts()
-        gene_partition_all = self.cell_by_gene.sum().reindex(gene_counts.index) / gene_counts
+        gene_partition_all = self.cell_by_gene.get_gene_sums().reindex(gene_counts.index) / gene_counts
         gene_partition_all = gene_partition_all.sort_values(ascending=False)
         top_20_genes_all = gene_partition_all.head(20)
 
-        gene_partition = self.cell_by_gene_filtered.sum().reindex(gene_counts.index) / gene_counts
+        gene_partition = self.cell_by_gene_filtered.get_gene_sums().reindex(gene_counts.index) / gene_counts
         top_20_genes_filtered = gene_partition.loc[top_20_genes_all.index]
 
         top_20 = go.Bar(
@@ -588,11 +588,11 @@ class Distributions:
 
     def make_bottom_20_genes(self):
         gene_counts = self.detected_transcripts["gene"].value_counts()
-        gene_partition_all = self.cell_by_gene.sum().reindex(gene_counts.index) / gene_counts
+        gene_partition_all = self.cell_by_gene.get_gene_sums().reindex(gene_counts.index) / gene_counts
         gene_partition_all = gene_partition_all.sort_values(ascending=False)
         bottom_20_genes_all = gene_partition_all.tail(20)
 
-        gene_partition = self.cell_by_gene_filtered.sum().reindex(gene_counts.index) / gene_counts
+        gene_partition = self.cell_by_gene_filtered.get_gene_sums().reindex(gene_counts.index) / gene_counts
         bottom_20_genes_filtered = gene_partition.loc[bottom_20_genes_all.index]
 
         bottom_20 = go.Bar(
@@ -70,7 +70,11 @@ def crop_segmentation(
         maxx=window_micron[0] + (window_micron[2] / 2),
         maxy=window_micron[1] + (window_micron[3] / 2),
     )
-    cell_polys = gdf[gdf["Geometry"].within(bounding_box)]
+    # only the polygons with bounding boxes inside the window are tested
+    bounds = shapely.bounds(np.asarray(gdf["Geometry"], dtype=object))
+    xmin, ymin, xmax, ymax = bounding_box.bounds
+    candidates = gdf[(bounds[:, 0] >= xmin) & (bounds[:, 1] >= ymin) & (bounds[:, 2] <= xmax) & (bounds[:, 3] <= ymax)]
+    cell_polys = candidates[candidates["Geometry"].within(bounding_box)]
     cell_polys["Geometry"] = cell_polys["Geometry"].apply(
         lambda p: shapely.affinity.scale(
             p,
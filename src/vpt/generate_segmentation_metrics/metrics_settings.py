@@ -3,6 +3,7 @@ from pathlib import Path
 TEMPLATE_ROOT = (Path(__file__).parent.parent / "utils" / "html_template").resolve()
 OUTPUT_FILE_NAME1 = "Cells_categories.parquet"
 OUTPUT_FILE_NAME2 = "Cells_numeric_categories.parquet"
+TRANSCRIPTS_COLUMNS = ["global_x", "global_y", "x", "y", "fov", "gene"]
 
 METRICS_CSV_OUTPUT_MAPPER = {
     "Cell volume - mean (µm³)": "Cell volume - mean (um^3)",
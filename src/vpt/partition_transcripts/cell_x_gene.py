@@ -1,126 +1,126 @@
-from typing import Optional, List
+from typing import Iterable, List, Optional, Sequence, Tuple
 
 import numpy as np
 import pandas as pd
-import shapely
-from shapely import Polygon
-from vpt_core.io.vzgfs import io_with_retries
 
+from vpt.app.context import pipeline_run
+from vpt.partition_transcripts.cmd_args import CELL_ID_COLUMN
+from vpt.partition_transcripts.entity_by_gene import ChunkCounts, EntityByGeneAccumulator
+from vpt.partition_transcripts.entity_index import EntityIndex, entity_index_factory
+from vpt.partition_transcripts.transcripts_writer import TranscriptsWriter, transcripts_writer_factory
 from vpt.utils.boundaries import Boundaries
-
-
-def process_chunk(chunk_df, shapely_list, z_planes_count, cell_id_list, needs_new_dt: bool = False):
-    genes_detected = chunk_df["gene"].unique()
-    grouped = chunk_df.groupby(chunk_df["gene"])
-
-    gene_df_list = []
-    transcripts_list = []
-    for gene in genes_detected:
-        one_gene = grouped.get_group(gene)
-        one_gene_partition_list = []
-        for z in range(z_planes_count):
-            one_gene_z = one_gene.loc[one_gene["global_z"] == z]
-            points = shapely.points(one_gene_z["global_x"], one_gene_z["global_y"])
-            one_gene_tree = shapely.STRtree(points)
-            one_gene_partition_z = one_gene_tree.query(shapely_list[z], predicate="contains")
-            one_gene_partition_list.append(one_gene_partition_z)
-
-            if needs_new_dt:
-                out = np.full(len(one_gene_z), -1, dtype=np.int64)
-                if len(one_gene_partition_z[0]) > 0:
-                    cell_id_vectorize = np.vectorize(lambda t: cell_id_list[t])
-                    out[one_gene_partition_z[1]] = cell_id_vectorize(one_gene_partition_z[0])
-
-                one_gene_z = one_gene_z.assign(cell_id=out)
-
-                transcripts_list.append(one_gene_z)
+from vpt.utils.entity_by_gene_io import EntityByGeneMatrix
+
+
+def process_chunk(
+    chunk_df: pd.DataFrame,
+    entity_indexes: Sequence[EntityIndex],
+    cell_ids: Sequence[np.ndarray],
+    id_columns: Sequence[str],
+    needs_new_dt: bool = False,
+) -> Tuple[List[ChunkCounts], pd.DataFrame]:
+    """Counts the transcripts of the chunk by Entity and gene for every Entity type"""
+    x = chunk_df["global_x"].to_numpy()
+    y = chunk_df["global_y"].to_numpy()
+    z = chunk_df["global_z"].to_numpy()
+
+    gene_codes, genes = pd.factorize(chunk_df["gene"])
+    _, first_occurrence = np.unique(gene_codes, return_index=True)
+    barcode_ids = chunk_df["barcode_id"].to_numpy()[first_occurrence]
+
+    chunk_counts_list, assigned_ids = [], {}
+    for entity_index, type_cell_ids, id_column in zip(entity_indexes, cell_ids, id_columns):
+        points_idx, entity_idx, assignment = entity_index.assign(x, y, z)
+
+        pairs, counts = np.unique(np.stack([entity_idx, gene_codes[points_idx]]), axis=1, return_counts=True)
+        chunk_counts_list.append(
+            ChunkCounts(
+                entity_idx=pairs[0],
+                gene_idx=pairs[1],
+                counts=counts,
+                genes=genes.to_numpy(),
+                barcode_ids=barcode_ids,
+            )
+        )
 
         if needs_new_dt:
-            unhandled_transcripts = one_gene.loc[(one_gene["global_z"] >= z_planes_count) | (one_gene["global_z"] < 0)]
-            unhandled_transcripts.assign(cell_id=-1)
-            if len(unhandled_transcripts) > 0:
-                transcripts_list.append(unhandled_transcripts)
-
-        if one_gene_partition_list:
-            one_gene_partition = np.concatenate(one_gene_partition_list, axis=1)
-        else:
-            one_gene_partition = np.array([[], []])
-
-        cell_x_one_gene = pd.DataFrame(one_gene_partition.T, columns=["cell_id", gene]).groupby("cell_id").count()
-        gene_df_list.append(cell_x_one_gene)
+            out = np.full(len(chunk_df), -1, dtype=np.int64)
+            assigned = assignment >= 0
+            out[assigned] = type_cell_ids[assignment[assigned]]
+            assigned_ids[id_column] = out
 
-    cell_x_gene = pd.DataFrame(index=range(len(cell_id_list))).join(gene_df_list).fillna(0)
-    cell_x_gene["cell"] = pd.to_numeric(cell_id_list)
-
-    if len(transcripts_list) > 0:
-        transcripts_df = pd.concat(transcripts_list).loc[chunk_df.index]
+    if needs_new_dt:
+        transcripts_df = chunk_df.assign(**assigned_ids)
     else:
-        transcripts_df = pd.DataFrame(columns=list(chunk_df.columns) + ["cell_id"])
-
-    return cell_x_gene, transcripts_df
-
+        transcripts_df = pd.DataFrame(columns=list(chunk_df.columns) + list(id_columns))
 
-def construct_cell_x_gene(
-    transcripts, geometry_list, z_planes_count: int, cell_id_list, output_transcripts: Optional[str] = None
-) -> pd.DataFrame:
-    cell_by_gene = pd.DataFrame({"cell": pd.to_numeric(cell_id_list)})
-    barcode_id_name_df = pd.DataFrame(columns=["barcode_id", "gene"])
-
-    first_chunk = True
-    for chunk_df in transcripts:
-        chunk_cell_by_gene, transcripts_df = process_chunk(
-            chunk_df, geometry_list, z_planes_count, cell_id_list, output_transcripts is not None
-        )
+    return chunk_counts_list, transcripts_df
 
-        cell_by_gene = (
-            pd.concat([cell_by_gene, chunk_cell_by_gene]).groupby("cell").sum(min_count=1).fillna(0).reset_index()
-        )
-
-        barcode_id_name_df = pd.concat([barcode_id_name_df, chunk_df[["barcode_id", "gene"]]]).drop_duplicates(
-            subset="barcode_id"
-        )
-
-        if output_transcripts is None:
-            continue
 
+def write_transcripts_chunk(writer: TranscriptsWriter, transcripts_df: pd.DataFrame) -> None:
+    # the unnamed index column of the input csv keeps its empty header in the output
+    if len(transcripts_df.columns) > 0 and str(transcripts_df.columns[0]).startswith("Unnamed: "):
         transcripts_df = transcripts_df.rename(columns={transcripts_df.columns[0]: ""})
+    writer.write(transcripts_df)
 
-        if first_chunk:
-            io_with_retries(
-                output_transcripts, "w", lambda f: transcripts_df.to_csv(f, mode="w", index=False, header=True)
-            )
-            first_chunk = False
-            continue
-
-        io_with_retries(
-            output_transcripts, "a", lambda f: transcripts_df.to_csv(f, mode="a", index=False, header=False)
-        )
-
-    cell_by_gene.set_index("cell", inplace=True, drop=True)
-    cell_by_gene.index = cell_by_gene.index.astype(np.int64)
-    cell_by_gene.index.name = "cell"
-    cell_by_gene = cell_by_gene.sort_index()
 
-    barcode_id_name_df = barcode_id_name_df.set_index("barcode_id")
-    barcode_id_name_df.sort_index(inplace=True)
-    cell_by_gene = cell_by_gene.reindex(list(barcode_id_name_df["gene"]), axis=1)
-    return cell_by_gene.astype("int")
+def construct_cell_x_gene(
+    transcripts,
+    entity_indexes: Sequence[EntityIndex],
+    cell_id_lists: Sequence,
+    id_columns: Sequence[str],
+    output_transcripts: Optional[str] = None,
+) -> List[EntityByGeneMatrix]:
+    cell_ids = [np.asarray(pd.to_numeric(cell_id_list), dtype=np.int64) for cell_id_list in cell_id_lists]
+    cell_by_gene_list = [EntityByGeneAccumulator(type_cell_ids) for type_cell_ids in cell_ids]
+    writer = transcripts_writer_factory(output_transcripts) if output_transcripts else None
+
+    def consume(chunk_result: Tuple[List[ChunkCounts], pd.DataFrame]):
+        chunk_counts_list, transcripts_df = chunk_result
+        for cell_by_gene, chunk_counts in zip(cell_by_gene_list, chunk_counts_list):
+            cell_by_gene.add(chunk_counts)
+
+        if writer is not None:
+            write_transcripts_chunk(writer, transcripts_df)
+
+    try:
+        pipeline_run(process_chunk, transcripts, consume, entity_indexes, cell_ids, id_columns, writer is not None)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return [cell_by_gene.to_matrix() for cell_by_gene in cell_by_gene_list]
+
+
+def entity_by_gene_matrices(
+    bnds_list: Sequence[Boundaries],
+    transcripts: Iterable[pd.DataFrame],
+    id_columns: Sequence[str],
+    output_transcripts: Optional[str] = None,
+    label_pixel_size: Optional[float] = None,
+) -> List[EntityByGeneMatrix]:
+    """Partitions the transcripts into the Entities of every boundaries in a single pass over the transcripts"""
+    entity_indexes, cell_id_lists = [], []
+    for bnds in bnds_list:
+        entities = bnds.get_entities_geometry()
+        entity_indexes.append(entity_index_factory(entities.geometries, bnds.get_z_planes_count(), label_pixel_size))
+        cell_id_lists.append(entities.entity_ids)
+    return construct_cell_x_gene(transcripts, entity_indexes, cell_id_lists, id_columns, output_transcripts)
+
+
+def entity_by_gene_matrix(
+    bnds: Boundaries,
+    transcripts: Iterable[pd.DataFrame],
+    output_transcripts: Optional[str] = None,
+    label_pixel_size: Optional[float] = None,
+) -> EntityByGeneMatrix:
+    return entity_by_gene_matrices([bnds], transcripts, [CELL_ID_COLUMN], output_transcripts, label_pixel_size)[0]
 
 
 def cell_by_gene_matrix(
-    bnds: Boundaries, transcripts: pd.DataFrame, output_transcripts: Optional[str] = None
+    bnds: Boundaries,
+    transcripts: Iterable[pd.DataFrame],
+    output_transcripts: Optional[str] = None,
+    label_pixel_size: Optional[float] = None,
 ) -> pd.DataFrame:
-    idList = []
-    geomList: List[List[Polygon]] = []
-    for z in range(bnds.get_z_planes_count()):
-        geomList.append([])
-    for feature in bnds.features:
-        idList.append(np.int64(feature.get_feature_id()))
-        for zIdx, poly in enumerate(feature.get_full_cell()):
-            geomList[zIdx].append(poly)
-
-    cell_x_gene = construct_cell_x_gene(
-        transcripts, np.array(geomList), bnds.get_z_planes_count(), idList, output_transcripts
-    )
-
-    return cell_x_gene
+    return entity_by_gene_matrix(bnds, transcripts, output_transcripts, label_pixel_size).to_dataframe()
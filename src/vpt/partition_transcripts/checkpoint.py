@@ -0,0 +1,188 @@
+import json
+from collections import deque
+from typing import Deque, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+from vpt_core import log
+from vpt_core.io.vzgfs import filesystem_path_split, io_with_retries
+
+from vpt.app.context import pipeline_run
+from vpt.partition_transcripts.cell_x_gene import process_chunk, write_transcripts_chunk
+from vpt.partition_transcripts.cmd_args import TRANSCRIPTS_PARTITION_COLUMNS
+from vpt.partition_transcripts.entity_by_gene import ChunkCounts, EntityByGeneAccumulator
+from vpt.partition_transcripts.entity_index import EntityIndex
+from vpt.partition_transcripts.transcripts_writer import transcripts_writer_factory
+from vpt.utils.entity_by_gene_io import EntityByGeneMatrix
+from vpt.utils.input_utils import read_transcripts_by_chunks
+
+STATE_FILE = "state.npz"
+ASSIGNMENT_PREFIX = "cell_id_"
+
+
+class PartitionCheckpoint:
+    """
+    Directory with the partial Entity by gene counts of a partition-transcripts run and the number of transcripts
+    they cover. If the transcripts output is requested, the EntityIDs assigned to the processed transcripts are
+    kept there as well, one file per chunk.
+    """
+
+    def __init__(self, path: str, input_paths: List[str], with_assignment: bool):
+        self._fs, self._path = filesystem_path_split(path)
+        self._uri = path.rstrip(self._fs.sep)
+        self._fs.mkdirs(self._path, exist_ok=True)
+
+        # a checkpoint is only reused for the same inputs
+        inputs = []
+        for input_path in input_paths:
+            fs, path_inside_fs = filesystem_path_split(input_path)
+            inputs.append([input_path, fs.size(path_inside_fs)])
+        self._fingerprint = json.dumps({"inputs": inputs, "with_assignment": with_assignment})
+
+    def _get_uri(self, name: str) -> str:
+        return f"{self._uri}{self._fs.sep}{name}"
+
+    def _get_path(self, name: str) -> str:
+        return f"{self._path.rstrip(self._fs.sep)}{self._fs.sep}{name}"
+
+    def _get_assignments(self) -> List[Tuple[int, str]]:
+        names = [path.split(self._fs.sep)[-1] for path in self._fs.ls(self._path, detail=False)]
+        assignments = [name for name in names if name.startswith(ASSIGNMENT_PREFIX) and name.endswith(".npy")]
+        return sorted((int(name[len(ASSIGNMENT_PREFIX) : -len(".npy")]), name) for name in assignments)
+
+    def load(self) -> Tuple[int, Optional[List[EntityByGeneAccumulator]]]:
+        """
+        Number of transcripts already processed and their counts for every Entity type, or (0, None) if nothing
+        was saved yet
+        """
+        if not self._fs.exists(self._get_path(STATE_FILE)):
+            return 0, None
+
+        state = io_with_retries(self._get_uri(STATE_FILE), "rb", lambda f: dict(np.load(f)))
+        if str(state.pop("fingerprint")) != self._fingerprint:
+            raise ValueError(f"The checkpoint {self._uri} was saved for other inputs. Remove it to start over")
+        rows_done = int(state.pop("rows_done"))
+        entity_types_count = int(state.pop("entity_types_count"))
+
+        # assignments of the chunks processed after the last saved state are computed again
+        for start_row, name in self._get_assignments():
+            if start_row >= rows_done:
+                self._fs.rm(self._get_path(name))
+
+        accumulators = []
+        for i in range(entity_types_count):
+            prefix = f"{i}_"
+            type_state = {key[len(prefix) :]: value for key, value in state.items() if key.startswith(prefix)}
+            accumulators.append(EntityByGeneAccumulator.from_state(type_state))
+        return rows_done, accumulators
+
+    def save(self, rows_done: int, accumulators: List[EntityByGeneAccumulator]) -> None:
+        state = {
+            "rows_done": np.array(rows_done, dtype=np.int64),
+            "entity_types_count": np.array(len(accumulators), dtype=np.int64),
+            "fingerprint": np.array(self._fingerprint),
+        }
+        for i, accumulator in enumerate(accumulators):
+            state.update({f"{i}_{key}": value for key, value in accumulator.get_state().items()})
+        # the state is replaced at once, an interruption while saving keeps the previous one
+        temp_name = f"{STATE_FILE}.tmp"
+        io_with_retries(self._get_uri(temp_name), "wb", lambda f: np.savez(f, **state))
+        self._fs.mv(self._get_path(temp_name), self._get_path(STATE_FILE))
+
+    def write_assignment(self, start_row: int, cell_ids: np.ndarray) -> None:
+        """Saves the EntityIDs assigned to the transcripts from start_row on, one column per Entity type"""
+        io_with_retries(self._get_uri(f"{ASSIGNMENT_PREFIX}{start_row}.npy"), "wb", lambda f: np.save(f, cell_ids))
+
+    def read_assignments(self) -> Iterator[np.ndarray]:
+        for _, name in self._get_assignments():
+            yield io_with_retries(self._get_uri(name), "rb", np.load)
+
+    def remove(self) -> None:
+        self._fs.rm(self._path, recursive=True)
+
+
+def _write_transcripts_with_assignments(
+    transcripts_path: str,
+    chunk_size: int,
+    output_transcripts: str,
+    id_columns: Sequence[str],
+    assignments: Iterator[np.ndarray],
+) -> None:
+    cell_ids = np.empty((0, len(id_columns)), dtype=np.int64)
+    with transcripts_writer_factory(output_transcripts) as writer:
+        for chunk_df in read_transcripts_by_chunks(transcripts_path, chunk_size):
+            # the assignments were saved by chunks of a run that may have been resumed, they are realigned here
+            while len(cell_ids) < len(chunk_df):
+                cell_ids = np.concatenate([cell_ids, next(assignments)])
+            chunk_ids = {column: cell_ids[: len(chunk_df), i] for i, column in enumerate(id_columns)}
+            write_transcripts_chunk(writer, chunk_df.assign(**chunk_ids))
+            cell_ids = cell_ids[len(chunk_df) :]
+
+
+def construct_cell_x_gene_with_checkpoints(
+    transcripts_path: str,
+    chunk_size: int,
+    entity_indexes: Sequence[EntityIndex],
+    cell_id_lists: Sequence,
+    id_columns: Sequence[str],
+    checkpoint: PartitionCheckpoint,
+    checkpoint_interval: int,
+    output_transcripts: Optional[str] = None,
+) -> List[EntityByGeneMatrix]:
+    """
+    Same as construct_cell_x_gene, but the partial counts are saved to the checkpoint every checkpoint_interval
+    chunks, and the transcripts that are already counted in the checkpoint are skipped. The transcripts output
+    is written from the saved assignments once all transcripts are processed.
+    """
+    cell_ids = [np.asarray(pd.to_numeric(cell_id_list), dtype=np.int64) for cell_id_list in cell_id_lists]
+    rows_done, restored = checkpoint.load()
+    if restored is None:
+        cell_by_gene_list = [EntityByGeneAccumulator(type_cell_ids) for type_cell_ids in cell_ids]
+    else:
+        cell_by_gene_list = restored
+        log.info(f"Partition is resumed from the checkpoint after {rows_done} transcripts")
+
+    chunk_rows: Deque[int] = deque()
+
+    def read_chunks() -> Iterator[pd.DataFrame]:
+        for chunk_df in read_transcripts_by_chunks(
+            transcripts_path, chunk_size, TRANSCRIPTS_PARTITION_COLUMNS, rows_done
+        ):
+            chunk_rows.append(len(chunk_df))
+            yield chunk_df
+
+    chunks_since_save = 0
+
+    def consume(chunk_result: Tuple[List[ChunkCounts], pd.DataFrame]):
+        nonlocal rows_done, chunks_since_save
+        chunk_counts_list, transcripts_df = chunk_result
+        for cell_by_gene, chunk_counts in zip(cell_by_gene_list, chunk_counts_list):
+            cell_by_gene.add(chunk_counts)
+        if output_transcripts:
+            checkpoint.write_assignment(rows_done, transcripts_df[list(id_columns)].to_numpy(dtype=np.int64))
+
+        rows_done += chunk_rows.popleft()
+        chunks_since_save += 1
+        if chunks_since_save == checkpoint_interval:
+            checkpoint.save(rows_done, cell_by_gene_list)
+            chunks_since_save = 0
+            log.info(f"Checkpoint saved after {rows_done} transcripts")
+
+    pipeline_run(
+        process_chunk,
+        read_chunks(),
+        consume,
+        entity_indexes,
+        cell_ids,
+        id_columns,
+        output_transcripts is not None,
+    )
+    if chunks_since_save > 0:
+        checkpoint.save(rows_done, cell_by_gene_list)
+
+    if output_transcripts:
+        _write_transcripts_with_assignments(
+            transcripts_path, chunk_size, output_transcripts, id_columns, checkpoint.read_assignments()
+        )
+
+    return [cell_by_gene.to_matrix() for cell_by_gene in cell_by_gene_list]
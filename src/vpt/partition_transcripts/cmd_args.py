@@ -1,43 +1,73 @@
 from argparse import ArgumentParser
 from dataclasses import dataclass
+from typing import List, Optional, Union
 
-from vpt_core.io.vzgfs import vzg_open, retrying_attempts
-
+from vpt.partition_transcripts.transcripts_writer import validate_compression
+from vpt.utils.entity_by_gene_io import get_entity_by_gene_paths
+from vpt.utils.input_utils import as_paths_list, read_transcripts_columns
 from vpt.utils.validate import validate_does_not_exist, validate_exists
 
+TRANSCRIPTS_PARTITION_COLUMNS = ["barcode_id", "global_x", "global_y", "global_z", "gene"]
+CELL_ID_COLUMN = "cell_id"
+
 
 @dataclass
 class PartitionTranscriptsArgs:
-    input_boundaries: str
+    input_boundaries: Union[str, List[str]]
     input_transcripts: str
-    output_entity_by_gene: str
+    output_entity_by_gene: Union[str, List[str]]
     chunk_size: int
     output_transcripts: str
     overwrite: bool
+    tile_size: Optional[float] = None
+    temp_path: Optional[str] = None
+    label_pixel_size: Optional[float] = None
+    checkpoint_path: Optional[str] = None
+    checkpoint_interval: int = 10
 
 
 def validate_args(args: PartitionTranscriptsArgs):
-    validate_exists(args.input_boundaries)
+    input_boundaries = as_paths_list(args.input_boundaries)
+    output_entity_by_gene = as_paths_list(args.output_entity_by_gene)
+    if len(input_boundaries) != len(output_entity_by_gene):
+        raise ValueError("An output Entity by gene path should be specified for every input boundaries file")
+
+    for path in input_boundaries:
+        validate_exists(path)
     validate_exists(args.input_transcripts)
 
     if not args.overwrite:
-        validate_does_not_exist(args.output_entity_by_gene)
+        for output_path in output_entity_by_gene:
+            for path in get_entity_by_gene_paths(output_path):
+                validate_does_not_exist(path)
         if args.output_transcripts:
             validate_does_not_exist(args.output_transcripts)
 
+    if args.output_transcripts:
+        validate_compression(args.output_transcripts)
+
     if args.chunk_size <= 0:
         raise ValueError("Chunk size should be a positive integer")
 
-    transcripts_header = {"gene", "global_x", "global_y", "global_z"}
-    for attempt in retrying_attempts():
-        with attempt, vzg_open(args.input_transcripts, "r") as f:
-            header = f.readline()
-            header = header.replace("\n", "").split(",")
-            if not transcripts_header.issubset(header):
-                raise ValueError(
-                    f"Expected columns {transcripts_header.difference(header)} were not found in the "
-                    f"input-transcripts file. Input transcript file contained columns: {header}"
-                )
+    if args.tile_size is not None and args.tile_size <= 0:
+        raise ValueError("Tile size should be a positive number")
+
+    if args.label_pixel_size is not None and args.label_pixel_size <= 0:
+        raise ValueError("Label pixel size should be a positive number")
+
+    if args.checkpoint_path is not None and args.tile_size is not None:
+        raise ValueError("Checkpoints are not supported together with tiles")
+
+    if args.checkpoint_interval <= 0:
+        raise ValueError("Checkpoint interval should be a positive integer")
+
+    transcripts_header = set(TRANSCRIPTS_PARTITION_COLUMNS)
+    header = read_transcripts_columns(args.input_transcripts)
+    if not transcripts_header.issubset(header):
+        raise ValueError(
+            f"Expected columns {transcripts_header.difference(header)} were not found in the "
+            f"input-transcripts file. Input transcript file contained columns: {header}"
+        )
 
 
 def get_parser() -> ArgumentParser:
@@ -49,13 +79,27 @@ def get_parser() -> ArgumentParser:
     )
     required = parser.add_argument_group("Required arguments")
     required.add_argument(
-        "--input-boundaries", required=True, type=str, help="Path to a micron-space parquet boundary file."
+        "--input-boundaries",
+        required=True,
+        type=str,
+        nargs="+",
+        help="Path to a micron-space parquet boundary file. Several files (e.g. cells and nuclei) may be listed to "
+        "partition the transcripts into all of them in a single pass.",
     )
     required.add_argument(
-        "--input-transcripts", required=True, type=str, help="Path to an existing transcripts csv file."
+        "--input-transcripts",
+        required=True,
+        type=str,
+        help="Path to an existing transcripts csv or parquet file.",
     )
     required.add_argument(
-        "--output-entity-by-gene", required=True, type=str, help="Path to output the Entity by gene matrix csv file."
+        "--output-entity-by-gene",
+        required=True,
+        type=str,
+        nargs="+",
+        help="Path to output the Entity by gene matrix, one path for every input boundaries file. The matrix is saved in a sparse format if the filename ends "
+        "with .mtx (Matrix Market, with the EntityIDs and genes in _entities.csv and _genes.csv files next to it), "
+        ".h5ad (AnnData) or .parquet (COO table), and as a dense csv otherwise.",
     )
 
     opt = parser.add_argument_group("Optional arguments")
@@ -64,7 +108,8 @@ def get_parser() -> ArgumentParser:
         required=False,
         type=int,
         default=10000000,
-        help="Number of transcript file lines to be loaded in memory at once. Default: 10,000,000",
+        help="Number of transcript file lines to be loaded in memory at once. When running with several "
+        "processes, each process holds up to two chunks at a time. Default: 10,000,000",
     )
     opt.add_argument(
         "--output-transcripts",
@@ -72,7 +117,51 @@ def get_parser() -> ArgumentParser:
         type=str,
         help="If a filename is provided, a copy of the detected transcripts file will be written "
         "with an additional column with the EntityID of the cell or other Entity that contains "
-        "each transcript (or -1 if the transcript is not contained by any Entity).",
+        "each transcript (or -1 if the transcript is not contained by any Entity). With several input boundaries "
+        "files, there is one column per file, named after the Entity type of the boundaries (e.g. nuclei_id). "
+        "The copy is written in parquet format if the filename ends with .parquet, otherwise as csv. The csv is "
+        "compressed with gzip or zstd if the filename ends with .gz or .zst.",
+    )
+    opt.add_argument(
+        "--tile-size",
+        required=False,
+        type=float,
+        help="If provided, the transcripts are binned into square tiles of this size (in microns) and every "
+        "tile is partitioned as an independent task that only loads the transcripts of the tile and the "
+        "Entities crossing it. Suited for experiments that are too large to be processed by a single node.",
+    )
+    opt.add_argument(
+        "--temp-path",
+        required=False,
+        type=str,
+        help="Directory for the temporary per-tile files used with --tile-size. It should be accessible by all "
+        "workers of the Dask cluster, and is required with a remote Dask cluster. Default: a local temporary "
+        "directory.",
+    )
+    opt.add_argument(
+        "--label-pixel-size",
+        required=False,
+        type=float,
+        help="If provided, the Entities of each z-plane are rasterized into a label image with pixels of this size "
+        "(in microns), and the transcripts are assigned by a lookup in that image. Only the transcripts in pixels "
+        "touched by an Entity boundary are tested against the polygons, so the result is the same. Smaller pixels "
+        "need fewer exact tests but more memory.",
+    )
+    opt.add_argument(
+        "--checkpoint-path",
+        required=False,
+        type=str,
+        help="If provided, the partial Entity by gene matrix and the number of processed transcripts are saved to "
+        "this directory every --checkpoint-interval chunks. If the directory already holds a checkpoint of the same "
+        "inputs, the run continues from it. The directory is removed once the outputs are saved. Can not be "
+        "combined with --tile-size.",
+    )
+    opt.add_argument(
+        "--checkpoint-interval",
+        required=False,
+        type=int,
+        default=10,
+        help="Number of transcript chunks processed between two checkpoints. Default: 10",
     )
     opt.add_argument(
         "--overwrite",
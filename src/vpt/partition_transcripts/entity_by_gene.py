@@ -0,0 +1,114 @@
+from dataclasses import dataclass
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from vpt.utils.entity_by_gene_io import EntityByGeneMatrix
+
+
+@dataclass
+class ChunkCounts:
+    """Non-zero Entity by gene counts of one transcripts chunk in COO layout"""
+
+    entity_idx: np.ndarray
+    gene_idx: np.ndarray
+    counts: np.ndarray
+    genes: np.ndarray
+    barcode_ids: np.ndarray
+
+
+class EntityByGeneAccumulator:
+    """
+    Sparse int32 Entity by gene matrix that is filled chunk by chunk. Chunk counts are buffered as COO
+    triplets and periodically compacted into a CSR matrix, so adding a chunk costs O(chunk size).
+    """
+
+    COMPACT_THRESHOLD = 10_000_000
+
+    def __init__(self, entity_ids: np.ndarray):
+        # the same EntityID may be read more than once, its counts are merged into a single row
+        self._entity_ids, self._entity_rows = np.unique(np.asarray(entity_ids, dtype=np.int64), return_inverse=True)
+        self._gene_columns: Dict[str, int] = {}
+        self._gene_barcodes: Dict[str, int] = {}
+
+        self._rows: List[np.ndarray] = []
+        self._cols: List[np.ndarray] = []
+        self._data: List[np.ndarray] = []
+        self._buffered = 0
+        self._matrix = sparse.csr_matrix((len(self._entity_ids), 0), dtype=np.int32)
+
+    def _register_genes(self, genes: np.ndarray, barcode_ids: np.ndarray) -> np.ndarray:
+        columns = np.empty(len(genes), dtype=np.int64)
+        for i, (gene, barcode_id) in enumerate(zip(genes, barcode_ids)):
+            if gene not in self._gene_columns:
+                self._gene_columns[gene] = len(self._gene_columns)
+                self._gene_barcodes[gene] = barcode_id
+            columns[i] = self._gene_columns[gene]
+        return columns
+
+    def add(self, chunk: ChunkCounts) -> None:
+        gene_columns = self._register_genes(chunk.genes, chunk.barcode_ids)
+        self._rows.append(self._entity_rows[chunk.entity_idx])
+        self._cols.append(gene_columns[chunk.gene_idx])
+        self._data.append(chunk.counts.astype(np.int32, copy=False))
+        self._buffered += len(chunk.counts)
+        if self._buffered >= self.COMPACT_THRESHOLD:
+            self._compact()
+
+    def _compact(self) -> None:
+        shape = (len(self._entity_ids), len(self._gene_columns))
+        self._matrix.resize(shape)
+        if self._buffered > 0:
+            buffered = sparse.coo_matrix(
+                (np.concatenate(self._data), (np.concatenate(self._rows), np.concatenate(self._cols))),
+                shape=shape,
+                dtype=np.int32,
+            )
+            self._matrix = self._matrix + buffered.tocsr()
+        self._rows, self._cols, self._data = [], [], []
+        self._buffered = 0
+
+    def get_entity_ids(self) -> np.ndarray:
+        return self._entity_ids
+
+    def get_genes(self) -> List[str]:
+        """Genes ordered by barcode id"""
+        return sorted(self._gene_columns.keys(), key=lambda gene: self._gene_barcodes[gene])
+
+    def to_sparse(self) -> sparse.csr_matrix:
+        """Entity by gene matrix with rows ordered by EntityID and columns ordered as get_genes"""
+        self._compact()
+        order = [self._gene_columns[gene] for gene in self.get_genes()]
+        return self._matrix[:, order].tocsr()
+
+    def get_state(self) -> Dict[str, np.ndarray]:
+        """Everything accumulated so far as plain arrays, an equal accumulator is restored by from_state"""
+        self._compact()
+        genes = list(self._gene_columns.keys())
+        return {
+            "entity_ids": self._entity_ids,
+            "genes": np.array(genes, dtype=str),
+            "barcode_ids": np.array([self._gene_barcodes[gene] for gene in genes], dtype=np.int64),
+            "data": self._matrix.data,
+            "indices": self._matrix.indices,
+            "indptr": self._matrix.indptr,
+        }
+
+    @staticmethod
+    def from_state(state: Dict[str, np.ndarray]) -> "EntityByGeneAccumulator":
+        accumulator = EntityByGeneAccumulator(state["entity_ids"])
+        accumulator._register_genes(state["genes"].tolist(), state["barcode_ids"])
+        accumulator._matrix = sparse.csr_matrix(
+            (state["data"], state["indices"], state["indptr"]),
+            shape=(len(accumulator._entity_ids), len(state["genes"])),
+            dtype=np.int32,
+        )
+        return accumulator
+
+    def to_matrix(self) -> EntityByGeneMatrix:
+        return EntityByGeneMatrix(self.to_sparse(), self._entity_ids, self.get_genes())
+
+    def to_dataframe(self) -> pd.DataFrame:
+        return self.to_matrix().to_dataframe()
@@ -0,0 +1,194 @@
+from typing import List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import shapely
+from rasterio import Affine
+from rasterio.enums import MergeAlg
+from rasterio.features import rasterize
+
+
+class EntityIndex:
+    """
+    Spatial index over the Entity polygons of every z-plane. Polygons are prepared and stored in a single
+    STRtree per z-plane, so that each chunk of transcripts is assigned to Entities in one vectorized query.
+    """
+
+    def __init__(self, geometry_list: Sequence[Union[Sequence, np.ndarray]], z_planes_count: int):
+        self._geometries: List[np.ndarray] = []
+        self._entity_idx: List[np.ndarray] = []
+
+        for z in range(z_planes_count):
+            geoms = np.asarray(geometry_list[z] if z < len(geometry_list) else [], dtype=object)
+
+            # missing, empty and degenerate polygons can not contain a transcript, skip them in the index
+            valid = np.flatnonzero(shapely.area(geoms) > 0)
+            self._geometries.append(geoms[valid])
+            self._entity_idx.append(valid.astype(np.int64))
+
+        self._build_trees()
+
+    def _build_trees(self):
+        for geoms in self._geometries:
+            shapely.prepare(geoms)
+        self._trees = [shapely.STRtree(geoms) for geoms in self._geometries]
+
+    def __getstate__(self):
+        # prepared geometries and trees are not preserved by pickle, they are rebuilt on the receiving side
+        return {"geometries": self._geometries, "entity_idx": self._entity_idx}
+
+    def __setstate__(self, state):
+        self._geometries = state["geometries"]
+        self._entity_idx = state["entity_idx"]
+        self._build_trees()
+
+    def get_z_planes_count(self) -> int:
+        return len(self._trees)
+
+    def query(self, x: np.ndarray, y: np.ndarray, z: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the Entities containing each point. Returns two aligned arrays: indexes of the points and
+        indexes of the Entities that contain them. A point covered by several Entities is listed once per Entity.
+        """
+        points_idx_list, entity_idx_list = [], []
+        for z_plane in range(self.get_z_planes_count()):
+            if len(self._geometries[z_plane]) == 0:
+                continue
+
+            z_points = np.flatnonzero(z == z_plane)
+            if len(z_points) == 0:
+                continue
+
+            x_plane, y_plane = x[z_points], y[z_points]
+            candidates_points, candidates_tree = self._trees[z_plane].query(shapely.points(x_plane, y_plane))
+            inside = shapely.contains_xy(
+                self._geometries[z_plane][candidates_tree], x_plane[candidates_points], y_plane[candidates_points]
+            )
+
+            points_idx_list.append(z_points[candidates_points[inside]])
+            entity_idx_list.append(self._entity_idx[z_plane][candidates_tree[inside]])
+
+        if not points_idx_list:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+
+        return np.concatenate(points_idx_list), np.concatenate(entity_idx_list)
+
+    def assign(self, x: np.ndarray, y: np.ndarray, z: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Same as query, additionally returns for every point the index of the containing Entity (-1 if the point
+        is not contained by any Entity). If several Entities contain a point, the one with the largest index wins.
+        """
+        points_idx, entity_idx = self.query(x, y, z)
+        assignment = np.full(len(x), -1, dtype=np.int64)
+        np.maximum.at(assignment, points_idx, entity_idx)
+        return points_idx, entity_idx, assignment
+
+
+class LabelMap:
+    """
+    Label image of the Entity polygons of one z-plane. A pixel keeps the Entity index + 1 if it lies entirely within
+    the interior of a single Entity, 0 if it lies outside of all Entities, and -1 if a boundary touches it or several
+    Entities cover it, so that the points of that pixel need an exact test.
+    """
+
+    BOUNDARY = -1
+
+    def __init__(self, geometries: np.ndarray, entity_idx: np.ndarray, pixel_size: float):
+        min_x, min_y, max_x, max_y = shapely.total_bounds(geometries)
+        # one pixel of margin keeps every polygon strictly inside of the image
+        self.min_x, self.min_y = min_x - pixel_size, min_y - pixel_size
+        self.pixel_size = pixel_size
+        shape = (int((max_y - self.min_y) / pixel_size) + 2, int((max_x - self.min_x) / pixel_size) + 2)
+        transform = Affine(pixel_size, 0, self.min_x, 0, pixel_size, self.min_y)
+
+        self.labels = rasterize(
+            zip(geometries, entity_idx + 1), out_shape=shape, transform=transform, fill=0, dtype=np.int32
+        )
+        coverage = rasterize(
+            ((geom, 1) for geom in geometries),
+            out_shape=shape,
+            transform=transform,
+            fill=0,
+            merge_alg=MergeAlg.add,
+            dtype=np.int32,
+        )
+        edges = rasterize(
+            ((edge, 1) for edge in shapely.boundary(geometries)),
+            out_shape=shape,
+            transform=transform,
+            fill=0,
+            all_touched=True,
+            dtype=np.uint8,
+        ).astype(bool)
+
+        # the edge mask is grown by one pixel, so a boundary lying on the border of two pixels marks both of them
+        near_edges = edges.copy()
+        near_edges[1:, :] |= edges[:-1, :]
+        near_edges[:-1, :] |= edges[1:, :]
+        near_edges[:, 1:] |= edges[:, :-1]
+        near_edges[:, :-1] |= edges[:, 1:]
+        self.labels[near_edges | (coverage > 1)] = self.BOUNDARY
+
+    def lookup(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        rows = np.floor((y - self.min_y) / self.pixel_size)
+        columns = np.floor((x - self.min_x) / self.pixel_size)
+        inside = (rows >= 0) & (rows < self.labels.shape[0]) & (columns >= 0) & (columns < self.labels.shape[1])
+
+        result = np.zeros(len(x), dtype=np.int32)
+        result[inside] = self.labels[rows[inside].astype(np.int64), columns[inside].astype(np.int64)]
+        return result
+
+
+class RasterEntityIndex(EntityIndex):
+    """
+    Entity index that assigns most of the points with a label image lookup. Only the points in pixels touched by a
+    boundary are tested against the polygons, so the results are identical to the ones of EntityIndex.
+    """
+
+    def __init__(self, geometry_list: Sequence[Union[Sequence, np.ndarray]], z_planes_count: int, pixel_size: float):
+        super().__init__(geometry_list, z_planes_count)
+        self._label_maps: List[Optional[LabelMap]] = [
+            LabelMap(geoms, entity_idx, pixel_size) if len(geoms) > 0 else None
+            for geoms, entity_idx in zip(self._geometries, self._entity_idx)
+        ]
+
+    def __getstate__(self):
+        return {**super().__getstate__(), "label_maps": self._label_maps}
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self._label_maps = state["label_maps"]
+
+    def query(self, x: np.ndarray, y: np.ndarray, z: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        points_idx_list, entity_idx_list, exact_points_list = [], [], []
+        for z_plane, label_map in enumerate(self._label_maps):
+            if label_map is None:
+                continue
+
+            z_points = np.flatnonzero(z == z_plane)
+            if len(z_points) == 0:
+                continue
+
+            labels = label_map.lookup(x[z_points], y[z_points])
+            inside = labels > 0
+            points_idx_list.append(z_points[inside])
+            entity_idx_list.append(labels[inside].astype(np.int64) - 1)
+            exact_points_list.append(z_points[labels == LabelMap.BOUNDARY])
+
+        exact_points = np.concatenate(exact_points_list) if exact_points_list else np.array([], dtype=np.int64)
+        if len(exact_points) > 0:
+            points_idx, entity_idx = super().query(x[exact_points], y[exact_points], z[exact_points])
+            points_idx_list.append(exact_points[points_idx])
+            entity_idx_list.append(entity_idx)
+
+        if not points_idx_list:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+
+        return np.concatenate(points_idx_list), np.concatenate(entity_idx_list)
+
+
+def entity_index_factory(
+    geometry_list: Sequence[Union[Sequence, np.ndarray]], z_planes_count: int, label_pixel_size: Optional[float] = None
+) -> EntityIndex:
+    if label_pixel_size is not None:
+        return RasterEntityIndex(geometry_list, z_planes_count, label_pixel_size)
+    return EntityIndex(geometry_list, z_planes_count)
@@ -1,40 +1,108 @@
 import argparse
 import warnings
+from typing import List, Optional
 
-import pandas as pd
 from vpt_core import log
 from vpt_core.io.output_tools import make_parent_dirs
-from vpt_core.io.vzgfs import vzg_open, retrying_attempts, io_with_retries
 
-from vpt.partition_transcripts.cell_x_gene import cell_by_gene_matrix
-from vpt.partition_transcripts.cmd_args import validate_args, PartitionTranscriptsArgs
+from vpt.partition_transcripts.cell_x_gene import entity_by_gene_matrices
+from vpt.partition_transcripts.checkpoint import PartitionCheckpoint, construct_cell_x_gene_with_checkpoints
+from vpt.partition_transcripts.cmd_args import (
+    CELL_ID_COLUMN,
+    TRANSCRIPTS_PARTITION_COLUMNS,
+    PartitionTranscriptsArgs,
+    validate_args,
+)
+from vpt.partition_transcripts.entity_index import entity_index_factory
+from vpt.partition_transcripts.tiled_partition import construct_cell_x_gene_by_tiles
 from vpt.utils.boundaries import Boundaries
-from vpt.utils.cellsreader import CellsReader, cell_reader_factory
+from vpt.utils.cellsreader import cell_reader_factory
+from vpt.utils.entity_by_gene_io import write_entity_by_gene
+from vpt.utils.input_utils import as_paths_list, read_segmentation_entity_types, read_transcripts_by_chunks
+
+
+def get_id_columns(input_boundaries: List[str]) -> List[str]:
+    """Names of the EntityID columns of the transcripts output, one per boundaries file"""
+    if len(input_boundaries) == 1:
+        return [CELL_ID_COLUMN]
+
+    id_columns: List[str] = []
+    for path in input_boundaries:
+        column = f"{read_segmentation_entity_types(path)}_id"
+        if column in id_columns:
+            column = f"{column[: -len('_id')]}_{len(id_columns) + 1}_id"
+        id_columns.append(column)
+    return id_columns
 
 
 def main_partition_transcripts(args: argparse.Namespace) -> None:
     # Suppress parquet / Arrow warnings
     warnings.filterwarnings("ignore", category=UserWarning)
 
-    validate_args(PartitionTranscriptsArgs(**vars(args)))
+    partition_args = PartitionTranscriptsArgs(**vars(args))
+    validate_args(partition_args)
     log.info("Partition transcripts started")
 
-    cellsReader: CellsReader = cell_reader_factory(args.input_boundaries)
-    bnds = Boundaries(cellsReader)
+    input_boundaries = as_paths_list(partition_args.input_boundaries)
+    output_entity_by_gene = as_paths_list(partition_args.output_entity_by_gene)
+    bnds_list = [Boundaries(cell_reader_factory(path)) for path in input_boundaries]
+    id_columns = get_id_columns(input_boundaries)
 
-    for attempt in retrying_attempts():
-        with attempt, vzg_open(args.input_transcripts, "r") as f:
-            chunks = pd.read_csv(f, chunksize=args.chunk_size)
-            if args.output_transcripts:
-                make_parent_dirs(args.output_transcripts)
+    if args.output_transcripts:
+        make_parent_dirs(args.output_transcripts)
 
-            cell_x_gene = cell_by_gene_matrix(bnds, chunks, args.output_transcripts)
+    checkpoint: Optional[PartitionCheckpoint] = None
+    if partition_args.checkpoint_path is not None:
+        checkpoint = PartitionCheckpoint(
+            partition_args.checkpoint_path,
+            [*input_boundaries, args.input_transcripts],
+            bool(args.output_transcripts),
+        )
+        entities_list = [bnds.get_entities_geometry() for bnds in bnds_list]
+        entity_indexes = [
+            entity_index_factory(entities.geometries, bnds.get_z_planes_count(), partition_args.label_pixel_size)
+            for entities, bnds in zip(entities_list, bnds_list)
+        ]
+        cell_x_gene_list = construct_cell_x_gene_with_checkpoints(
+            args.input_transcripts,
+            args.chunk_size,
+            entity_indexes,
+            [entities.entity_ids for entities in entities_list],
+            id_columns,
+            checkpoint,
+            partition_args.checkpoint_interval,
+            args.output_transcripts,
+        )
+    elif partition_args.tile_size is not None:
+        entities_list = [bnds.get_entities_geometry() for bnds in bnds_list]
+        cell_x_gene_list = construct_cell_x_gene_by_tiles(
+            args.input_transcripts,
+            [entities.geometries for entities in entities_list],
+            [entities.entity_ids for entities in entities_list],
+            id_columns,
+            args.chunk_size,
+            partition_args.tile_size,
+            partition_args.temp_path,
+            args.output_transcripts,
+            partition_args.label_pixel_size,
+        )
+    else:
+        # only the columns needed for partitioning are parsed unless the whole table is copied to the output
+        columns = None if args.output_transcripts else TRANSCRIPTS_PARTITION_COLUMNS
+        chunks = read_transcripts_by_chunks(args.input_transcripts, args.chunk_size, columns)
+        cell_x_gene_list = entity_by_gene_matrices(
+            bnds_list, chunks, id_columns, args.output_transcripts, partition_args.label_pixel_size
+        )
 
-    make_parent_dirs(args.output_entity_by_gene)
-    io_with_retries(args.output_entity_by_gene, "w", cell_x_gene.to_csv)
-    log.info(f"cell by gene matrix saved as {args.output_entity_by_gene}")
+    for output_path, cell_x_gene in zip(output_entity_by_gene, cell_x_gene_list):
+        make_parent_dirs(output_path)
+        write_entity_by_gene(output_path, cell_x_gene)
+        log.info(f"cell by gene matrix saved as {output_path}")
 
     if args.output_transcripts:
         log.info(f"detected transcripts saved as {args.output_transcripts}")
 
+    if checkpoint is not None:
+        checkpoint.remove()
+
     log.info("Partition transcripts finished")
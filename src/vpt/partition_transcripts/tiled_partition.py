@@ -0,0 +1,267 @@
+import warnings
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+import shapely
+from vpt_core import log
+
+from vpt.app.context import current_context, parallel_run
+from vpt.app.task import Task
+from vpt.partition_transcripts.cell_x_gene import process_chunk, write_transcripts_chunk
+from vpt.partition_transcripts.cmd_args import TRANSCRIPTS_PARTITION_COLUMNS
+from vpt.partition_transcripts.entity_by_gene import ChunkCounts, EntityByGeneAccumulator
+from vpt.partition_transcripts.entity_index import entity_index_factory
+from vpt.partition_transcripts.transcripts_writer import ParquetTranscriptsWriter, transcripts_writer_factory
+from vpt.utils.entity_by_gene_io import EntityByGeneMatrix
+from vpt.utils.input_utils import read_transcripts_by_chunks
+from vpt.utils.temp_files import temp_directory
+
+ROW_INDEX_COLUMN = "row_index"
+
+
+@dataclass(frozen=True)
+class TileGrid:
+    """Non-overlapping square tiles in micron space, every transcript belongs to exactly one tile"""
+
+    min_x: float
+    min_y: float
+    tile_size: float
+    columns: int
+    rows: int
+
+    @staticmethod
+    def from_bounds(bounds: Tuple[float, float, float, float], tile_size: float) -> "TileGrid":
+        min_x, min_y, max_x, max_y = bounds
+        columns = max(int(np.ceil((max_x - min_x) / tile_size)), 1)
+        rows = max(int(np.ceil((max_y - min_y) / tile_size)), 1)
+        return TileGrid(min_x, min_y, tile_size, columns, rows)
+
+    def get_tiles_count(self) -> int:
+        return self.columns * self.rows
+
+    def _column(self, x: np.ndarray) -> np.ndarray:
+        return np.clip(np.floor((x - self.min_x) / self.tile_size), 0, self.columns - 1).astype(np.int64)
+
+    def _row(self, y: np.ndarray) -> np.ndarray:
+        return np.clip(np.floor((y - self.min_y) / self.tile_size), 0, self.rows - 1).astype(np.int64)
+
+    def locate(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        """Tile index of every point, points outside of the grid fall into the border tiles"""
+        return self._row(y) * self.columns + self._column(x)
+
+    def crossing(self, bounds: np.ndarray) -> List[np.ndarray]:
+        """For every tile, indexes of the boxes (min_x, min_y, max_x, max_y rows) that cross the tile"""
+        first_column, last_column = self._column(bounds[:, 0]), self._column(bounds[:, 2])
+        first_row, last_row = self._row(bounds[:, 1]), self._row(bounds[:, 3])
+        columns_count = last_column - first_column + 1
+        tiles_count = columns_count * (last_row - first_row + 1)
+
+        # the range of tiles of every box is expanded into (tile, box) pairs, which are grouped by tile
+        boxes = np.repeat(np.arange(len(bounds)), tiles_count)
+        position = np.arange(len(boxes)) - np.repeat(np.cumsum(tiles_count) - tiles_count, tiles_count)
+        rows = first_row[boxes] + position // columns_count[boxes]
+        columns = first_column[boxes] + position % columns_count[boxes]
+        tiles = rows * self.columns + columns
+        order = np.argsort(tiles, kind="stable")
+        sizes = np.bincount(tiles, minlength=self.get_tiles_count())
+        return np.split(boxes[order], np.cumsum(sizes)[:-1])
+
+
+@dataclass(frozen=True)
+class TranscriptsTile:
+    """
+    Transcripts of one tile together with the Entities that cross it, processed as an independent task. The
+    transcripts are spilled to one file per chunk of the input, and the assignments are written to one file per
+    spilled file. The Entity fields hold one item per Entity type.
+    """
+
+    transcripts_paths: List[str]
+    assignment_paths: Optional[List[str]]
+    chunk_size: int
+    entity_idx: List[np.ndarray]
+    cell_ids: List[np.ndarray]
+    geometry_list: List[List[np.ndarray]]
+    id_columns: List[str]
+    label_pixel_size: Optional[float] = None
+
+
+def partition_tile(tile: TranscriptsTile) -> List[List[ChunkCounts]]:
+    """Chunk counts of the tile transcripts for every Entity type"""
+    entity_indexes = [
+        entity_index_factory(geometry_list, len(geometry_list), tile.label_pixel_size)
+        for geometry_list in tile.geometry_list
+    ]
+    write_assignments = tile.assignment_paths is not None
+
+    result: List[List[ChunkCounts]] = [[] for _ in entity_indexes]
+    for part_i, path in enumerate(tile.transcripts_paths):
+        assignments = []
+        for chunk_df in read_transcripts_by_chunks(path, tile.chunk_size):
+            chunk_counts_list, transcripts_df = process_chunk(
+                chunk_df, entity_indexes, tile.cell_ids, tile.id_columns, write_assignments
+            )
+            for type_result, chunk_counts, entity_idx in zip(result, chunk_counts_list, tile.entity_idx):
+                # the Entities of the tile are sorted by their global index, so the local assignment rules still hold
+                chunk_counts.entity_idx = entity_idx[chunk_counts.entity_idx]
+                type_result.append(chunk_counts)
+            if write_assignments:
+                assignments.append(transcripts_df[[ROW_INDEX_COLUMN, *tile.id_columns]])
+        if tile.assignment_paths is not None:
+            with ParquetTranscriptsWriter(tile.assignment_paths[part_i]) as writer:
+                for assignment_df in assignments:
+                    writer.write(assignment_df)
+
+    return result
+
+
+def _entities_bounds(geometry_list: List[np.ndarray]) -> np.ndarray:
+    # the box of an Entity covers its polygons on all z-planes, empty placeholders and missing polygons are skipped
+    if len(geometry_list) == 0:
+        return np.empty((0, 4))
+    bounds = np.stack([shapely.bounds(geoms) for geoms in geometry_list])
+    bounds[np.stack([~(shapely.area(geoms) > 0) for geoms in geometry_list])] = np.nan
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        return np.hstack([np.nanmin(bounds[:, :, :2], axis=0), np.nanmax(bounds[:, :, 2:], axis=0)])
+
+
+def _get_part_path(temp_dir: str, name: str, tile_idx: int, chunk_i: int) -> str:
+    return f"{temp_dir}/{name}_{tile_idx}_{chunk_i}.parquet"
+
+
+def _spill_transcripts(
+    transcripts_path: str, chunk_size: int, grid: TileGrid, temp_dir: str
+) -> Tuple[Dict[int, List[int]], List[int]]:
+    """
+    Spills every chunk of the input to one closed file per tile, so the number of open files does not grow with the
+    tiles. Returns the chunks spilled for every tile and the first row of every chunk followed by the rows count.
+    """
+    tile_chunks: Dict[int, List[int]] = {}
+    chunk_starts = [0]
+    chunks = read_transcripts_by_chunks(transcripts_path, chunk_size, TRANSCRIPTS_PARTITION_COLUMNS)
+    for chunk_i, chunk_df in enumerate(chunks):
+        start = chunk_starts[-1]
+        chunk_df[ROW_INDEX_COLUMN] = np.arange(start, start + len(chunk_df), dtype=np.int64)
+        chunk_starts.append(start + len(chunk_df))
+
+        tiles = grid.locate(chunk_df["global_x"].to_numpy(), chunk_df["global_y"].to_numpy())
+        order = np.argsort(tiles, kind="stable")
+        tile_indexes, starts = np.unique(tiles[order], return_index=True)
+        for tile_idx, rows in zip(tile_indexes, np.split(order, starts[1:])):
+            with ParquetTranscriptsWriter(_get_part_path(temp_dir, "transcripts", tile_idx, chunk_i)) as writer:
+                writer.write(chunk_df.iloc[rows])
+            tile_chunks.setdefault(int(tile_idx), []).append(chunk_i)
+
+    return tile_chunks, chunk_starts
+
+
+def _write_assigned_transcripts(
+    transcripts_path: str,
+    chunk_size: int,
+    output_transcripts: str,
+    id_columns: List[str],
+    chunk_assignments: List[List[str]],
+    chunk_starts: List[int],
+) -> None:
+    """
+    Writes the input transcripts with the assigned EntityIDs. The assignments are kept by spilled chunk, only the
+    assignments of the spilled chunks that overlap the input chunk are read while it is written.
+    """
+    offset = 0
+    with transcripts_writer_factory(output_transcripts) as writer:
+        for chunk_df in read_transcripts_by_chunks(transcripts_path, chunk_size):
+            stop = offset + len(chunk_df)
+            chunk_ids = {column: np.full(len(chunk_df), -1, dtype=np.int64) for column in id_columns}
+            first_spilled = int(np.searchsorted(chunk_starts, offset, side="right")) - 1
+            last_spilled = min(int(np.searchsorted(chunk_starts, stop, side="left")), len(chunk_assignments))
+            for spilled_i in range(max(first_spilled, 0), last_spilled):
+                for path in chunk_assignments[spilled_i]:
+                    for assignment_df in read_transcripts_by_chunks(path, chunk_size):
+                        rows = assignment_df[ROW_INDEX_COLUMN].to_numpy() - offset
+                        inside = (rows >= 0) & (rows < len(chunk_df))
+                        for column in id_columns:
+                            chunk_ids[column][rows[inside]] = assignment_df[column].to_numpy()[inside]
+            write_transcripts_chunk(writer, chunk_df.assign(**chunk_ids))
+            offset = stop
+
+
+def construct_cell_x_gene_by_tiles(
+    transcripts_path: str,
+    geometry_lists: Sequence[Sequence[Union[Sequence, np.ndarray]]],
+    cell_id_lists: Sequence,
+    id_columns: Sequence[str],
+    chunk_size: int,
+    tile_size: float,
+    temp_path: Optional[str] = None,
+    output_transcripts: Optional[str] = None,
+    label_pixel_size: Optional[float] = None,
+) -> List[EntityByGeneMatrix]:
+    """
+    Bins the transcripts by spatial tile and partitions every tile as an independent task that only holds the
+    transcripts of the tile and the Entities crossing it. Partial Entity by gene counts are reduced at the end.
+    The geometries and EntityIDs hold one item per Entity type.
+    """
+    ctx = current_context()
+    if temp_path is None and ctx is not None and ctx.is_distributed():
+        raise ValueError("A temporary path accessible by all the workers is required to run on a Dask cluster")
+
+    cell_ids = [np.asarray(pd.to_numeric(cell_id_list), dtype=np.int64) for cell_id_list in cell_id_lists]
+    geometries = [[np.asarray(geoms, dtype=object) for geoms in geometry_list] for geometry_list in geometry_lists]
+
+    entities_bounds = [_entities_bounds(type_geometries) for type_geometries in geometries]
+    located = [np.flatnonzero(~np.isnan(bounds).any(axis=1)) for bounds in entities_bounds]
+    located_bounds = np.concatenate([bounds[idx] for bounds, idx in zip(entities_bounds, located)])
+    if len(located_bounds) > 0:
+        grid_bounds = (*located_bounds[:, :2].min(axis=0), *located_bounds[:, 2:].max(axis=0))
+    else:
+        grid_bounds = (0.0, 0.0, tile_size, tile_size)
+    grid = TileGrid.from_bounds(grid_bounds, tile_size)
+    entities_per_tile = [
+        [idx[crossing] for crossing in grid.crossing(bounds[idx])] for bounds, idx in zip(entities_bounds, located)
+    ]
+
+    with temp_directory(temp_path, "partition_transcripts_tiles") as temp_dir:
+        tile_chunks, chunk_starts = _spill_transcripts(transcripts_path, chunk_size, grid, temp_dir)
+        log.info(f"transcripts are binned into {len(tile_chunks)} of {grid.get_tiles_count()} tiles")
+
+        chunk_assignments: List[List[str]] = [[] for _ in chunk_starts[:-1]]
+        for tile_idx, chunks in tile_chunks.items():
+            for chunk_i in chunks:
+                chunk_assignments[chunk_i].append(_get_part_path(temp_dir, "assignment", tile_idx, chunk_i))
+
+        tiles = [
+            TranscriptsTile(
+                transcripts_paths=[_get_part_path(temp_dir, "transcripts", tile_idx, chunk_i) for chunk_i in chunks],
+                assignment_paths=(
+                    [_get_part_path(temp_dir, "assignment", tile_idx, chunk_i) for chunk_i in chunks]
+                    if output_transcripts
+                    else None
+                ),
+                chunk_size=chunk_size,
+                entity_idx=[type_tiles[tile_idx] for type_tiles in entities_per_tile],
+                cell_ids=[ids[type_tiles[tile_idx]] for ids, type_tiles in zip(cell_ids, entities_per_tile)],
+                geometry_list=[
+                    [geoms[type_tiles[tile_idx]] for geoms in type_geometries]
+                    for type_geometries, type_tiles in zip(geometries, entities_per_tile)
+                ],
+                id_columns=list(id_columns),
+                label_pixel_size=label_pixel_size,
+            )
+            for tile_idx, chunks in sorted(tile_chunks.items())
+        ]
+        tiles_counts = parallel_run([Task(partition_tile, tile) for tile in tiles])
+
+        cell_by_gene_list = [EntityByGeneAccumulator(type_cell_ids) for type_cell_ids in cell_ids]
+        for tile_counts in tiles_counts:
+            for cell_by_gene, type_counts in zip(cell_by_gene_list, tile_counts):
+                for chunk_counts in type_counts:
+                    cell_by_gene.add(chunk_counts)
+
+        if output_transcripts:
+            _write_assigned_transcripts(
+                transcripts_path, chunk_size, output_transcripts, list(id_columns), chunk_assignments, chunk_starts
+            )
+
+    return [cell_by_gene.to_matrix() for cell_by_gene in cell_by_gene_list]
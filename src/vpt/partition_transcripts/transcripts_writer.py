@@ -0,0 +1,103 @@
+import io
+from abc import ABC, abstractmethod
+from typing import IO, Optional
+
+import pandas as pd
+import pyarrow as pa
+from fsspec.compression import compr
+from pyarrow import parquet
+from vpt_core.io.vzgfs import vzg_open
+
+from vpt.utils.input_utils import is_parquet_path
+
+COMPRESSION_EXTENSIONS = {".gz": "gzip", ".zst": "zstd"}
+
+
+class TranscriptsWriter(ABC):
+    def __init__(self, path: str):
+        self.path = path
+
+    @abstractmethod
+    def write(self, transcripts_df: pd.DataFrame) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class CsvTranscriptsWriter(TranscriptsWriter):
+    """Streams all chunks into a single output file, compressed if the file name ends with .gz or .zst"""
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self._file: Optional[IO] = None
+        self._text: Optional[io.TextIOWrapper] = None
+
+    def write(self, transcripts_df: pd.DataFrame) -> None:
+        header = self._text is None
+        if self._text is None:
+            self._file = vzg_open(self.path, "wb")
+            compression = get_compression(self.path)
+            stream = compr[compression](self._file, mode="w") if compression else self._file
+            self._text = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+        transcripts_df.to_csv(self._text, index=False, header=header)
+
+    def close(self) -> None:
+        # closing the text layer flushes the compressor, the file itself is closed separately to finish the upload
+        if self._text is not None:
+            self._text.close()
+            self._text = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class ParquetTranscriptsWriter(TranscriptsWriter):
+    """Keeps the output file open for the whole run and writes one row group per chunk"""
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self._file: Optional[IO] = None
+        self._writer: Optional[parquet.ParquetWriter] = None
+        self._schema: Optional[pa.Schema] = None
+
+    def write(self, transcripts_df: pd.DataFrame) -> None:
+        table = pa.Table.from_pandas(transcripts_df, schema=self._schema, preserve_index=False)
+        if self._writer is None:
+            self._schema = table.schema.remove_metadata()
+            self._file = vzg_open(self.path, "wb")
+            self._writer = parquet.ParquetWriter(self._file, self._schema)
+        self._writer.write_table(table.replace_schema_metadata())
+
+    def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def get_compression(path: str) -> Optional[str]:
+    for extension, compression in COMPRESSION_EXTENSIONS.items():
+        if path.lower().endswith(extension):
+            return compression
+    return None
+
+
+def validate_compression(path: str) -> None:
+    compression = get_compression(path)
+    if compression is not None and compression not in compr:
+        raise ValueError(f"{compression} compression is not available, install the package that provides it")
+
+
+def transcripts_writer_factory(path: str) -> TranscriptsWriter:
+    if is_parquet_path(path):
+        return ParquetTranscriptsWriter(path)
+    return CsvTranscriptsWriter(path)
@@ -0,0 +1,46 @@
+from typing import List
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from vpt_core import log
+from vpt_core.segmentation.seg_result import SegmentationResult
+
+# Columns of the approximation report, one row per output column
+ENTITIES = "entities"
+MEDIAN_ERROR = "median_relative_error"
+P95_ERROR = "p95_relative_error"
+MAX_ERROR = "max_relative_error"
+
+
+def sample_entities(boundaries: gpd.GeoDataFrame, count: int, seed: int = 0) -> gpd.GeoDataFrame:
+    """Polygons (on all z-planes) of a random sample of the Entities"""
+    ids = boundaries[SegmentationResult.cell_id_field].unique()
+    sample = np.random.default_rng(seed).choice(ids, min(count, len(ids)), replace=False)
+    return boundaries[boundaries[SegmentationResult.cell_id_field].isin(sample)]
+
+
+def get_approximation_report(approximate: List[pd.DataFrame], exact: List[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Relative errors of the approximate statistics of the sampled Entities against their full resolution
+    statistics, for every output column. The Entities with a zero full resolution value are left out.
+    """
+    errors = []
+    for approximate_df, exact_df in zip(approximate, exact):
+        errors.append((approximate_df.loc[exact_df.index] - exact_df).abs() / exact_df.abs())
+    errors_df = pd.concat(errors).replace(np.inf, np.nan) if errors else pd.DataFrame()
+
+    report = pd.DataFrame(
+        {
+            ENTITIES: errors_df.count(),
+            MEDIAN_ERROR: errors_df.median(),
+            P95_ERROR: errors_df.quantile(0.95),
+            MAX_ERROR: errors_df.max(),
+        }
+    )
+    for column, row in report.iterrows():
+        log.info(
+            f"approximation error of {column} for {row[ENTITIES]} Entities: median {row[MEDIAN_ERROR]:.3g}, "
+            f"95th percentile {row[P95_ERROR]:.3g}, max {row[MAX_ERROR]:.3g}"
+        )
+    return report
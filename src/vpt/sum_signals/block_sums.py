@@ -0,0 +1,371 @@
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+import rasterio
+import shapely
+from rasterio.features import rasterize
+from scipy import ndimage
+from vpt_core import log
+from vpt_core.io.vzgfs import get_rasterio_environment, rasterio_open
+
+from vpt.sum_signals.statistics import (
+    ADDITIVE_MEASURES,
+    COUNT,
+    HIGH_PASS,
+    MAX,
+    SUM,
+    SUM_SQUARES,
+    StatisticsSpec,
+    quantile_measure,
+)
+
+# The mosaic is read by square blocks of this size, extended by the windows of the Entities that start in the block
+BLOCK_SIZE = 2048
+
+# Every sum-signals task covers the Entities that start in a square tile of the mosaic of this size
+TILE_SIZE = 4 * BLOCK_SIZE
+
+# Width in pixels of the box average subtracted by the high-pass filter
+HIGH_PASS_SIZE = 10
+
+# Measures with one value per Entity, the quantiles are kept together as one column per quantile
+MEASURES = (SUM, HIGH_PASS, COUNT, SUM_SQUARES, MAX)
+QUANTILES = "quantiles"
+
+
+def high_pass_filter(image_data: np.ndarray) -> np.ndarray:
+    """High-pass filter of a single Entity window, the box average is computed by FFT over the periodic window"""
+    image_fft = np.fft.fft2(image_data)
+    filtered_fft = ndimage.fourier_uniform(image_fft, size=HIGH_PASS_SIZE)
+    high_pass_image = image_data - np.fft.ifft2(filtered_fft).real
+    return np.maximum(high_pass_image, 0)
+
+
+def get_high_pass_halo(size: float = HIGH_PASS_SIZE) -> int:
+    return int(np.ceil(size / 2 - 0.5))
+
+
+def block_high_pass_filter(image_data: np.ndarray, size: float = HIGH_PASS_SIZE) -> np.ndarray:
+    """
+    High-pass filter of a whole block, the box average is computed in the spatial domain with the neighbor pixels
+    of the block (get_high_pass_halo(size) pixels around it must be included) and mirrored pixels at the image border
+    """
+    # every pixel is weighted by its overlap with the box centered on the pixel, so the end pixels of an even
+    # box are halved
+    halo = get_high_pass_halo(size)
+    taps = np.arange(-halo, halo + 1)
+    weights = np.clip(np.minimum(taps + 0.5, size / 2) - np.maximum(taps - 0.5, -size / 2), 0, None)
+    weights /= weights.sum()
+    data = image_data.astype(np.float64)
+    smooth = ndimage.correlate1d(ndimage.correlate1d(data, weights, axis=0), weights, axis=1)
+    return np.maximum(data - smooth, 0)
+
+
+def get_level_factor(file: rasterio.DatasetReader, pyramid_level: int) -> int:
+    """Downsampling factor of the pyramid level of the image, the level 0 is the full resolution image"""
+    if pyramid_level == 0:
+        return 1
+    overviews = file.overviews(1)
+    if pyramid_level <= len(overviews):
+        return overviews[pyramid_level - 1]
+    log.warning(f"{file.name} has no pyramid level {pyramid_level}, the full resolution image is decimated instead")
+    return 2**pyramid_level
+
+
+def get_entity_windows(geometries: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Image window of every Entity as (top, left, bottom, right) rows, and whether the Entity mask rasterized at the
+    window origin has the shape of the window
+    """
+    bounds = shapely.bounds(geometries)
+    # casting truncates toward zero, the same as int() of the window of a single Entity read
+    top, left = bounds[:, 1].astype(np.int64), bounds[:, 0].astype(np.int64)
+    height = (bounds[:, 3] - bounds[:, 1] + 1).astype(np.int64)
+    width = (bounds[:, 2] - bounds[:, 0] + 1).astype(np.int64)
+    mask_fits = ((bounds[:, 3] - bounds[:, 1]).astype(np.int64) + 1 == height) & (
+        (bounds[:, 2] - bounds[:, 0]).astype(np.int64) + 1 == width
+    )
+    return np.stack([top, left, top + height, left + width], axis=1), mask_fits
+
+
+def split_by_tiles(geometries: np.ndarray, tile_size: int = TILE_SIZE) -> List[np.ndarray]:
+    """
+    Indexes of the geometries for every non-empty square tile, by the origin of their windows. Missing and empty
+    geometries are left out.
+    """
+    present = np.flatnonzero(~shapely.is_missing(geometries) & ~shapely.is_empty(geometries))
+    if len(present) == 0:
+        return []
+    windows, _ = get_entity_windows(geometries[present])
+    _, tiles = np.unique(windows[:, :2] // tile_size, axis=0, return_inverse=True)
+    order = np.argsort(tiles.ravel(), kind="stable")
+    _, starts = np.unique(tiles.ravel()[order], return_index=True)
+    return np.split(present[order], starts[1:])
+
+
+def split_into_layers(windows: np.ndarray) -> np.ndarray:
+    """Layer index of every window such that the windows of one layer do not share pixels"""
+    count = len(windows)
+    # closed boxes shrunk by half a pixel intersect only if the windows share a pixel
+    boxes = shapely.box(windows[:, 1], windows[:, 0], windows[:, 3] - 0.5, windows[:, 2] - 0.5)
+    first, second = shapely.STRtree(boxes).query(boxes, predicate="intersects")
+    pairs = first != second
+    first, second = first[pairs], second[pairs]
+
+    # every layer is a maximal independent set of the overlap graph, built by rounds of random priorities
+    priority = np.random.default_rng(0).permutation(count)
+    layers = np.full(count, -1, dtype=np.int64)
+    layer = 0
+    while (layers < 0).any():
+        candidates = layers < 0
+        while candidates.any():
+            active = candidates[first] & candidates[second]
+            blocked = np.zeros(count, dtype=bool)
+            blocked[first[active & (priority[second] < priority[first])]] = True
+            selected = candidates & ~blocked
+            layers[selected] = layer
+            candidates &= ~selected
+            candidates[second[selected[first]]] = False
+        layer += 1
+    return layers
+
+
+def _move_to_windows(geometries: np.ndarray, window_origins: np.ndarray) -> np.ndarray:
+    # the polygon is first moved to its bounds origin, as the mask of a single Entity, then by whole pixels
+    coords, index = shapely.get_coordinates(geometries, return_index=True)
+    bounds_origins = shapely.bounds(geometries)[:, :2]
+    return shapely.set_coordinates(geometries.copy(), (coords - bounds_origins[index]) + window_origins[index])
+
+
+def _window_measures(
+    window_data: np.ndarray, high_pass_image: Optional[np.ndarray], spec: StatisticsSpec
+) -> Dict[str, Union[float, np.ndarray]]:
+    measures: Dict[str, Union[float, np.ndarray]] = {SUM: np.sum(window_data)}
+    if high_pass_image is not None:
+        measures[HIGH_PASS] = np.sum(high_pass_image)
+    if spec.needs_count():
+        measures[COUNT] = window_data.size
+    if spec.needs_sum_squares():
+        measures[SUM_SQUARES] = np.sum(window_data.astype(np.float64) ** 2)
+    if spec.needs_max():
+        measures[MAX] = np.max(window_data)
+    if spec.quantiles:
+        measures[QUANTILES] = np.quantile(window_data, spec.quantiles)
+    return measures
+
+
+def _grouped_quantiles(
+    values: np.ndarray, labels: np.ndarray, labels_count: int, quantiles: Sequence[float]
+) -> np.ndarray:
+    """Quantiles of the values of every label 1..labels_count, with the linear interpolation of np.quantile"""
+    order = np.lexsort((values, labels))
+    sorted_values = values[order].astype(np.float64)
+    counts = np.bincount(labels, minlength=labels_count + 1)[1:]
+    starts = np.cumsum(counts) - counts
+    result = np.full((len(counts), len(quantiles)), np.nan)
+    present = counts > 0
+    for i, quantile in enumerate(quantiles):
+        position = quantile * (counts[present] - 1)
+        lower = np.floor(position).astype(np.int64)
+        upper = np.minimum(lower + 1, counts[present] - 1)
+        lower_values = sorted_values[starts[present] + lower]
+        upper_values = sorted_values[starts[present] + upper]
+        result[present, i] = lower_values + (upper_values - lower_values) * (position - lower)
+    return result
+
+
+def _sum_block(
+    data: np.ndarray,
+    high_pass_data: Optional[np.ndarray],
+    origin: np.ndarray,
+    windows: np.ndarray,
+    geometries: np.ndarray,
+    masked: np.ndarray,
+    spec: StatisticsSpec,
+    all_touched: bool = True,
+) -> Dict[str, np.ndarray]:
+    """
+    Measures of the Entities in the block, the high-pass is filtered per Entity window if the high-pass sums are
+    requested and high_pass_data is None
+    """
+    measures = {measure: np.zeros(len(windows)) for measure in spec.get_measures() if measure in MEASURES}
+    if spec.quantiles:
+        measures[QUANTILES] = np.zeros((len(windows), len(spec.quantiles)))
+    local_windows = windows - np.tile(origin, 2)
+
+    def window_slice(i: int) -> Tuple[slice, slice]:
+        top, left, bottom, right = local_windows[i]
+        return slice(top, bottom), slice(left, right)
+
+    def window_high_pass(i: int) -> Optional[np.ndarray]:
+        if not spec.needs_high_pass():
+            return None
+        if high_pass_data is None:
+            return high_pass_filter(data[window_slice(i)])
+        return high_pass_data[window_slice(i)]
+
+    # Entities that can't be masked use the measures of their whole window
+    for i in np.flatnonzero(~masked):
+        for measure, value in _window_measures(data[window_slice(i)], window_high_pass(i), spec).items():
+            measures[measure][i] = value
+
+    masked_idx = np.flatnonzero(masked)
+    if len(masked_idx) == 0:
+        return measures
+
+    local_geometries = _move_to_windows(geometries[masked_idx], local_windows[masked_idx][:, [1, 0]].astype(float))
+
+    # the masks of adjacent Entities share the touched pixels, so overlapping windows are rasterized separately
+    layers = split_into_layers(local_windows[masked_idx])
+    flat_data = data.ravel()
+    flat_high_pass = None if high_pass_data is None else high_pass_data.ravel()
+    for layer in range(layers.max() + 1):
+        layer_idx = np.flatnonzero(layers == layer)
+        rows = masked_idx[layer_idx]
+        labels = rasterize(
+            [(geom, label + 1) for geom, label in zip(local_geometries[layer_idx], layer_idx)],
+            out_shape=data.shape,
+            all_touched=all_touched,
+            dtype=np.int32,
+        )
+        # only the pixels touched by the layer are counted, in the raster order of every Entity
+        pixels = np.flatnonzero(labels)
+        pixel_labels = labels.ravel()[pixels]
+        values = flat_data[pixels]
+
+        def layer_sums(weights: Optional[np.ndarray]) -> np.ndarray:
+            return np.bincount(pixel_labels, weights=weights, minlength=len(masked_idx) + 1)[layer_idx + 1]
+
+        measures[SUM][rows] = layer_sums(values)
+        if COUNT in measures:
+            measures[COUNT][rows] = layer_sums(None)
+        if SUM_SQUARES in measures:
+            measures[SUM_SQUARES][rows] = layer_sums(values.astype(np.float64) ** 2)
+        if MAX in measures:
+            measures[MAX][rows] = ndimage.maximum(values, pixel_labels, layer_idx + 1)
+        if QUANTILES in measures:
+            layer_quantiles = _grouped_quantiles(values, pixel_labels, len(masked_idx), spec.quantiles)
+            measures[QUANTILES][rows] = layer_quantiles[layer_idx]
+
+        if not spec.needs_high_pass():
+            continue
+        if flat_high_pass is not None:
+            measures[HIGH_PASS][rows] = layer_sums(flat_high_pass[pixels])
+            continue
+        for label in layer_idx:
+            i = masked_idx[label]
+            cell_slice = window_slice(i)
+            cell_mask = labels[cell_slice] == label + 1
+            measures[HIGH_PASS][i] = np.sum(high_pass_filter(data[cell_slice]) * cell_mask)
+
+    return measures
+
+
+def _read_level_window(file: rasterio.DatasetReader, origin: np.ndarray, end: np.ndarray, factor: int) -> np.ndarray:
+    # GDAL reads a decimated window from the pyramid level (overview) with the same downsampling factor
+    window = rasterio.windows.Window(
+        origin[1] * factor,
+        origin[0] * factor,
+        min(end[1] * factor, file.width) - origin[1] * factor,
+        min(end[0] * factor, file.height) - origin[0] * factor,
+    )
+    if factor == 1:
+        return file.read(1, window=window)
+    return file.read(1, window=window, out_shape=(end[0] - origin[0], end[1] - origin[1]))
+
+
+def get_entity_measures(
+    image_path: str,
+    entity_ids: np.ndarray,
+    geometries: np.ndarray,
+    spec: StatisticsSpec = StatisticsSpec(),
+    block_size: int = BLOCK_SIZE,
+    exact_high_pass: bool = False,
+    pyramid_level: int = 0,
+) -> pd.DataFrame:
+    """
+    Measures of the image pixels touched by every Entity polygon (in mosaic pixels), one column per measure of the
+    spec. The image is read by blocks and the Entities are measured together, with the same raw sums as reading one
+    window per Entity. The high-pass image is filtered once per block, or per Entity window as a periodic image if
+    exact_high_pass is set. Entities without a polygon are skipped.
+
+    A pyramid_level above 0 approximates the measures from a downsampled level of a pyramidal image: the polygons
+    and the high-pass box are scaled down to the level, and the additive measures are scaled up by the area of a
+    level pixel.
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    present = ~shapely.is_missing(geometries) & ~shapely.is_empty(geometries)
+    entity_ids, geometries = np.asarray(entity_ids)[present], geometries[present]
+
+    measures = {measure: np.zeros(len(geometries)) for measure in spec.get_measures() if measure in MEASURES}
+    if spec.quantiles:
+        measures[QUANTILES] = np.zeros((len(geometries), len(spec.quantiles)))
+    with get_rasterio_environment(image_path):
+        with rasterio_open(image_path) as file:
+            factor = get_level_factor(file, pyramid_level)
+            if factor > 1:
+                # the pixel centers inside the polygons grown by half a full resolution pixel approximate the pixels
+                # touched at full resolution, the touched level pixels would overestimate them by the level pixel size
+                geometries = shapely.transform(shapely.buffer(geometries, 0.5), lambda coords: coords / factor)
+            windows, mask_fits = get_entity_windows(geometries)
+            height, width = -(-file.height // factor), -(-file.width // factor)
+
+            clipped = np.clip(windows, 0, [height, width, height, width])
+            in_image = (windows == clipped).all(axis=1)
+            readable = (clipped[:, 2] > clipped[:, 0]) & (clipped[:, 3] > clipped[:, 1])
+            for i in np.flatnonzero(~(in_image & mask_fits)):
+                log.warning(f"Could not apply cell mask for Entity {entity_ids[i]} in image {image_path}")
+
+            # every Entity belongs to the block of its window origin, the block is read with all its windows
+            block_columns = -(-width // block_size)
+            blocks = (clipped[:, 0] // block_size) * block_columns + clipped[:, 1] // block_size
+            readable_idx = np.flatnonzero(readable)
+            order = readable_idx[np.argsort(blocks[readable_idx], kind="stable")]
+            _, starts = np.unique(blocks[order], return_index=True)
+            high_pass_size = HIGH_PASS_SIZE / factor
+            block_filter = spec.needs_high_pass() and not exact_high_pass
+            halo = get_high_pass_halo(high_pass_size) if block_filter else 0
+            for block_idx in np.split(order, starts[1:]) if len(order) > 0 else []:
+                block_windows = clipped[block_idx]
+                origin = block_windows[:, :2].min(axis=0)
+                end = block_windows[:, 2:].max(axis=0)
+                read_origin = np.maximum(origin - halo, 0)
+                read_end = np.minimum(end + halo, [height, width])
+                data = _read_level_window(file, read_origin, read_end, factor)
+                high_pass_data = block_high_pass_filter(data, high_pass_size) if block_filter else None
+
+                crop = tuple(slice(start, stop) for start, stop in zip(origin - read_origin, end - read_origin))
+                block_measures = _sum_block(
+                    data[crop],
+                    None if high_pass_data is None else high_pass_data[crop],
+                    origin,
+                    block_windows,
+                    geometries[block_idx],
+                    in_image[block_idx] & mask_fits[block_idx],
+                    spec,
+                    all_touched=factor == 1,
+                )
+                for measure, values in block_measures.items():
+                    measures[measure][block_idx] = values
+
+    for measure in ADDITIVE_MEASURES:
+        if measure in measures:
+            measures[measure] *= factor**2
+
+    columns = {measure: values for measure, values in measures.items() if measure != QUANTILES}
+    for i, quantile in enumerate(spec.quantiles):
+        columns[quantile_measure(quantile)] = measures[QUANTILES][:, i]
+    return pd.DataFrame(columns, index=entity_ids)
+
+
+def get_entity_brightness(
+    image_path: str,
+    entity_ids: np.ndarray,
+    geometries: np.ndarray,
+    block_size: int = BLOCK_SIZE,
+    exact_high_pass: bool = False,
+) -> Tuple[pd.Series, pd.Series]:
+    """Raw and high-pass filtered sums of the image pixels touched by every Entity polygon (in mosaic pixels)"""
+    measures = get_entity_measures(image_path, entity_ids, geometries, StatisticsSpec(), block_size, exact_high_pass)
+    return measures[SUM], measures[HIGH_PASS]
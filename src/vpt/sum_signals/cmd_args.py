@@ -1,6 +1,9 @@
 from argparse import ArgumentParser
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from typing import List, Optional, Union
 
+from vpt.sum_signals.statistics import DEFAULT_STATISTICS, STATISTICS, validate_statistics
+from vpt.utils.input_utils import as_paths_list
 from vpt.utils.validate import validate_does_not_exist, validate_exists
 
 # The maximum number of parallel processes that may be launched by sum-signals
@@ -10,18 +13,41 @@ MAX_PROCESSES = 512
 @dataclass
 class SumSignalsArgs:
     input_images: str
-    input_boundaries: str
+    input_boundaries: Union[str, List[str]]
     input_micron_to_mosaic: str
-    output_csv: str
+    output_csv: Union[str, List[str]]
     overwrite: bool
+    exact_high_pass: bool = False
+    statistics: List[str] = field(default_factory=lambda: list(DEFAULT_STATISTICS))
+    quantiles: List[float] = field(default_factory=list)
+    pyramid_level: int = 0
+    approximation_sample: int = 200
+    output_approximation_report: Optional[str] = None
+    temp_path: Optional[str] = None
 
 
 def validate_args(args: SumSignalsArgs):
-    validate_exists(args.input_boundaries)
+    input_boundaries = as_paths_list(args.input_boundaries)
+    output_csv = as_paths_list(args.output_csv)
+    if len(input_boundaries) != len(output_csv):
+        raise ValueError("An output path should be specified for every input boundaries file")
+
+    for path in input_boundaries:
+        validate_exists(path)
     validate_exists(args.input_micron_to_mosaic)
+    validate_statistics(args.statistics, args.quantiles)
+    if args.pyramid_level < 0:
+        raise ValueError("The pyramid level should not be negative")
+    if args.pyramid_level > 0 and args.exact_high_pass:
+        raise ValueError("The exact high-pass sums are only computed from the full resolution images")
+    if args.approximation_sample < 0:
+        raise ValueError("The approximation sample size should not be negative")
 
     if not args.overwrite:
-        validate_does_not_exist(args.output_csv)
+        for path in output_csv:
+            validate_does_not_exist(path)
+        if args.output_approximation_report:
+            validate_does_not_exist(args.output_approximation_report)
 
 
 def get_parser() -> ArgumentParser:
@@ -48,7 +74,12 @@ def get_parser() -> ArgumentParser:
         '"stain" and "z" must match the stains and z indexes specified in the segmentation algorithm.',
     )
     required.add_argument(
-        "--input-boundaries", type=str, required=True, help="Path to a micron-space .parquet boundary file."
+        "--input-boundaries",
+        type=str,
+        required=True,
+        nargs="+",
+        help="Path to a micron-space .parquet boundary file. Several files (e.g. cells and nuclei) may be listed to "
+        "sum the signals of all of them in a single pass over the images.",
     )
     required.add_argument(
         "--input-micron-to-mosaic",
@@ -57,7 +88,12 @@ def get_parser() -> ArgumentParser:
         help="Path to the micron to mosaic pixel transformation matrix.",
     )
     required.add_argument(
-        "--output-csv", type=str, required=True, help="Path to the csv file where the sum intensities will be stored."
+        "--output-csv",
+        type=str,
+        required=True,
+        nargs="+",
+        help="Path to the csv file where the sum intensities will be stored, one path for every input boundaries "
+        "file. A path with the .parquet extension is written as a Parquet table with an EntityID column.",
     )
 
     opt = parser.add_argument_group("Optional arguments")
@@ -68,6 +104,67 @@ def get_parser() -> ArgumentParser:
         required=False,
         help="Set true if you want to use non empty directory and agree that files can be overwritten.",
     )
+    opt.add_argument(
+        "--exact-high-pass",
+        action="store_true",
+        default=False,
+        required=False,
+        help="Filter the high-pass image of every Entity separately, as a periodic image of its bounding box. "
+        "Reproduces the high-pass sums of earlier versions, but is slower than filtering the whole mosaic.",
+    )
+    opt.add_argument(
+        "--statistics",
+        type=str,
+        nargs="+",
+        choices=STATISTICS,
+        default=list(DEFAULT_STATISTICS),
+        required=False,
+        help="Statistics of the Entity pixel intensities computed for every channel in the same pass over the "
+        "images: sum (the raw column), high_pass (sum of the high-pass filtered image), mean, max, variance and "
+        "count (number of pixels). Default: sum high_pass.",
+    )
+    opt.add_argument(
+        "--quantiles",
+        type=float,
+        nargs="+",
+        default=[],
+        required=False,
+        help="Quantiles of the Entity pixel intensities, in the [0, 1] range, computed for every channel. The "
+        "quantiles are exact within an image and averaged over the z-planes weighted by the pixel counts.",
+    )
+    opt.add_argument(
+        "--pyramid-level",
+        type=int,
+        default=0,
+        required=False,
+        help="Level of the pyramidal images (e.g. the OME-TIFF images written by convert-to-ome) the statistics are "
+        "approximated from, the level 0 is the full resolution. The sums and counts are scaled by the area of a "
+        "level pixel. Gives a quick approximate table for QC. Default: 0.",
+    )
+    opt.add_argument(
+        "--approximation-sample",
+        type=int,
+        default=200,
+        required=False,
+        help="Number of Entities of every boundaries file measured at full resolution to report the approximation "
+        "error of --pyramid-level. Set to 0 to skip the report. Default: 200.",
+    )
+    opt.add_argument(
+        "--output-approximation-report",
+        type=str,
+        default=None,
+        required=False,
+        help="Path to a csv file where the approximation errors of every output column are stored. The errors are "
+        "logged in any case.",
+    )
+    opt.add_argument(
+        "--temp-path",
+        type=str,
+        default=None,
+        required=False,
+        help="Directory for the temporary geometry files shared by the tasks. It should be accessible by all workers "
+        "of the Dask cluster, and is required with a remote Dask cluster. Default: a local temporary directory.",
+    )
     opt.add_argument("-h", "--help", action="help", help="Show this help message and exit")
 
     return parser
@@ -0,0 +1,54 @@
+from typing import List, Tuple
+
+import numpy as np
+import shapely
+from vpt_core.io.vzgfs import io_with_retries
+
+# Byte size of the int64 items of the offsets and output rows files
+ITEM_SIZE = np.dtype(np.int64).itemsize
+
+
+class GeometryCache:
+    """
+    Mosaic space geometries of every z-plane saved as raw WKB arrays in a directory shared by the sum-signals tasks,
+    which may be on any supported filesystem. Every geometry is stored with its output row, and the geometries of a
+    z-plane are kept in the order they were written, so that every task reads one contiguous range.
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+
+    def _get_path(self, z_layer: int, name: str) -> str:
+        return f"{self._path}/z{z_layer}_{name}.bin"
+
+    def write(self, z_layer: int, entity_idx: np.ndarray, geometries: np.ndarray) -> None:
+        wkb = shapely.to_wkb(geometries)
+        offsets = np.zeros(len(wkb) + 1, dtype="<i8")
+        np.cumsum([len(item) for item in wkb], out=offsets[1:])
+        for name, data in [
+            ("wkb", b"".join(wkb)),
+            ("offsets", offsets.tobytes()),
+            ("entity_idx", np.asarray(entity_idx, dtype="<i8").tobytes()),
+        ]:
+            io_with_retries(self._get_path(z_layer, name), "wb", lambda f: f.write(data))
+
+    def _read_range(self, z_layer: int, name: str, start: int, size: int) -> bytes:
+        def read(f) -> bytes:
+            f.seek(start)
+            return f.read(size)
+
+        return io_with_retries(self._get_path(z_layer, name), "rb", read)
+
+    def read(self, z_layer: int, start: int, stop: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Output rows and geometries of the z-plane range, only this range is read and decoded"""
+        offsets = np.frombuffer(
+            self._read_range(z_layer, "offsets", start * ITEM_SIZE, (stop - start + 1) * ITEM_SIZE), dtype="<i8"
+        )
+        entity_idx = np.frombuffer(
+            self._read_range(z_layer, "entity_idx", start * ITEM_SIZE, (stop - start) * ITEM_SIZE), dtype="<i8"
+        )
+
+        data = self._read_range(z_layer, "wkb", int(offsets[0]), int(offsets[-1] - offsets[0]))
+        local_offsets = offsets - offsets[0]
+        items: List[bytes] = [data[begin:end] for begin, end in zip(local_offsets[:-1], local_offsets[1:])]
+        return entity_idx.astype(np.int64), shapely.from_wkb(np.array(items, dtype=object))
@@ -1,148 +1,195 @@
 import argparse
-from collections import defaultdict
-from typing import Iterable, Tuple
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Sequence, Tuple
 
+import geopandas as gpd
 import numpy as np
 import pandas as pd
-import rasterio
-from rasterio.features import rasterize
-from scipy import ndimage
-from shapely.affinity import affine_transform, translate
+import shapely
 from shapely.geometry.base import BaseGeometry
 from vpt_core import log
-from vpt_core.io.regex_tools import parse_images_str
-from vpt_core.io.vzgfs import (
-    filesystem_path_split,
-    get_rasterio_environment,
-    initialize_filesystem,
-    rasterio_open,
-    io_with_retries,
-)
+from vpt_core.io.output_tools import make_parent_dirs
+from vpt_core.io.regex_tools import ImagePath, parse_images_str
+from vpt_core.io.vzgfs import filesystem_path_split, initialize_filesystem, io_with_retries
 from vpt_core.log import show_progress
 from vpt_core.segmentation.seg_result import SegmentationResult
 
 from vpt.app.context import current_context, parallel_run
 from vpt.app.task import Task
+from vpt.sum_signals.approximation import get_approximation_report, sample_entities
+from vpt.sum_signals.block_sums import get_entity_brightness, get_entity_measures, split_by_tiles
 from vpt.sum_signals.cmd_args import SumSignalsArgs, parse_args, validate_args
+from vpt.sum_signals.geometry_cache import GeometryCache
+from vpt.sum_signals.statistics import ChannelStatistics, StatisticsSpec
 from vpt.sum_signals.validate import validate_z_layers_number
-from vpt.utils.input_utils import read_geodataframe, read_micron_to_mosaic_transform, read_parquet_by_groups
-
-
-def get_cell_brightness_in_image(image_path: str, entities: Iterable[Tuple[int, BaseGeometry]]) -> tuple:
-    cell_raw_brightness = []
-    cell_filtered_brightness = []
-    indexes = []
-
-    with get_rasterio_environment(image_path):
-        with rasterio_open(image_path) as file:
-            for cell_id, cell in entities:
-                if cell is None or cell.is_empty:
-                    continue
-
-                # Define an image area to read
-                rasterio_window = [
-                    cell.bounds[0],
-                    cell.bounds[1],
-                    cell.bounds[2] - cell.bounds[0] + 1,
-                    cell.bounds[3] - cell.bounds[1] + 1,
-                ]
-
-                # Read the image area and convert to 2D numpy array
-                rasterio_window = [int(x) for x in rasterio_window]
-                image_data = file.read(1, window=rasterio.windows.Window(*rasterio_window))
-
-                high_pass_input = image_data
-                cell_fft = np.fft.fft2(high_pass_input)
-                filtered_fft = ndimage.fourier_uniform(cell_fft, size=10)
-                inverse_filtered_fft = np.fft.ifft2(filtered_fft)
-                high_pass_image = high_pass_input - inverse_filtered_fft.real
-                high_pass_image = np.maximum(high_pass_image, 0)
-
-                try:
-                    # Create a polygon at the origin to use to mask an image
-                    selector_poly = translate(cell, xoff=-cell.bounds[0], yoff=-cell.bounds[1])
-
-                    # Create the mask
-                    bounding_box = [int(x) for x in selector_poly.bounds]
-                    if (
-                        min(bounding_box[:2]) < 0
-                        or bounding_box[2] >= image_data.shape[1]
-                        or bounding_box[3] >= image_data.shape[0]
-                    ):
-                        raise ValueError(f"Cell is beyond image boundaries: {cell}")
-
-                    mask_shape = (bounding_box[3] + 1, bounding_box[2] + 1)
-                    cell_mask = rasterize([selector_poly], out_shape=mask_shape, all_touched=True)
-                    temp_raw = np.sum(image_data * cell_mask)
-                    temp_filt = np.sum(high_pass_image * cell_mask)
-                except ValueError:
-                    log.warning(f"Could not apply cell mask for Entity {cell_id} in image {image_path}")
-                    temp_raw = np.sum(image_data)
-                    temp_filt = np.sum(high_pass_image)
-
-                cell_raw_brightness.append(temp_raw)
-                cell_filtered_brightness.append(temp_filt)
-                indexes.append(cell_id)
-
-    return (pd.Series(cell_raw_brightness, index=indexes), pd.Series(cell_filtered_brightness, index=indexes))
-
-
-def calculate(args):
-    img, fn_boundaries, transform = args.img, args.boundaries, args.transform
-    log.info(f"sum_signals.calculate for {img.full_path} started")
-
-    def iterator() -> Iterable[Tuple[int, BaseGeometry]]:
-        for parquet_data in read_parquet_by_groups(fn_boundaries):
-            for _, row in parquet_data.loc[parquet_data[SegmentationResult.z_index_field] == img.z_layer].iterrows():
-                entity_id = row[SegmentationResult.cell_id_field]
-                geom = row[SegmentationResult.geometry_field]
-                yield entity_id, affine_transform(geom, transform)
-
-    res = get_cell_brightness_in_image(img.full_path, iterator())
-    return img.channel, res
-
-
-def validate_and_prepare_ids(images, fn_boundary):
-    boundaries = read_geodataframe(fn_boundary)
-    validate_z_layers_number(images, boundaries)
-    return boundaries["EntityID"].unique()
-
-
-def get_cell_brightnesses(images, fn_boundary, transform):
-    ids = validate_and_prepare_ids(images, fn_boundary)
-
-    def default_value():
-        return pd.Series(np.zeros(len(ids)), index=ids)
-
-    results_raw, results_high_pass = defaultdict(default_value), defaultdict(default_value)
-    log.info("output structures prepared")
-    results = parallel_run(
-        [Task(calculate, argparse.Namespace(img=img, boundaries=fn_boundary, transform=transform)) for img in images]
+from vpt.utils.input_utils import as_paths_list, is_parquet_path, read_geodataframe, read_micron_to_mosaic_transform
+from vpt.utils.temp_files import temp_directory
+
+
+def get_cell_brightness_in_image(
+    image_path: str, entities: Iterable[Tuple[int, BaseGeometry]], exact_high_pass: bool = False
+) -> tuple:
+    entity_ids, geometries = [], []
+    for cell_id, cell in entities:
+        entity_ids.append(cell_id)
+        geometries.append(cell)
+    return get_entity_brightness(
+        image_path, np.array(entity_ids), np.array(geometries, dtype=object), exact_high_pass=exact_high_pass
     )
 
+
+def affine_transform_geometries(geometries: np.ndarray, transform: List[float]) -> np.ndarray:
+    """Vectorized shapely.affinity.affine_transform with a 2D transform, missing geometries are kept"""
+    a, b, d, e, xoff, yoff = transform
+    matrix = np.array([[a, b], [d, e]], dtype=float)
+    offset = np.array([xoff, yoff], dtype=float)
+    return shapely.transform(geometries, lambda coords: np.matmul(matrix, coords.T).T + offset)
+
+
+@dataclass(frozen=True)
+class SumSignalsTile:
+    """Entities of one image that start in one mosaic tile, stored in the range [start, stop) of the z-plane cache"""
+
+    image: ImagePath
+    cache_path: str
+    start: int
+    stop: int
+    spec: StatisticsSpec
+    exact_high_pass: bool = False
+    pyramid_level: int = 0
+
+
+def calculate(tile: SumSignalsTile):
+    log.info(f"sum_signals.calculate for {tile.image.full_path} and {tile.stop - tile.start} Entities started")
+    entity_idx, geometries = GeometryCache(tile.cache_path).read(tile.image.z_layer, tile.start, tile.stop)
+    res = get_entity_measures(
+        tile.image.full_path,
+        entity_idx,
+        geometries,
+        tile.spec,
+        exact_high_pass=tile.exact_high_pass,
+        pyramid_level=tile.pyramid_level,
+    )
+    return tile.image.channel, res
+
+
+def prepare_geometry_cache(
+    cache: GeometryCache, z_layers: Iterable[int], boundaries_list: Sequence[gpd.GeoDataFrame], transform: List[float]
+) -> Tuple[List[np.ndarray], Dict[int, List[Tuple[int, int]]]]:
+    """
+    Saves the mosaic space geometries of every z-plane to the cache ordered by tile. The Entities of all the
+    boundaries share the cache, the output rows of every boundaries item follow the rows of the previous ones.
+    Returns the EntityIDs of the output rows of every boundaries item and the cache ranges of the tiles of every
+    z-plane.
+    """
+    ids_list, entity_idx_list, z_indexes_list, geometries_list = [], [], [], []
+    offset = 0
+    for boundaries in boundaries_list:
+        entity_idx, ids = pd.factorize(boundaries[SegmentationResult.cell_id_field])
+        ids_list.append(np.asarray(ids))
+        entity_idx_list.append(entity_idx + offset)
+        offset += len(ids)
+        z_indexes_list.append(boundaries[SegmentationResult.z_index_field].to_numpy())
+        geometries_list.append(np.asarray(boundaries[SegmentationResult.geometry_field], dtype=object))
+    entity_idx = np.concatenate(entity_idx_list) if entity_idx_list else np.empty(0, dtype=np.int64)
+    z_indexes = np.concatenate(z_indexes_list) if z_indexes_list else np.empty(0, dtype=np.int64)
+    geometries = affine_transform_geometries(
+        np.concatenate(geometries_list) if geometries_list else np.empty(0, dtype=object), transform
+    )
+
+    z_ranges = {}
+    for z_layer in z_layers:
+        rows = np.flatnonzero(z_indexes == z_layer)
+        tiles = split_by_tiles(geometries[rows])
+        ordered = rows[np.concatenate(tiles)] if tiles else rows[:0]
+        cache.write(z_layer, entity_idx[ordered], geometries[ordered])
+        bounds = np.cumsum([0] + [len(tile) for tile in tiles])
+        z_ranges[z_layer] = [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:])]
+    return ids_list, z_ranges
+
+
+def read_boundaries(images, boundaries_paths) -> List[gpd.GeoDataFrame]:
+    boundaries_list = []
+    for path in boundaries_paths:
+        boundaries = read_geodataframe(path)
+        validate_z_layers_number(images, boundaries)
+        boundaries_list.append(boundaries)
+    return boundaries_list
+
+
+def get_entity_statistics(
+    images, boundaries_list, transform, exact_high_pass=False, spec=StatisticsSpec(), pyramid_level=0, temp_path=None
+):
+    """
+    Statistics of the Entities of every boundaries item, one DataFrame per item. Every image block is read once for
+    the Entities of all the items.
+    """
+    ctx = current_context()
+    if temp_path is None and ctx is not None and ctx.is_distributed():
+        raise ValueError("A temporary path accessible by all the workers is required to run on a Dask cluster")
+
+    # the workers share the geometries prepared once by z-plane
+    with temp_directory(temp_path, "sum_signals_geometry") as cache_path:
+        ids_list, z_ranges = prepare_geometry_cache(
+            GeometryCache(cache_path), set(img.z_layer for img in images), boundaries_list, transform
+        )
+        del boundaries_list
+        tiles = [
+            SumSignalsTile(img, cache_path, start, stop, spec, exact_high_pass, pyramid_level)
+            for img in images
+            for start, stop in z_ranges[img.z_layer]
+        ]
+        log.info(f"{len(tiles)} tasks prepared for {len(images)} images")
+        results = parallel_run([Task(calculate, tile) for tile in tiles])
+
+    entities_count = sum(len(ids) for ids in ids_list)
+    channel_statistics: Dict[str, ChannelStatistics] = {}
+    for img in images:
+        channel_statistics.setdefault(img.channel, ChannelStatistics(entities_count, spec))
+
     def combine_results(jobs, progress=False):
         if progress:
             jobs = show_progress(jobs, total=len(results))
         log.info("all jobs finished")
-        for channel, (intensities_raw, intensities_high_pass) in jobs:
-            results_raw[channel][intensities_raw.index] += intensities_raw
-            results_high_pass[channel][intensities_high_pass.index] += intensities_high_pass
+        for channel, measures in jobs:
+            channel_statistics[channel].add(measures)
 
-    ctx = current_context()
     combine_results(results, progress=ctx is None or ctx.get_workers_count() == 1)
     log.info("results combined")
 
-    assert set(results_raw.keys()) == set(results_high_pass.keys())
+    sum_signals_data: Dict[str, np.ndarray] = {}
+    for stain, statistics in channel_statistics.items():
+        sum_signals_data.update(statistics.get_columns(stain))
 
-    sum_signals_data = {}
-    for stain in results_raw.keys():
-        sum_signals_data[f"{stain}_raw"] = results_raw[stain]
-        sum_signals_data[f"{stain}_high_pass"] = results_high_pass[stain]
+    result = []
+    offset = 0
+    for ids in ids_list:
+        columns = {column: values[offset : offset + len(ids)] for column, values in sum_signals_data.items()}
+        offset += len(ids)
+        df = pd.DataFrame(columns, index=ids)
+        df.sort_index(inplace=True)
+        result.append(df)
 
-    df = pd.DataFrame(sum_signals_data)
-    df.sort_index(inplace=True)
+    return result
 
-    return df
+
+def get_entity_brightnesses(images, boundaries_paths, transform, exact_high_pass=False, spec=StatisticsSpec()):
+    """Statistics of the Entities of every boundaries file, one DataFrame per file"""
+    return get_entity_statistics(images, read_boundaries(images, boundaries_paths), transform, exact_high_pass, spec)
+
+
+def get_approximation_errors(
+    images, boundaries_list, approximate_dfs, transform, spec, sample_size, temp_path=None
+) -> pd.DataFrame:
+    """Approximation errors of the statistics of a pyramid level, measured on a sample of Entities of every item"""
+    samples = [sample_entities(boundaries, sample_size) for boundaries in boundaries_list]
+    log.info(f"measuring {sum(len(sample) for sample in samples)} sampled polygons at full resolution")
+    exact_dfs = get_entity_statistics(images, samples, transform, spec=spec, temp_path=temp_path)
+    return get_approximation_report(approximate_dfs, exact_dfs)
+
+
+def get_cell_brightnesses(images, fn_boundary, transform, exact_high_pass=False, spec=StatisticsSpec()):
+    return get_entity_brightnesses(images, [fn_boundary], transform, exact_high_pass, spec)[0]
 
 
 def save_df(df, path: str):
@@ -153,7 +200,11 @@ def save_df(df, path: str):
     except ValueError:
         pass
 
-    io_with_retries(path, "w", df.to_csv)
+    if is_parquet_path(path):
+        table = df.rename_axis(SegmentationResult.cell_id_field).reset_index()
+        io_with_retries(path, "wb", lambda f: table.to_parquet(f, index=False))
+    else:
+        io_with_retries(path, "w", df.to_csv)
 
 
 def sum_signals(args: argparse.Namespace):
@@ -165,9 +216,36 @@ def sum_signals(args: argparse.Namespace):
     m2m = np.array(read_micron_to_mosaic_transform(sum_signals_args.input_micron_to_mosaic))
     tform_flat = [*m2m[:2, :2].flatten(), *m2m[:2, 2].flatten()]
 
-    df = get_cell_brightnesses(regex_info.images, sum_signals_args.input_boundaries, tform_flat)
+    spec = StatisticsSpec(tuple(sum_signals_args.statistics), tuple(sum_signals_args.quantiles))
+    input_boundaries = as_paths_list(sum_signals_args.input_boundaries)
+    output_csv = as_paths_list(sum_signals_args.output_csv)
+    boundaries_list = read_boundaries(regex_info.images, input_boundaries)
+    dfs = get_entity_statistics(
+        regex_info.images,
+        boundaries_list,
+        tform_flat,
+        sum_signals_args.exact_high_pass,
+        spec,
+        sum_signals_args.pyramid_level,
+        sum_signals_args.temp_path,
+    )
 
-    save_df(df, sum_signals_args.output_csv)
+    for df, path in zip(dfs, output_csv):
+        save_df(df, path)
+
+    if sum_signals_args.pyramid_level > 0 and sum_signals_args.approximation_sample > 0:
+        report = get_approximation_errors(
+            regex_info.images,
+            boundaries_list,
+            dfs,
+            tform_flat,
+            spec,
+            sum_signals_args.approximation_sample,
+            sum_signals_args.temp_path,
+        )
+        if sum_signals_args.output_approximation_report:
+            make_parent_dirs(sum_signals_args.output_approximation_report)
+            io_with_retries(sum_signals_args.output_approximation_report, "w", report.to_csv)
     log.info("Sum signals finished")
 
 
@@ -0,0 +1,114 @@
+from dataclasses import dataclass
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+SUM = "sum"
+HIGH_PASS = "high_pass"
+MEAN = "mean"
+MAX = "max"
+VARIANCE = "variance"
+COUNT = "count"
+STATISTICS = (SUM, HIGH_PASS, MEAN, MAX, VARIANCE, COUNT)
+DEFAULT_STATISTICS = (SUM, HIGH_PASS)
+
+# Partial measures of the Entity pixels computed from one image, the statistics are derived from them
+SUM_SQUARES = "sum_squares"
+ADDITIVE_MEASURES = (SUM, HIGH_PASS, COUNT, SUM_SQUARES)
+
+
+def quantile_measure(quantile: float) -> str:
+    return f"q{quantile * 100:g}"
+
+
+def get_output_column(stain: str, statistic: str) -> str:
+    # the sum keeps the column name of the raw sums written by earlier versions
+    return f"{stain}_raw" if statistic == SUM else f"{stain}_{statistic}"
+
+
+@dataclass(frozen=True)
+class StatisticsSpec:
+    """Statistics of the raw pixel intensities (and the high-pass sum) computed for every Entity and channel"""
+
+    statistics: Tuple[str, ...] = DEFAULT_STATISTICS
+    quantiles: Tuple[float, ...] = ()
+
+    def needs_high_pass(self) -> bool:
+        return HIGH_PASS in self.statistics
+
+    def needs_count(self) -> bool:
+        return any(statistic not in (SUM, HIGH_PASS) for statistic in self.statistics) or len(self.quantiles) > 0
+
+    def needs_sum_squares(self) -> bool:
+        return VARIANCE in self.statistics
+
+    def needs_max(self) -> bool:
+        return MAX in self.statistics
+
+    def get_measures(self) -> List[str]:
+        """Measures computed from every image"""
+        measures = [SUM]
+        if self.needs_high_pass():
+            measures.append(HIGH_PASS)
+        if self.needs_count():
+            measures.append(COUNT)
+        if self.needs_sum_squares():
+            measures.append(SUM_SQUARES)
+        if self.needs_max():
+            measures.append(MAX)
+        return measures + [quantile_measure(quantile) for quantile in self.quantiles]
+
+
+class ChannelStatistics:
+    """
+    Statistics of all Entities for one channel, accumulated over the images (z-planes) and tiles of the channel.
+    The quantiles are exact within an image and averaged over the images weighted by the pixel counts.
+    """
+
+    def __init__(self, entities_count: int, spec: StatisticsSpec):
+        self._spec = spec
+        self._measures: Dict[str, np.ndarray] = {}
+        for measure in spec.get_measures():
+            self._measures[measure] = np.full(entities_count, -np.inf if measure == MAX else 0.0)
+
+    def add(self, measures: pd.DataFrame) -> None:
+        # the Entities of one image are unique, so the measures are added by fancy indexing
+        rows = measures.index.to_numpy()
+        for measure, values in self._measures.items():
+            if measure in ADDITIVE_MEASURES:
+                values[rows] += measures[measure].to_numpy()
+            elif measure == MAX:
+                values[rows] = np.maximum(values[rows], measures[measure].to_numpy())
+            else:
+                values[rows] += measures[measure].to_numpy() * measures[COUNT].to_numpy()
+
+    def get_columns(self, stain: str) -> Dict[str, np.ndarray]:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            # the count is measured whenever a statistic divided by it is requested
+            count = self._measures.get(COUNT, np.empty(0))
+            columns = {}
+            for statistic in self._spec.statistics:
+                if statistic in (SUM, HIGH_PASS, COUNT):
+                    values = self._measures[statistic]
+                elif statistic == MEAN:
+                    values = self._measures[SUM] / count
+                elif statistic == MAX:
+                    values = np.where(count > 0, self._measures[MAX], np.nan)
+                else:
+                    mean = self._measures[SUM] / count
+                    values = np.maximum(self._measures[SUM_SQUARES] / count - mean**2, 0)
+                columns[get_output_column(stain, statistic)] = values
+            for quantile in self._spec.quantiles:
+                measure = quantile_measure(quantile)
+                columns[get_output_column(stain, measure)] = self._measures[measure] / count
+        return columns
+
+
+def validate_statistics(statistics: Sequence[str], quantiles: Sequence[float]) -> None:
+    for statistic in statistics:
+        if statistic not in STATISTICS:
+            raise ValueError(f"Unknown statistic {statistic}, the supported statistics are {', '.join(STATISTICS)}")
+    for quantile in quantiles:
+        if not 0 <= quantile <= 1:
+            raise ValueError(f"Quantile {quantile} is outside of the [0, 1] range")
@@ -30,30 +30,26 @@ class CellColoring:
         self._outputNameBtrDict: dict = {}
 
     def _make_cell_lists(self):
-        data = self._matrix.data
         sigma_genes = []
-        for genes_column in self._matrix.data.T:
+        for genes_column in self._matrix.get_gene_columns():
             sigma_genes.append(np.std(genes_column))
 
-        self._metricExtr[ExpressionMetric.Count.value][0] = data.min()
-        self._metricExtr[ExpressionMetric.Count.value][1] = data.max()
+        self._metricExtr[ExpressionMetric.Count.value][0] = self._matrix.get_min()
+        self._metricExtr[ExpressionMetric.Count.value][1] = self._matrix.get_max()
 
-        for i, row_transcripts in enumerate(data):
-            self._cellsMetricsList[ExpressionMetric.Count.value][i] = np.sum(row_transcripts)
+        self._cellsMetricsList[ExpressionMetric.Count.value][:] = self._matrix.get_cell_sums()
 
         self._normalized_matrix: GeneExprMatrix = deepcopy(self._matrix)
         self._normalized_matrix.change_matrix_data_from_origin(ExpressionMetric.Normalized)
-        normalized_data = self._normalized_matrix.data
         normalized_sigma_genes = []
 
-        self._metricExtr[ExpressionMetric.Normalized.value][0] = normalized_data.min()
-        self._metricExtr[ExpressionMetric.Normalized.value][1] = normalized_data.max()
+        self._metricExtr[ExpressionMetric.Normalized.value][0] = self._normalized_matrix.get_min()
+        self._metricExtr[ExpressionMetric.Normalized.value][1] = self._normalized_matrix.get_max()
 
-        for genes_column in self._normalized_matrix.data.T:
+        for genes_column in self._normalized_matrix.get_gene_columns():
             normalized_sigma_genes.append(np.std(genes_column))
 
-        for i, row_transcripts in enumerate(normalized_data):
-            self._cellsMetricsList[ExpressionMetric.Normalized.value][i] = np.sum(row_transcripts)
+        self._cellsMetricsList[ExpressionMetric.Normalized.value][:] = self._normalized_matrix.get_cell_sums()
 
         self._outputNameBtrDict: dict = {
             "genes_mean": create_bytearray(self._matrix.average_genes),
@@ -72,9 +68,7 @@ class CellColoring:
         statisticsVariablesBtr = bytearray()
 
         for metric in file_names.keys():
-            cell_metric_btr = bytearray()  # t[i]
-            for i in range(self._matrix.lines_cells):
-                cell_metric_btr.extend(np.float32(self._cellsMetricsList[metric.value][i]))
+            cell_metric_btr = bytearray(self._cellsMetricsList[metric.value].astype(np.float32).tobytes())  # t[i]
 
             statisticsVariablesBtr.extend(np.float32(np.min(self._cellsMetricsList[metric.value])))
             statisticsVariablesBtr.extend(np.float32(np.max(self._cellsMetricsList[metric.value])))
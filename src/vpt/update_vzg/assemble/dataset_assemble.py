@@ -1,13 +1,12 @@
 import os
 from typing import Dict, Optional
 
-import pandas
 from vpt_core import log
-from vpt_core.io.vzgfs import io_with_retries
 
 from vpt.update_vzg.assemble.cell_coloring import CellColoring
 from vpt.update_vzg.assemble.expression_matrix import GeneExprMatrix
 from vpt.update_vzg.cell_metadata import CellMetadata
+from vpt.utils.entity_by_gene_io import read_entity_by_gene
 from vpt.utils.general_data import write_file
 
 
@@ -25,16 +24,15 @@ def identify_sequential(genes: list[Dict], channels: list[str]) -> list[str]:
 def run_dataset_assembling(
     exprMatrixPath: str, outputDatasetPath: str, cellMetadata: CellMetadata, genes: Optional[list[str]] = None
 ):
-    exprMatrixDF: pandas.DataFrame = io_with_retries(exprMatrixPath, "r", lambda f: pandas.read_csv(f, index_col=0))
+    exprMatrixSparse = read_entity_by_gene(exprMatrixPath)
 
     # Sort cell by gene matrix by EntityID if it isn't already sorted
-    exprMatrixDF = exprMatrixDF.sort_index()
+    exprMatrixSparse = exprMatrixSparse.sort_by_entity()
 
     if genes:
-        exprMatrixDF = exprMatrixDF.assign(**{g: 0 for g in set(genes) - set(exprMatrixDF.columns)})
-        exprMatrixDF = exprMatrixDF.reindex(columns=genes)
+        exprMatrixSparse = exprMatrixSparse.reindex_genes(genes)
 
-    exprMatrix = GeneExprMatrix(exprMatrixDF, cellMetadata)
+    exprMatrix = GeneExprMatrix(exprMatrixSparse, cellMetadata)
 
     log.info("Start calculating expression matrices")
     exprMatrixFolder = os.path.join("assemble", "expression_matrix")
@@ -1,11 +1,11 @@
 from enum import Enum
-from typing import Tuple
+from typing import Iterator, Tuple
 
 import numpy as np
-import pandas
+from scipy import sparse
 
-from vpt.update_vzg.byte_utils import extend_with_u32
 from vpt.update_vzg.cell_metadata import CellMetadata
+from vpt.utils.entity_by_gene_io import EntityByGeneMatrix
 
 
 class ExpressionMetric(Enum):
@@ -23,9 +23,11 @@ class GeneExprMatrix:
     Cell2|    0     |     0     |     4     |     3     |     0    |     8     |    7
     """
 
-    def __init__(self, exprMatrix: pandas.DataFrame, cellMetadata: CellMetadata):
+    ROWS_BLOCK_SIZE = 10000
+
+    def __init__(self, exprMatrix: EntityByGeneMatrix, cellMetadata: CellMetadata):
         self._cellMetaData = cellMetadata
-        self.data = np.zeros(0)
+        self.data = sparse.csr_matrix((0, 0))
         self.columns_genes = 0
         self.lines_cells = 0
 
@@ -36,17 +38,23 @@ class GeneExprMatrix:
         self._load_matrix_data(exprMatrix)
 
     def _calculate_statistic_variables(self):
-        self.average_sum = np.mean(self.data)  # μ
-        self.std = np.std(self.data)  # σ
-        self.average_genes = np.array(self.columns_genes)
-
-        self.average_genes = np.mean(self.data, 0)
-
-    def _load_matrix_data(self, exprMatrix):
-        exprMatrix = exprMatrix.sort_index()
-        self.data = exprMatrix.to_numpy()
-        self.lines_cells = len(self.data)
-        self.columns_genes = len(self.data[0])
+        size = self.lines_cells * self.columns_genes
+        self.average_sum = self.data.sum() / size  # μ
+        self.std = np.sqrt(self.data.multiply(self.data).sum() / size - self.average_sum**2)  # σ
+
+        if np.issubdtype(self.data.dtype, np.integer):
+            self.average_genes = np.asarray(self.data.sum(axis=0), dtype=np.float64).ravel() / self.lines_cells
+        else:
+            # rows are accumulated one after another, as numpy does for the mean along the first axis
+            self.average_genes = np.zeros(self.columns_genes, dtype=self.data.dtype)
+            np.add.at(self.average_genes, self.data.indices, self.data.data)
+            self.average_genes = np.true_divide(self.average_genes, self.lines_cells, out=self.average_genes)
+
+    def _load_matrix_data(self, exprMatrix: EntityByGeneMatrix):
+        self.data = exprMatrix.sort_by_entity().matrix.tocsr()
+        self.data.eliminate_zeros()
+        self.data.sort_indices()
+        self.lines_cells, self.columns_genes = self.data.shape
 
         self._calculate_statistic_variables()
 
@@ -55,15 +63,44 @@ class GeneExprMatrix:
             self._normalize_data_by_cell_volume(self.data)
             self._calculate_statistic_variables()
 
-    def _normalize_data_by_cell_volume(self, origin_data):
+    def _normalize_data_by_cell_volume(self, origin_data: sparse.csr_matrix):
         volume_np = self._cellMetaData.get_volume_array()
 
-        self.lines_cells, self.columns_genes = len(origin_data), len(origin_data[0])
-
-        self.data = np.zeros((self.lines_cells, self.columns_genes), np.float32)
-        for cell_number, cell_row in enumerate(self.data):
-            cell_volume = volume_np[cell_number]
-            self.data[cell_number] = origin_data[cell_number] / cell_volume
+        self.lines_cells, self.columns_genes = origin_data.shape
+
+        cells_volume = np.repeat(np.asarray(volume_np[: self.lines_cells]), np.diff(origin_data.indptr))
+        self.data = sparse.csr_matrix(
+            ((origin_data.data / cells_volume).astype(np.float32), origin_data.indices, origin_data.indptr),
+            shape=origin_data.shape,
+        )
+
+    def get_min(self):
+        return self.data.min()
+
+    def get_max(self):
+        return self.data.max()
+
+    def get_gene_columns(self) -> Iterator[np.ndarray]:
+        """Dense gene columns, one at a time"""
+        columns = self.data.tocsc()
+        for gene_number in range(self.columns_genes):
+            column = np.zeros(self.lines_cells, dtype=self.data.dtype)
+            start, end = columns.indptr[gene_number], columns.indptr[gene_number + 1]
+            column[columns.indices[start:end]] = columns.data[start:end]
+            yield column
+
+    def get_cell_sums(self) -> np.ndarray:
+        if np.issubdtype(self.data.dtype, np.integer):
+            return np.asarray(self.data.sum(axis=1)).ravel()
+
+        # floating point rows are summed densely by blocks to keep the summation order of numpy
+        return np.concatenate(
+            [
+                self.data[start : start + self.ROWS_BLOCK_SIZE].toarray().sum(axis=1)
+                for start in range(0, self.lines_cells, self.ROWS_BLOCK_SIZE)
+            ]
+            + [np.zeros(0, dtype=self.data.dtype)]
+        )
 
     def generate_sparse_gene_expr_matrix_data(self) -> Tuple[bytearray, bytearray]:
         """
@@ -77,34 +114,7 @@ class GeneExprMatrix:
             3. An array of maximum numbers of gene transcripts in cells:
             |   2   |   5   |   4   |   3   |   3   |   8   |   7   |
         """
-        transcripts_gene_number_btr = bytearray()
-        transcripts_gene_indices_btr = bytearray()
-        genesCountList = []
-        genesArrayList = []
-        geneIndexList = []
-
-        writen_element_id = 0
-        for cell_line in range(self.lines_cells):
-            first_gene = True
-            genesCountList.append(str(cell_line) + " " + str(np.sum(self.data[cell_line])) + "\n")
-            for gene_number in range(self.columns_genes):
-                transcripts_count = self.data[cell_line][gene_number]
-                if transcripts_count != 0:
-                    if first_gene:
-                        extend_with_u32(transcripts_gene_indices_btr, writen_element_id)
-                        first_gene = False
-                        geneIndexList.append(str(writen_element_id) + "\n")
-
-                    extend_with_u32(transcripts_gene_number_btr, transcripts_count)
-                    extend_with_u32(transcripts_gene_number_btr, gene_number)
-                    genesArrayList.append(str(transcripts_count) + " " + str(gene_number) + "\n")
-                    writen_element_id += 1
-
-            if first_gene:
-                extend_with_u32(transcripts_gene_indices_btr, writen_element_id)
-                geneIndexList.append(str(writen_element_id) + "\n")
-
-        return transcripts_gene_number_btr, transcripts_gene_indices_btr
+        return self._pack_compressed(self.data.tocsr())
 
     def generate_sparse_cell_expr_matrix_data(self):
         """
@@ -116,24 +126,13 @@ class GeneExprMatrix:
         2. Array of indices:
         |   0   |   1   |   3   |   4   |   5   |   6   |   8   |
         """
-        transcripts_cell_number_btr = bytearray()
-        transcripts_cell_indices_btr = bytearray()
-
-        writen_element_id = 0
-        for gene_column in range(self.columns_genes):
-            first_cell = True
-            for cell_line in range(self.lines_cells):
-                transcripts_count = self.data[cell_line][gene_column]
-                if transcripts_count != 0:
-                    if first_cell:
-                        transcripts_cell_indices_btr.extend(np.uint32(writen_element_id))
-                        first_cell = False
-
-                    transcripts_cell_number_btr.extend(np.uint32(transcripts_count))
-                    transcripts_cell_number_btr.extend(np.uint32(cell_line))
-                    writen_element_id += 1
-
-            if first_cell:
-                transcripts_cell_indices_btr.extend(np.uint32(writen_element_id))
-
-        return transcripts_cell_number_btr, transcripts_cell_indices_btr
+        columns = self.data.tocsc()
+        columns.sort_indices()
+        return self._pack_compressed(columns)
+
+    @staticmethod
+    def _pack_compressed(matrix) -> Tuple[bytearray, bytearray]:
+        # for a CSR matrix indptr gives the position of the first value of every cell (or the next cell's position
+        # if the cell is empty), for a CSC matrix the same holds for genes
+        values = np.stack([matrix.data.astype(np.uint32), matrix.indices.astype(np.uint32)], axis=1)
+        return bytearray(values.tobytes()), bytearray(matrix.indptr[:-1].astype(np.uint32).tobytes())
@@ -3,6 +3,7 @@ from argparse import ArgumentParser
 from dataclasses import dataclass
 from typing import Optional
 
+from vpt.utils.cellsreader.spatial_reader import ENTITY_ID_ORDER, FOV_ORDERS
 from vpt.utils.validate import validate_does_not_exist, validate_exists, validate_experimental
 
 # The maximum number of parallel processes that may be launched by update-vzg
@@ -23,6 +24,7 @@ class UpdateVzgArgs:
     second_entity_type: Optional[str]
     temp_path: str
     overwrite: bool
+    fov_order: str = ENTITY_ID_ORDER
 
 
 def validate_args(args: UpdateVzgArgs):
@@ -47,12 +49,17 @@ def validate_args(args: UpdateVzgArgs):
     if os.path.exists(args.temp_path) and not os.path.isdir(args.temp_path):
         raise ValueError("The path for the temporary files must specify the directory")
 
+    if args.fov_order not in FOV_ORDERS:
+        raise ValueError(f"Unknown FOV order {args.fov_order}, the supported orders are {', '.join(FOV_ORDERS)}")
+
 
 def initialize_experimental_args(args):
     experimental_args = ["second_boundaries", "second_entity_by_gene", "second_metadata", "second_entity_type"]
     for experimental_arg in experimental_args:
         if not hasattr(args, experimental_arg):
             setattr(args, experimental_arg, None)
+    if not hasattr(args, "fov_order"):
+        args.fov_order = ENTITY_ID_ORDER
     return args
 
 
@@ -75,7 +82,10 @@ def get_parser() -> ArgumentParser:
         "--input-boundaries", required=True, type=str, help="Path to a micron-space parquet boundary file."
     )
     required.add_argument(
-        "--input-entity-by-gene", required=True, type=str, help="Path to the Entity by gene csv file."
+        "--input-entity-by-gene",
+        required=True,
+        type=str,
+        help="Path to the Entity by gene csv, mtx, h5ad or parquet file.",
     )
     required.add_argument("--output-vzg", required=True, type=str, help="Path where the updated vzg should be saved.")
 
@@ -98,7 +108,7 @@ def get_parser() -> ArgumentParser:
             "--second-entity-by-gene",
             required=False,
             type=str,
-            help="Path to the Entity by gene csv file for additional boundaries.",
+            help="Path to the Entity by gene csv, mtx, h5ad or parquet file for additional boundaries.",
         )
         opt.add_argument(
             "--second-metadata",
@@ -119,6 +129,16 @@ def get_parser() -> ArgumentParser:
         default=os.path.join(os.getcwd(), "vzg_build_temp"),
         help="Path for temporary folder for unzipping vzg file.",
     )
+    opt.add_argument(
+        "--fov-order",
+        required=False,
+        type=str,
+        choices=FOV_ORDERS,
+        default=ENTITY_ID_ORDER,
+        help="Order of the Entities chunked into the batches processed in parallel: by EntityID, or along a "
+        "Hilbert or Z-order curve through the Entity centers for spatially compact batches. The spatial orders "
+        "read all the boundaries in every process. Default: entity_id.",
+    )
     opt.add_argument(
         "--overwrite",
         action="store_true",
@@ -2,6 +2,7 @@ import math
 from typing import Dict, List, Tuple, Optional
 
 import numpy as np
+import shapely
 from vpt_core import log
 
 from vpt.update_vzg.byte_utils import extend_with_u32, extend_with_i16, extend_with_i32
@@ -12,7 +13,7 @@ from vpt.update_vzg.polygons.packedpolygon import LodLevel
 from vpt.update_vzg.polygons.packedstarpolygon import PackedStarPolygon
 from vpt.update_vzg.polygons.polygonset import PolygonSet
 from vpt.utils.general_data import grid_size_calculate
-from vpt.utils.raw_cell import Feature
+from vpt.utils.raw_cell import EntitiesGeometry
 
 
 class CellTransfer:
@@ -26,25 +27,28 @@ class CellTransfer:
         self._gridSize = grid_size_calculate(self._textureSize, self._mtpMatrix)
         self.gridPolyCounts = self._gridSize[0] * self._gridSize[1]
 
-    def process_cells(self, rawCellsList: List[Feature], fovIdx: int) -> List[PolygonSet]:
+    def process_cells(self, entities: EntitiesGeometry, fovIdx: int) -> List[PolygonSet]:
         """Transfer points: thinning out, transformation to the new domain"""
+        # first polygon of every non-empty (Entity, z-plane) pair, in the order of the Entities and then z-planes
+        z_planes_count = entities.get_z_planes_count()
+        shapes = np.stack(entities.geometries, axis=1) if z_planes_count > 0 else np.empty((0, 0), dtype=object)
+        entity_idx, z_slices = np.nonzero(~(shapely.is_missing(shapes) | shapely.is_empty(shapes)))
+        polys = shapely.get_geometry(shapes[entity_idx, z_slices], 0)
+        centroids = shapely.centroid(polys)
+        x_centers, y_centers = shapely.get_x(centroids), shapely.get_y(centroids)
+
         polygonsList = []
-        for rawCell in rawCellsList:
-            for z_slice, zSlicePoly in enumerate(rawCell.shapes):
-                if zSlicePoly is None or zSlicePoly.is_empty:
-                    continue
-                poly = zSlicePoly.geoms[0]
-                rawId = rawCell.get_feature_id()
-                x_center, y_center = poly.centroid.x, poly.centroid.y
-
-                true_coords = np.column_stack(poly.exterior.coords.xy)
-                polygon = PolygonSet(z_slice, x_center, y_center, rawId)
-                poly_relevant_reduce = polygon.points_transform(
-                    true_coords, self._mtpMatrix, self._textureSize, self._gridSize, self._expBbox
-                )
+        for i, poly in enumerate(polys):
+            true_coords = shapely.get_coordinates(shapely.get_exterior_ring(poly))
+            polygon = PolygonSet(
+                int(z_slices[i]), float(x_centers[i]), float(y_centers[i]), str(entities.entity_ids[entity_idx[i]])
+            )
+            poly_relevant_reduce = polygon.points_transform(
+                true_coords, self._mtpMatrix, self._textureSize, self._gridSize, self._expBbox
+            )
 
-                if poly_relevant_reduce:
-                    polygonsList.append(polygon)
+            if poly_relevant_reduce:
+                polygonsList.append(polygon)
 
         log.info(f"Done fov {fovIdx}")
         return polygonsList
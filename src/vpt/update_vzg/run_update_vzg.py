@@ -20,12 +20,13 @@ from vpt.update_vzg.polygon_transfer import CellsTransfer, CellTransfer
 from vpt.update_vzg.polygons.packedpolygon import LodLevel
 from vpt.update_vzg.polygons.polygonset import PolygonSet
 from vpt.utils.cellsreader import CellsReader, cell_reader_factory
+from vpt.utils.cellsreader.spatial_reader import ENTITY_ID_ORDER
 from vpt.utils.general_data import write_file
 from vpt.utils.vzgrepacker import VzgRepacker
 
 
 def _process(args) -> Tuple[List[PolygonSet], int]:
-    cells_reader: CellsReader = cell_reader_factory(args.input_boundaries)
+    cells_reader: CellsReader = cell_reader_factory(args.input_boundaries, args.fov_order)
     fov_count = cells_reader.get_fovs_count()
     z_count = cells_reader.get_z_planes_count()
     image_params = load_image_parameters(args.data_folder)
@@ -47,6 +48,7 @@ def update_feature(
     input_entity_by_gene: str,
     image_params: ImageParams,
     feature_name: str,
+    fov_order: str = ENTITY_ID_ORDER,
 ):
     dataset_folder = vzg_repacker.get_dataset_folder()
     channels = vzg_repacker.get_manifest_channels()
@@ -73,6 +75,7 @@ def update_feature(
                     data_folder=dataset_folder,
                     task_index=i,
                     processes=num_processes,
+                    fov_order=fov_order,
                 ),
             )
             for i in range(num_processes)
@@ -157,7 +160,13 @@ def main_update_vzg(args):
     vzg_repacker.check_update_manifest_genes_info_array(image_params)
 
     update_feature(
-        vzg_repacker, args.input_metadata, args.input_boundaries, args.input_entity_by_gene, image_params, features[0]
+        vzg_repacker,
+        args.input_metadata,
+        args.input_boundaries,
+        args.input_entity_by_gene,
+        image_params,
+        features[0],
+        args.fov_order,
     )
     if args.second_boundaries:
         update_feature(
@@ -167,6 +176,7 @@ def main_update_vzg(args):
             args.second_entity_by_gene,
             image_params,
             features[1],
+            args.fov_order,
         )
 
     vzg_repacker.repack_vzg_file(os.path.splitext(args.output_vzg)[0])
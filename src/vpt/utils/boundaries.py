@@ -3,6 +3,7 @@ import warnings
 from shapely.errors import ShapelyDeprecationWarning
 
 from vpt.utils.cellsreader import CellsReader
+from vpt.utils.raw_cell import EntitiesGeometry
 
 
 class Boundaries:
@@ -13,8 +14,5 @@ class Boundaries:
     def get_z_planes_count(self) -> int:
         return self.cellsReader.get_z_planes_count()
 
-    @property
-    def features(self):
-        for fovIdx in range(self.cellsReader.get_fovs_count()):
-            for feature in self.cellsReader.read_fov(fovIdx):
-                yield feature
+    def get_entities_geometry(self) -> EntitiesGeometry:
+        return self.cellsReader.read_entities_geometry()
@@ -1,15 +1,19 @@
 from vpt.utils.cellsreader.base_reader import CellsReader
+from vpt.utils.cellsreader.spatial_reader import ENTITY_ID_ORDER, SpatialCellsReader
 
 
-def cell_reader_factory(pathToFile) -> CellsReader:
+def cell_reader_factory(pathToFile, fov_order: str = ENTITY_ID_ORDER) -> CellsReader:
     from vpt.utils.cellsreader.geo_reader import CellsGeoReader
     from vpt.utils.cellsreader.parquet_reader import CellsParquetReader
 
+    reader: CellsReader
     if pathToFile.endswith(".parquet"):
-        return CellsParquetReader(pathToFile)
+        reader = CellsParquetReader(pathToFile)
 
     elif pathToFile.endswith(".geojson"):
-        return CellsGeoReader(pathToFile)
+        reader = CellsGeoReader(pathToFile)
 
     else:
         raise ValueError("Input geometry has an unsupported file extension")
+
+    return reader if fov_order == ENTITY_ID_ORDER else SpatialCellsReader(reader, fov_order)
@@ -1,9 +1,7 @@
 from abc import ABC, abstractmethod
-from typing import List
-
 import numpy as np
 
-from vpt.utils.raw_cell import Feature
+from vpt.utils.raw_cell import EntitiesGeometry
 
 
 class CellsReader(ABC):
@@ -14,7 +12,11 @@ class CellsReader(ABC):
         pass
 
     @abstractmethod
-    def read_fov(self, fov: int) -> List[Feature]:
+    def read_fov(self, fov: int) -> EntitiesGeometry:
+        pass
+
+    @abstractmethod
+    def read_entities_geometry(self) -> EntitiesGeometry:
         pass
 
     @abstractmethod
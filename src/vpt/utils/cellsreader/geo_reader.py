@@ -1,12 +1,11 @@
 import math
-from typing import List
-
 import geopandas as gpd
 import numpy as np
+import pandas as pd
 from vpt_core.io.vzgfs import io_with_retries
 
 from vpt.utils.cellsreader.base_reader import CellsReader
-from vpt.utils.raw_cell import Feature
+from vpt.utils.raw_cell import EntitiesGeometry
 
 
 class CellsGeoReader(CellsReader):
@@ -21,21 +20,14 @@ class CellsGeoReader(CellsReader):
 
     def _initialize_with_data(self, data: gpd.GeoDataFrame):
         data = data.sort_values(by=["EntityID"])
-        self._data = data
-
-        poly_in_cell_count = list(data["EntityID"].value_counts().sort_index())
-
-        prev_fov_idx = 0
-        fov_start_idx = [prev_fov_idx]
-        i = 0
-        n = len(poly_in_cell_count)
-        while i < n:
-            prev_fov_idx += sum(poly_in_cell_count[i : min(n, i + self.CELLS_PER_FOV)])
-            fov_start_idx.append(prev_fov_idx)
-            i += self.CELLS_PER_FOV
 
-        self._fovs_start_idx = fov_start_idx
-        self._nameList = data["EntityID"].unique()
+        # columnar layout of the sorted polygons, the rows of the i-th Entity are [offsets[i], offsets[i + 1])
+        self._entity_ids = np.asarray(pd.to_numeric(data["EntityID"]), dtype=np.int64)
+        self._z_indexes = data["ZIndex"].to_numpy()
+        self._geometries = np.asarray(data["Geometry"], dtype=object)
+        is_entity_start = np.ones(len(data), dtype=bool)
+        is_entity_start[1:] = self._entity_ids[1:] != self._entity_ids[:-1]
+        self._entity_offsets = np.append(np.flatnonzero(is_entity_start), len(data))
 
         z_levels = data["ZLevel"].unique()
         z_levels.sort()
@@ -43,7 +35,7 @@ class CellsGeoReader(CellsReader):
 
         self._zPlanesCount = 0 if len(data["ZIndex"]) == 0 else data["ZIndex"].max() + 1
 
-        self._cells_count = len(self._nameList)
+        self._cells_count = len(self._entity_offsets) - 1
         self._fovs_count = int(math.ceil(self._cells_count / self.CELLS_PER_FOV))
 
     def get_z_depth_per_level(self) -> np.ndarray:
@@ -52,39 +44,30 @@ class CellsGeoReader(CellsReader):
     def get_fovs_count(self):
         return self._fovs_count
 
-    def read_fov(self, fov: int) -> List[Feature]:
-        raw_cells = []
-
-        cell_polys = [None] * self._zPlanesCount
-        prev_entity_idx = self._data.iloc[self._fovs_start_idx[fov]]["EntityID"]
-        for row_poly_idx in range(self._fovs_start_idx[fov], self._fovs_start_idx[fov + 1]):
-            row_poly = self._data.iloc[row_poly_idx]
-
-            entity_idx = row_poly["EntityID"]
-            if prev_entity_idx != entity_idx:
-                raw_cells.append(Feature(str(prev_entity_idx), cell_polys))
-                prev_entity_idx = entity_idx
-                cell_polys = [None] * self._zPlanesCount
-
-            poly_geometry = row_poly["Geometry"]
-            if poly_geometry is not None:
-                cell_polys[row_poly["ZIndex"]] = poly_geometry
-            continue
-
-        raw_cells.append(Feature(str(prev_entity_idx), cell_polys))  # last cell
-        return raw_cells
-
-    def read(self):
-        features = []
-
-        for fovIndex in range(self.get_fovs_count()):
-            features.extend(self.read_fov(fovIndex))
-
-        return features
+    def read_fov(self, fov: int) -> EntitiesGeometry:
+        first_cell = fov * self.CELLS_PER_FOV
+        start = self._entity_offsets[first_cell]
+        end = self._entity_offsets[min(first_cell + self.CELLS_PER_FOV, self._cells_count)]
+        return EntitiesGeometry.from_polygons(
+            self._entity_ids[start:end], self._z_indexes[start:end], self._geometries[start:end], self._zPlanesCount
+        )
+
+    def read_entities_geometry(self) -> EntitiesGeometry:
+        return EntitiesGeometry.from_polygons(
+            self._entity_ids,
+            self._z_indexes,
+            self._geometries,
+            self._zPlanesCount,
+        )
+
+    def read(self) -> EntitiesGeometry:
+        return EntitiesGeometry.concat(
+            [self.read_fov(fovIndex) for fovIndex in range(self.get_fovs_count())], self._zPlanesCount
+        )
 
     def get_z_planes_count(self) -> int:
         return self._zPlanesCount
 
     def _set_cells_per_fov(self, cells_per_fov: int):
         self.CELLS_PER_FOV = cells_per_fov
-        self._initialize_with_data(self._data)
+        self._fovs_count = int(math.ceil(self._cells_count / self.CELLS_PER_FOV))
@@ -1,14 +1,21 @@
 import io
-from typing import List
+from collections import OrderedDict
+from typing import List, Optional, Sequence
 
 import numpy as np
+import pandas as pd
+import shapely
 from pyarrow.parquet import ParquetFile
-from shapely import wkb
 from vpt_core.io.vzgfs import vzg_open, retrying_attempts
 from vpt_core.segmentation.seg_result import SegmentationResult
 
 from vpt.utils.cellsreader.base_reader import CellsReader
-from vpt.utils.raw_cell import Feature
+from vpt.utils.geoparquet import BBox, get_row_groups_in_bbox
+from vpt.utils.raw_cell import EntitiesGeometry
+
+
+# Number of row groups kept by the reader, sorted by EntityID and not decoded, while the FOVs are read in order
+ROW_GROUPS_CACHE_SIZE = 4
 
 
 class CellsParquetReader(CellsReader):
@@ -19,9 +26,16 @@ class CellsParquetReader(CellsReader):
     _fov_size: int
     _z_planes: np.ndarray
     _z_levels_diff: np.ndarray
+    _row_groups: List[int]
     _groups_start: List[int]
-
-    def __init__(self, data_path: str):
+    _row_groups_cache: "OrderedDict[int, pd.DataFrame]"
+
+    def __init__(self, data_path: str, bbox: Optional[BBox] = None):
+        """
+        With a bounding box (xmin, ymin, xmax, ymax) the FOVs and Entities are read only from the row groups whose
+        bbox statistics intersect it
+        """
+        self._row_groups_cache = OrderedDict()
         for attempt in retrying_attempts():
             with attempt:
                 self.fd = vzg_open(data_path, "rb")
@@ -31,17 +45,21 @@ class CellsParquetReader(CellsReader):
                 z_levels = np.unique(self.pq_data.read(columns=["ZLevel"]))
                 z_levels.sort()
                 self._z_levels_diff = np.diff(z_levels, prepend=0)
-        self._fov_size = self.CELLS_PER_FOV * self.get_z_planes_count()
-        self._fovs_count = 0 if self._fov_size == 0 else int(np.ceil(self.pq_data.metadata.num_rows / self._fov_size))
+        self._row_groups = list(range(self.pq_data.metadata.num_row_groups))
+        if bbox is not None:
+            self._row_groups = get_row_groups_in_bbox(self.pq_data.metadata, bbox)
 
         self._groups_start = [0]
-        for i in range(self.pq_data.metadata.num_row_groups):
+        for i in self._row_groups:
             self._groups_start.append(self._groups_start[-1] + self.pq_data.metadata.row_group(i).num_rows)
 
+        self._fov_size = self.CELLS_PER_FOV * self.get_z_planes_count()
+        self._fovs_count = 0 if self._fov_size == 0 else int(np.ceil(self._groups_start[-1] / self._fov_size))
+
     def get_fovs_count(self):
         return self._fovs_count
 
-    def read_fov(self, fov: int) -> List[Feature]:
+    def read_fov(self, fov: int) -> EntitiesGeometry:
         result = []
         start_row = self._fov_size * fov
         end_row = self._fov_size * (fov + 1)
@@ -49,39 +67,90 @@ class CellsParquetReader(CellsReader):
             if self._groups_start[i + 1] <= start_row or self._groups_start[i] >= end_row:
                 continue
             group_size = self._groups_start[i + 1] - self._groups_start[i]
-            result.extend(
+            result.append(
                 self.read_row_group_fov(
-                    i, max(0, start_row - self._groups_start[i]), min(group_size, end_row - self._groups_start[i])
+                    self._row_groups[i],
+                    max(0, start_row - self._groups_start[i]),
+                    min(group_size, end_row - self._groups_start[i]),
                 )
             )
 
-        return result
+        return EntitiesGeometry.concat(result, self.get_z_planes_count())
 
-    def read_row_group_fov(self, group_i, start, end) -> List[Feature]:
-        result = []
+    def _read_sorted_row_group(self, group_i: int) -> pd.DataFrame:
+        """Polygon rows of the row group sorted by EntityID, the geometries are kept as WKB"""
+        if group_i in self._row_groups_cache:
+            self._row_groups_cache.move_to_end(group_i)
+            return self._row_groups_cache[group_i]
+
+        columns = [
+            SegmentationResult.cell_id_field,
+            SegmentationResult.z_index_field,
+            SegmentationResult.geometry_field,
+        ]
         for attempt in retrying_attempts():
             with attempt:
-                group_data = self.pq_data.read_row_group(group_i).to_pandas()
+                group_data = self.pq_data.read_row_group(group_i, columns=columns).to_pandas()
         group_data = group_data.sort_values(by=[SegmentationResult.cell_id_field])
 
-        geometry_col = SegmentationResult.geometry_field
-        group_data[geometry_col] = group_data[geometry_col].apply(wkb.loads)
+        self._row_groups_cache[group_i] = group_data
+        if len(self._row_groups_cache) > ROW_GROUPS_CACHE_SIZE:
+            self._row_groups_cache.popitem(last=False)
+        return group_data
 
-        entity_id_col = group_data.columns.get_loc(SegmentationResult.cell_id_field)
+    def read_row_group_fov(self, group_i, start, end) -> EntitiesGeometry:
+        group_data = self._read_sorted_row_group(group_i)
+        entity_ids = group_data[SegmentationResult.cell_id_field].to_numpy()
 
         # shift fov's rows to the left until it contains whole cells at the edges
-        while start > 0 and group_data.iat[start - 1, entity_id_col] == group_data.iat[start, entity_id_col]:
+        while start > 0 and entity_ids[start - 1] == entity_ids[start]:
             start -= 1
         if end < len(group_data):
-            while end > start - 1 and group_data.iat[end - 1, entity_id_col] == group_data.iat[end, entity_id_col]:
+            while end > start - 1 and entity_ids[end - 1] == entity_ids[end]:
                 end -= 1
 
-        for cell_id, gdf in group_data[start:end].groupby(SegmentationResult.cell_id_field):
-            polys = [None] * self.get_z_planes_count()
-            for i in gdf.index:
-                polys[gdf[SegmentationResult.z_index_field][i]] = gdf[geometry_col][i]
-            result.append(Feature(str(cell_id), polys))
-        return result
+        # only the polygons of the fov are decoded
+        entity_ids = entity_ids[start:end]
+        z_indexes = group_data[SegmentationResult.z_index_field].to_numpy()[start:end]
+        polygons = shapely.from_wkb(group_data[SegmentationResult.geometry_field].to_numpy()[start:end])
+
+        return EntitiesGeometry.from_polygons(entity_ids, z_indexes, polygons, self.get_z_planes_count())
+
+    def get_row_groups_count(self) -> int:
+        return self.pq_data.metadata.num_row_groups
+
+    def read_row_group_entity_ids(self, group_i: int) -> np.ndarray:
+        for attempt in retrying_attempts():
+            with attempt:
+                group_data = self.pq_data.read_row_group(group_i, columns=[SegmentationResult.cell_id_field])
+        return group_data.column(SegmentationResult.cell_id_field).to_numpy()
+
+    def read_entities_geometry(self, row_groups: Optional[Sequence[int]] = None) -> EntitiesGeometry:
+        """Polygons of the Entities of all the row groups read by the reader, or of the listed row groups only"""
+        columns = [
+            SegmentationResult.cell_id_field,
+            SegmentationResult.z_index_field,
+            SegmentationResult.geometry_field,
+        ]
+        entity_ids, z_indexes, polygons = [], [], []
+        for group_i in self._row_groups if row_groups is None else row_groups:
+            for attempt in retrying_attempts():
+                with attempt:
+                    group_data = self.pq_data.read_row_group(group_i, columns=columns)
+
+            # polygons are decoded column-wise per row group, rows are ordered by EntityID as in read_fov
+            group_ids = group_data.column(SegmentationResult.cell_id_field).to_numpy()
+            order = np.argsort(group_ids, kind="stable")
+            entity_ids.append(group_ids[order])
+            z_indexes.append(group_data.column(SegmentationResult.z_index_field).to_numpy()[order])
+            wkb_data = group_data.column(SegmentationResult.geometry_field).to_numpy(zero_copy_only=False)
+            polygons.append(shapely.from_wkb(wkb_data[order]))
+
+        if not entity_ids:
+            return EntitiesGeometry(np.array([], dtype=np.int64), [])
+        return EntitiesGeometry.from_polygons(
+            np.concatenate(entity_ids), np.concatenate(z_indexes), np.concatenate(polygons), self.get_z_planes_count()
+        )
 
     def get_z_planes_count(self) -> int:
         return 0 if len(self._z_planes) == 0 else max(self._z_planes) + 1
@@ -92,7 +161,7 @@ class CellsParquetReader(CellsReader):
     def _set_cells_per_fov(self, cells_per_fov: int):
         self.CELLS_PER_FOV = cells_per_fov
         self._fov_size = self.CELLS_PER_FOV * self.get_z_planes_count()
-        self._fovs_count = int(np.ceil(self.pq_data.metadata.num_rows / self._fov_size))
+        self._fovs_count = int(np.ceil(self._groups_start[-1] / self._fov_size))
 
     def __del__(self):
         self.fd.close()
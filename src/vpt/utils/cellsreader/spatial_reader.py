@@ -0,0 +1,103 @@
+import numpy as np
+import shapely
+
+from vpt.utils.cellsreader.base_reader import CellsReader
+from vpt.utils.raw_cell import EntitiesGeometry
+
+# Orders of the Entities chunked into FOVs: by EntityID, or along a space-filling curve through their centers
+ENTITY_ID_ORDER = "entity_id"
+HILBERT_ORDER = "hilbert"
+Z_ORDER = "z_order"
+FOV_ORDERS = (ENTITY_ID_ORDER, HILBERT_ORDER, Z_ORDER)
+
+# Bits per axis of the grid the Entity centers are snapped to before the curve keys are computed
+CURVE_BITS = 16
+
+
+def hilbert_keys(x: np.ndarray, y: np.ndarray, bits: int = CURVE_BITS) -> np.ndarray:
+    """Distances along the Hilbert curve of the integer grid points (x, y), 0 <= x, y < 2**bits"""
+    x, y = np.array(x, dtype=np.int64), np.array(y, dtype=np.int64)
+    n = 1 << bits
+    keys = np.zeros(len(x), dtype=np.int64)
+    s = n >> 1
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        keys += s * s * ((3 * rx) ^ ry)
+        # rotate the quadrant so that the curve of the next level starts at its origin
+        flip = ~ry & rx
+        x[flip] = n - 1 - x[flip]
+        y[flip] = n - 1 - y[flip]
+        swap = ~ry
+        x[swap], y[swap] = y[swap], x[swap]
+        s >>= 1
+    return keys
+
+
+def z_order_keys(x: np.ndarray, y: np.ndarray, bits: int = CURVE_BITS) -> np.ndarray:
+    """Morton codes of the integer grid points (x, y), 0 <= x, y < 2**bits, with the x bit below the y bit"""
+    x, y = np.asarray(x, dtype=np.int64), np.asarray(y, dtype=np.int64)
+    keys = np.zeros(len(x), dtype=np.int64)
+    for bit in range(bits):
+        keys |= ((x >> bit) & 1) << (2 * bit)
+        keys |= ((y >> bit) & 1) << (2 * bit + 1)
+    return keys
+
+
+def get_entity_centers(entities: EntitiesGeometry) -> np.ndarray:
+    """Centers of the bounding boxes of the Entity polygons on all z-planes, NaN for Entities without polygons"""
+    bounds = np.full((entities.get_entities_count(), 4), np.nan)
+    for geometries in entities.geometries:
+        z_bounds = shapely.bounds(geometries)
+        bounds[:, :2] = np.fmin(bounds[:, :2], z_bounds[:, :2])
+        bounds[:, 2:] = np.fmax(bounds[:, 2:], z_bounds[:, 2:])
+    return (bounds[:, :2] + bounds[:, 2:]) / 2
+
+
+def get_spatial_order(centers: np.ndarray, fov_order: str, bits: int = CURVE_BITS) -> np.ndarray:
+    """Positions of the centers sorted along the curve, the points with a NaN coordinate are placed last"""
+    is_valid = ~np.isnan(centers).any(axis=1)
+    valid = centers[is_valid]
+    grid = np.zeros(valid.shape, dtype=np.int64)
+    if len(valid) > 0:
+        low, high = valid.min(axis=0), valid.max(axis=0)
+        scale = ((1 << bits) - 1) / np.where(high > low, high - low, 1)
+        grid = np.floor((valid - low) * scale).astype(np.int64)
+    curve_keys = hilbert_keys if fov_order == HILBERT_ORDER else z_order_keys
+    keys = np.full(len(centers), np.iinfo(np.int64).max)
+    keys[is_valid] = curve_keys(grid[:, 0], grid[:, 1], bits)
+    return np.argsort(keys, kind="stable")
+
+
+class SpatialCellsReader(CellsReader):
+    """
+    Reader that chunks the Entities of another reader into spatially compact FOVs along a space-filling curve.
+    All the Entities are read once on creation.
+    """
+
+    def __init__(self, reader: CellsReader, fov_order: str = HILBERT_ORDER):
+        if fov_order not in (HILBERT_ORDER, Z_ORDER):
+            raise ValueError(f"Unknown spatial FOV order {fov_order}, use {HILBERT_ORDER} or {Z_ORDER}")
+        self._reader = reader
+        self._entities = reader.read_entities_geometry()
+        self._order = get_spatial_order(get_entity_centers(self._entities), fov_order)
+        self._set_cells_per_fov(self.CELLS_PER_FOV)
+
+    def get_fovs_count(self):
+        return self._fovs_count
+
+    def read_fov(self, fov: int) -> EntitiesGeometry:
+        return self._entities.take(self._order[fov * self.CELLS_PER_FOV : (fov + 1) * self.CELLS_PER_FOV])
+
+    def read_entities_geometry(self) -> EntitiesGeometry:
+        return self._entities
+
+    def get_z_planes_count(self) -> int:
+        return self._reader.get_z_planes_count()
+
+    def get_z_depth_per_level(self) -> np.ndarray:
+        return self._reader.get_z_depth_per_level()
+
+    def _set_cells_per_fov(self, cells_per_fov: int):
+        self.CELLS_PER_FOV = cells_per_fov
+        self._fovs_count = int(np.ceil(self._entities.get_entities_count() / self.CELLS_PER_FOV))
@@ -0,0 +1,206 @@
+import json
+import os
+import shutil
+import tempfile
+from dataclasses import dataclass
+from typing import List, Sequence, Union
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import scipy.io
+from pyarrow import parquet
+from scipy import sparse
+from vpt_core.io.vzgfs import io_with_retries
+
+CSV_READ_CHUNK_SIZE = 100000
+CSV_WRITE_CHUNK_SIZE = 10000
+PARQUET_GENES_KEY = b"genes"
+
+
+@dataclass
+class EntityByGeneMatrix:
+    """Entity by gene counts kept as a sparse matrix with EntityIDs for rows and gene names for columns"""
+
+    matrix: sparse.csr_matrix
+    entity_ids: np.ndarray
+    genes: List[str]
+
+    def get_entities_count(self) -> int:
+        return self.matrix.shape[0]
+
+    def get_entity_sums(self) -> np.ndarray:
+        return np.asarray(self.matrix.sum(axis=1)).ravel()
+
+    def get_entity_genes_count(self) -> np.ndarray:
+        """Number of genes with non-zero counts for every Entity"""
+        return np.asarray((self.matrix != 0).sum(axis=1)).ravel()
+
+    def get_gene_sums(self) -> pd.Series:
+        return pd.Series(np.asarray(self.matrix.sum(axis=0)).ravel(), index=self.genes)
+
+    def select_entities(self, rows: Union[np.ndarray, slice]) -> "EntityByGeneMatrix":
+        return EntityByGeneMatrix(self.matrix[rows], self.entity_ids[rows], self.genes)
+
+    def sort_by_entity(self) -> "EntityByGeneMatrix":
+        return self.select_entities(np.argsort(self.entity_ids, kind="stable"))
+
+    def reindex_genes(self, genes: Sequence[str]) -> "EntityByGeneMatrix":
+        """Reorders the columns as genes, the genes that are missing in the matrix get zero counts"""
+        columns = {gene: i for i, gene in enumerate(self.genes)}
+        selection = sparse.lil_matrix((len(self.genes), len(genes)), dtype=self.matrix.dtype)
+        for i, gene in enumerate(genes):
+            if gene in columns:
+                selection[columns[gene], i] = 1
+        return EntityByGeneMatrix((self.matrix @ selection.tocsr()).tocsr(), self.entity_ids, list(genes))
+
+    def to_dataframe(self, dense: bool = True) -> pd.DataFrame:
+        if dense:
+            result = pd.DataFrame(self.matrix.toarray(), index=self.entity_ids, columns=self.genes)
+        else:
+            result = pd.DataFrame.sparse.from_spmatrix(self.matrix, index=self.entity_ids, columns=self.genes)
+        result.index.name = "cell"
+        return result
+
+
+def _get_format(path: str) -> str:
+    extension = os.path.splitext(path.lower())[1]
+    return extension if extension in (".mtx", ".h5ad", ".parquet") else ".csv"
+
+
+def _mtx_labels_path(path: str, labels: str) -> str:
+    return f"{path[: -len('.mtx')]}_{labels}.csv"
+
+
+def get_entity_by_gene_paths(path: str) -> List[str]:
+    """All the files that make up an Entity by gene matrix saved at path"""
+    if _get_format(path) == ".mtx":
+        return [path, _mtx_labels_path(path, "entities"), _mtx_labels_path(path, "genes")]
+    return [path]
+
+
+def _write_csv(path: str, entity_by_gene: EntityByGeneMatrix) -> None:
+    def write(f):
+        # the matrix is densified by blocks of rows, the output is the same as DataFrame.to_csv of the whole matrix
+        for start in range(0, max(len(entity_by_gene.entity_ids), 1), CSV_WRITE_CHUNK_SIZE):
+            rows = slice(start, start + CSV_WRITE_CHUNK_SIZE)
+            entity_by_gene.select_entities(rows).to_dataframe().to_csv(f, header=start == 0)
+
+    io_with_retries(path, "w", write)
+
+
+def _write_mtx(path: str, entity_by_gene: EntityByGeneMatrix) -> None:
+    io_with_retries(path, "wb", lambda f: scipy.io.mmwrite(f, entity_by_gene.matrix, symmetry="general"))
+    entities = pd.DataFrame({"cell": entity_by_gene.entity_ids})
+    io_with_retries(_mtx_labels_path(path, "entities"), "w", lambda f: entities.to_csv(f, index=False))
+    genes = pd.DataFrame({"gene": entity_by_gene.genes})
+    io_with_retries(_mtx_labels_path(path, "genes"), "w", lambda f: genes.to_csv(f, index=False))
+
+
+def _write_h5ad(path: str, entity_by_gene: EntityByGeneMatrix) -> None:
+    import anndata
+
+    adata = anndata.AnnData(
+        X=entity_by_gene.matrix,
+        obs=pd.DataFrame(index=pd.Index(entity_by_gene.entity_ids.astype(str), name="cell")),
+        var=pd.DataFrame(index=pd.Index(entity_by_gene.genes, name="gene")),
+    )
+    # h5ad files can only be created on the local file system
+    with tempfile.TemporaryDirectory() as temp_dir:
+        local_path = os.path.join(temp_dir, "entity_by_gene.h5ad")
+        adata.write_h5ad(local_path)
+        with open(local_path, "rb") as src:
+            io_with_retries(path, "wb", lambda f: shutil.copyfileobj(src, f))
+
+
+def _write_parquet(path: str, entity_by_gene: EntityByGeneMatrix) -> None:
+    coo = entity_by_gene.matrix.tocoo()
+    rows, columns, counts = coo.row, coo.col, coo.data
+
+    # Entities without transcripts are kept as explicit zeros, so that the matrix keeps all its rows
+    empty_rows = np.flatnonzero(np.diff(entity_by_gene.matrix.indptr) == 0)
+    if len(empty_rows) > 0 and len(entity_by_gene.genes) > 0:
+        rows = np.concatenate([rows, empty_rows])
+        columns = np.concatenate([columns, np.zeros(len(empty_rows), dtype=columns.dtype)])
+        counts = np.concatenate([counts, np.zeros(len(empty_rows), dtype=counts.dtype)])
+        order = np.lexsort((columns, rows))
+        rows, columns, counts = rows[order], columns[order], counts[order]
+
+    genes = np.array(entity_by_gene.genes, dtype=object)
+    table = pa.table(
+        {
+            "cell": pa.array(entity_by_gene.entity_ids[rows], type=pa.int64()),
+            "gene": pa.DictionaryArray.from_arrays(pa.array(columns, type=pa.int32()), pa.array(genes, pa.string())),
+            "count": pa.array(counts),
+        }
+    )
+    table = table.replace_schema_metadata({PARQUET_GENES_KEY: json.dumps(entity_by_gene.genes)})
+    io_with_retries(path, "wb", lambda f: parquet.write_table(table, f))
+
+
+def write_entity_by_gene(path: str, entity_by_gene: EntityByGeneMatrix) -> None:
+    """
+    Saves the Entity by gene matrix in the format defined by the file extension: Matrix Market (.mtx, with the
+    EntityIDs and genes in _entities.csv and _genes.csv files next to it), AnnData (.h5ad), COO parquet (.parquet)
+    or dense csv otherwise
+    """
+    writers = {".mtx": _write_mtx, ".h5ad": _write_h5ad, ".parquet": _write_parquet, ".csv": _write_csv}
+    writers[_get_format(path)](path, entity_by_gene)
+
+
+def _read_csv(path: str) -> EntityByGeneMatrix:
+    def read(f):
+        blocks, entity_ids, genes = [], [], []
+        for chunk in pd.read_csv(f, index_col=0, chunksize=CSV_READ_CHUNK_SIZE):
+            blocks.append(sparse.csr_matrix(chunk.to_numpy()))
+            entity_ids.append(chunk.index.to_numpy())
+            genes = list(chunk.columns)
+        return blocks, entity_ids, genes
+
+    blocks, entity_ids, genes = io_with_retries(path, "r", read)
+    if not blocks:
+        genes = io_with_retries(path, "r", lambda f: list(pd.read_csv(f, index_col=0).columns))
+        return EntityByGeneMatrix(sparse.csr_matrix((0, len(genes)), dtype=np.int64), np.array([], np.int64), genes)
+    return EntityByGeneMatrix(sparse.vstack(blocks, format="csr"), np.concatenate(entity_ids), genes)
+
+
+def _read_mtx(path: str) -> EntityByGeneMatrix:
+    matrix = io_with_retries(path, "rb", scipy.io.mmread)
+    entities = io_with_retries(_mtx_labels_path(path, "entities"), "r", pd.read_csv)
+    genes = io_with_retries(_mtx_labels_path(path, "genes"), "r", lambda f: pd.read_csv(f, dtype={"gene": str}))
+    return EntityByGeneMatrix(sparse.csr_matrix(matrix), entities["cell"].to_numpy(), list(genes["gene"]))
+
+
+def _read_h5ad(path: str) -> EntityByGeneMatrix:
+    import anndata
+
+    adata = io_with_retries(path, "rb", anndata.read_h5ad)
+    entity_ids = np.asarray(pd.to_numeric(adata.obs_names), dtype=np.int64)
+    return EntityByGeneMatrix(sparse.csr_matrix(adata.X), entity_ids, list(adata.var_names))
+
+
+def _read_parquet(path: str) -> EntityByGeneMatrix:
+    def read(f):
+        parquet_file = parquet.ParquetFile(f)
+        return parquet_file.read(), json.loads(parquet_file.schema_arrow.metadata[PARQUET_GENES_KEY])
+
+    table, genes = io_with_retries(path, "rb", read)
+    rows, entity_ids = pd.factorize(table.column("cell").to_numpy())
+    columns = {gene: i for i, gene in enumerate(genes)}
+    gene_column = table.column("gene").combine_chunks()
+    if pa.types.is_dictionary(gene_column.type):
+        dictionary_columns = np.array([columns[gene] for gene in gene_column.dictionary.to_pylist()], dtype=np.int64)
+        gene_idx = dictionary_columns[gene_column.indices.to_numpy(zero_copy_only=False)]
+    else:
+        gene_idx = np.array([columns[gene] for gene in gene_column.to_pylist()], dtype=np.int64)
+
+    matrix = sparse.csr_matrix(
+        (table.column("count").to_numpy(), (rows, gene_idx)), shape=(len(entity_ids), len(genes))
+    )
+    return EntityByGeneMatrix(matrix, np.asarray(entity_ids), genes)
+
+
+def read_entity_by_gene(path: str) -> EntityByGeneMatrix:
+    """Reads an Entity by gene matrix saved by write_entity_by_gene without densifying it"""
+    readers = {".mtx": _read_mtx, ".h5ad": _read_h5ad, ".parquet": _read_parquet, ".csv": _read_csv}
+    return readers[_get_format(path)](path)
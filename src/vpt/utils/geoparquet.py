@@ -0,0 +1,143 @@
+import json
+from typing import List, Optional, Tuple
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow
+import pyarrow.parquet as pq
+import shapely
+from vpt_core.io.vzgfs import io_with_retries
+from vpt_core.segmentation.seg_result import SegmentationResult
+
+from vpt.utils.cellsreader.spatial_reader import HILBERT_ORDER, get_spatial_order
+
+# Per-row bounding box struct column, declared as the GeoParquet 1.1 bbox covering of the geometry column
+BBOX_COLUMN = "bbox"
+BBOX_FIELDS = ("xmin", "ymin", "xmax", "ymax")
+GEOPARQUET_VERSION = "1.1.0"
+
+BBox = Tuple[float, float, float, float]
+
+
+def get_spatial_row_groups(gdf: gpd.GeoDataFrame, max_row_group_size: int) -> Tuple[np.ndarray, List[int]]:
+    """
+    Row positions with the Entities sorted along a Hilbert curve through the centers of their bounding boxes, and
+    the sizes of the row groups. A row group keeps all the polygons of its Entities and has at most
+    max_row_group_size rows, unless a single Entity has more polygons.
+    """
+    codes, _ = pd.factorize(gdf[SegmentationResult.cell_id_field])
+    bounds = pd.DataFrame(shapely.bounds(np.asarray(gdf.geometry.values, dtype=object)), columns=BBOX_FIELDS)
+    entity_bounds = bounds.groupby(codes).agg({"xmin": "min", "ymin": "min", "xmax": "max", "ymax": "max"})
+    centers = (entity_bounds[["xmin", "ymin"]].to_numpy() + entity_bounds[["xmax", "ymax"]].to_numpy()) / 2
+    entity_order = get_spatial_order(centers, HILBERT_ORDER)
+
+    entity_rank = np.empty(len(entity_order), dtype=np.int64)
+    entity_rank[entity_order] = np.arange(len(entity_order))
+    rows = np.argsort(entity_rank[codes], kind="stable")
+
+    group_sizes = []
+    current_size = 0
+    for entity_size in np.bincount(codes, minlength=len(entity_order))[entity_order]:
+        if current_size > 0 and current_size + entity_size > max_row_group_size:
+            group_sizes.append(current_size)
+            current_size = 0
+        current_size += int(entity_size)
+    if current_size > 0:
+        group_sizes.append(current_size)
+    return rows, group_sizes
+
+
+def without_bbox_column(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    """The boundaries without the bbox covering column, which is not valid after the geometries are changed"""
+    return gdf.drop(columns=[BBOX_COLUMN], errors="ignore")
+
+
+def get_geo_metadata(gdf: gpd.GeoDataFrame) -> dict:
+    """GeoParquet metadata of the WKB encoded geometry column with the bbox covering"""
+    geometry = gdf.geometry
+    column = {
+        "encoding": "WKB",
+        "crs": None if geometry.crs is None else geometry.crs.to_json_dict(),
+        "geometry_types": sorted(pd.Series(geometry.geom_type.unique()).dropna()),
+        "covering": {"bbox": {field: [BBOX_COLUMN, field] for field in BBOX_FIELDS}},
+    }
+    bbox = geometry.total_bounds.tolist()
+    if np.isfinite(bbox).all():
+        column["bbox"] = bbox
+    return {"primary_column": geometry.name, "columns": {geometry.name: column}, "version": GEOPARQUET_VERSION}
+
+
+def to_arrow_with_bbox(gdf: gpd.GeoDataFrame) -> pyarrow.Table:
+    """Arrow table of the boundaries with the bbox covering column and its GeoParquet metadata"""
+    geometries = np.asarray(gdf.geometry.values, dtype=object)
+    df = pd.DataFrame(without_bbox_column(gdf))
+    df[gdf.geometry.name] = shapely.to_wkb(geometries)
+    table = pyarrow.Table.from_pandas(df, preserve_index=False)
+
+    bounds = shapely.bounds(geometries)
+    bbox = pyarrow.StructArray.from_arrays(
+        [pyarrow.array(bounds[:, i], mask=np.isnan(bounds[:, i])) for i in range(len(BBOX_FIELDS))],
+        names=list(BBOX_FIELDS),
+    )
+    table = table.append_column(BBOX_COLUMN, bbox)
+    geo_metadata = json.dumps(get_geo_metadata(gdf)).encode("utf-8")
+    return table.replace_schema_metadata({**table.schema.metadata, b"geo": geo_metadata})
+
+
+def save_spatial_segmentation_results(gdf: gpd.GeoDataFrame, path: str, max_row_group_size: int) -> None:
+    """Saves the boundaries to parquet in spatially sorted row groups with the bbox covering column"""
+    gdf = without_bbox_column(gdf)
+    rows, group_sizes = get_spatial_row_groups(gdf, max_row_group_size)
+    table = to_arrow_with_bbox(gdf.iloc[rows])
+
+    def write(f) -> None:
+        with pq.ParquetWriter(f, table.schema) as writer:
+            for start, size in zip(np.cumsum([0] + group_sizes[:-1]), group_sizes):
+                writer.write_table(table.slice(start, size))
+
+    io_with_retries(path, "wb", write)
+
+
+def get_bbox_covering_paths(metadata: pq.FileMetaData) -> Optional[List[str]]:
+    """
+    Column paths of the xmin, ymin, xmax and ymax bbox fields declared as the covering of the primary geometry
+    column, None if the file has no bbox covering
+    """
+    if metadata.metadata is None or b"geo" not in metadata.metadata:
+        return None
+    geo_metadata = json.loads(metadata.metadata[b"geo"])
+    column = geo_metadata.get("columns", {}).get(geo_metadata.get("primary_column"), {})
+    covering = column.get("covering", {}).get("bbox")
+    if not covering or not all(field in covering for field in BBOX_FIELDS):
+        return None
+    return [".".join(covering[field]) for field in BBOX_FIELDS]
+
+
+def get_row_groups_in_bbox(metadata: pq.FileMetaData, bbox: BBox) -> List[int]:
+    """
+    Row groups whose bbox covering statistics intersect the bounding box (xmin, ymin, xmax, ymax). All the row groups
+    are returned for files without the bbox covering.
+    """
+    column_index = {metadata.schema.column(i).path: i for i in range(metadata.num_columns)}
+    paths = get_bbox_covering_paths(metadata)
+    if paths is None or not all(path in column_index for path in paths):
+        return list(range(metadata.num_row_groups))
+
+    xmin, ymin, xmax, ymax = bbox
+    result = []
+    for group_i in range(metadata.num_row_groups):
+        row_group = metadata.row_group(group_i)
+        stats = [row_group.column(column_index[path]).statistics for path in paths]
+        if any(s is None or not s.has_min_max for s in stats):
+            result.append(group_i)
+        elif stats[0].min <= xmax and stats[2].max >= xmin and stats[1].min <= ymax and stats[3].max >= ymin:
+            result.append(group_i)
+    return result
+
+
+def get_bbox_mask(geometries: np.ndarray, bbox: BBox) -> np.ndarray:
+    """Geometries whose bounding boxes intersect the bounding box"""
+    bounds = shapely.bounds(geometries)
+    xmin, ymin, xmax, ymax = bbox
+    return (bounds[:, 0] <= xmax) & (bounds[:, 2] >= xmin) & (bounds[:, 1] <= ymax) & (bounds[:, 3] >= ymin)
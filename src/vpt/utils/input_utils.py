@@ -1,6 +1,9 @@
-from typing import List
+import io
+from typing import IO, Iterator, List, Optional, Union
 
 import geopandas as gpd
+import numpy as np
+import pandas as pd
 from pyarrow import parquet
 from shapely import wkb
 
@@ -8,8 +11,11 @@ from vpt_core.io.input_tools import read_parquet
 from vpt_core.io.vzgfs import filesystem_path_split, vzg_open, retrying_attempts, io_with_retries
 from vpt_core.segmentation.seg_result import SegmentationResult
 
+from vpt.utils.geoparquet import BBox, get_bbox_mask, get_row_groups_in_bbox
 from vpt.utils.validate import validate_micron_to_mosaic_transform
 
+CSV_SKIP_BLOCK_SIZE = 1 << 24
+
 
 def read_micron_to_mosaic_transform(path: str) -> List[List[float]]:
     lines = io_with_retries(path, "r", lambda f: f.readlines())
@@ -24,14 +30,21 @@ def read_micron_to_mosaic_transform(path: str) -> List[List[float]]:
     return transform
 
 
-def read_parquet_by_groups(path: str):
+def read_parquet_by_groups(path: str, bbox: Optional[BBox] = None):
+    """
+    Boundaries by row groups. With a bounding box (xmin, ymin, xmax, ymax) only the row groups whose bbox statistics
+    intersect it are read, and only the polygons whose bounding boxes intersect it are kept.
+    """
     geom_field = SegmentationResult.geometry_field
     for attempt in retrying_attempts():
         with attempt, vzg_open(path, "rb") as f:
             pq = parquet.ParquetFile(f)
-            for i in range(pq.num_row_groups):
+            row_groups = range(pq.num_row_groups) if bbox is None else get_row_groups_in_bbox(pq.metadata, bbox)
+            for i in row_groups:
                 df = gpd.GeoDataFrame(pq.read_row_group(i).to_pandas())
                 df[geom_field] = df[geom_field].apply(wkb.loads)
+                if bbox is not None:
+                    df = df[get_bbox_mask(np.asarray(df[geom_field], dtype=object), bbox)]
                 yield df
 
 
@@ -48,5 +61,94 @@ def read_geodataframe(path: str):
 
 
 def read_segmentation_entity_types(path: str):
-    gdf = read_parquet(path)
-    return "_".join(gdf[SegmentationResult.entity_name_field].unique())
+    field = SegmentationResult.entity_name_field
+    if is_parquet_path(path):
+        types = io_with_retries(path, "rb", lambda f: parquet.read_table(f, columns=[field]).to_pandas()[field])
+    else:
+        types = read_geodataframe(path)[field]
+    return "_".join(types.unique())
+
+
+def as_paths_list(paths: Union[str, List[str]]) -> List[str]:
+    return [paths] if isinstance(paths, str) else list(paths)
+
+
+def is_parquet_path(path: str) -> bool:
+    return path.lower().endswith(".parquet")
+
+
+def read_transcripts_columns(path: str) -> List[str]:
+    if is_parquet_path(path):
+        return io_with_retries(path, "rb", lambda f: parquet.ParquetFile(f).schema_arrow.names)
+    return io_with_retries(path, "r", lambda f: f.readline().replace("\n", "").split(","))
+
+
+def _read_parquet_from_row(
+    f: IO, chunk_size: int, columns: Optional[List[str]], skip_rows: int
+) -> Iterator[pd.DataFrame]:
+    pq = parquet.ParquetFile(f)
+    # the reading starts from the row group that contains the first row to read
+    first_group, group_start = 0, 0
+    while first_group < pq.num_row_groups and group_start + pq.metadata.row_group(first_group).num_rows <= skip_rows:
+        group_start += pq.metadata.row_group(first_group).num_rows
+        first_group += 1
+
+    to_skip = skip_rows - group_start
+    row_groups = range(first_group, pq.num_row_groups)
+    for batch in pq.iter_batches(batch_size=chunk_size, columns=columns, row_groups=row_groups):
+        if to_skip >= len(batch):
+            to_skip -= len(batch)
+            continue
+        yield batch.slice(to_skip).to_pandas()
+        to_skip = 0
+
+
+def _read_csv_from_row(f: IO, chunk_size: int, columns: Optional[List[str]], skip_rows: int) -> Iterator[pd.DataFrame]:
+    header = f.readline()
+    names = pd.read_csv(io.BytesIO(header), nrows=0).columns
+
+    # the skipped lines are only counted, not parsed, then the reading continues from the first line to read
+    remaining = skip_rows
+    while remaining > 0:
+        position = f.tell()
+        block = f.read(CSV_SKIP_BLOCK_SIZE)
+        if not block:
+            return
+        newlines = block.count(b"\n")
+        if newlines < remaining:
+            remaining -= newlines
+            continue
+        offset = -1
+        for _ in range(remaining):
+            offset = block.index(b"\n", offset + 1)
+        f.seek(position + offset + 1)
+        remaining = 0
+
+    yield from pd.read_csv(f, chunksize=chunk_size, header=None, names=names, usecols=columns)
+
+
+def read_transcripts_by_chunks(
+    path: str, chunk_size: int, columns: Optional[List[str]] = None, skip_rows: int = 0
+) -> Iterator[pd.DataFrame]:
+    """
+    Reads a detected transcripts csv or parquet file by chunks of chunk_size rows. If columns are specified,
+    only those columns are parsed. The first skip_rows rows are skipped without being parsed. A retried read
+    continues after the last yielded row, the chunks that were already yielded are not repeated.
+    """
+    for attempt in retrying_attempts():
+        with attempt, vzg_open(path, "rb" if is_parquet_path(path) or skip_rows > 0 else "r") as f:
+            if is_parquet_path(path):
+                chunks = _read_parquet_from_row(f, chunk_size, columns, skip_rows)
+            elif skip_rows > 0:
+                chunks = _read_csv_from_row(f, chunk_size, columns, skip_rows)
+            else:
+                chunks = pd.read_csv(f, chunksize=chunk_size, usecols=columns)
+            for chunk_df in chunks:
+                skip_rows += len(chunk_df)
+                yield chunk_df
+
+
+def read_transcripts(path: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+    if is_parquet_path(path):
+        return io_with_retries(path, "rb", lambda f: parquet.ParquetFile(f).read(columns=columns).to_pandas())
+    return io_with_retries(path, "r", lambda f: pd.read_csv(f, usecols=columns))
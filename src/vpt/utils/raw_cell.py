@@ -1,33 +1,66 @@
-from typing import List, Optional
+from dataclasses import dataclass
+from typing import List, Sequence
 
-from shapely import geometry
+import numpy as np
+import pandas as pd
 
 
-class Feature:
-    def __init__(self, rawCellId: str, rawPolysGeometryList: List[geometry.shape]):
-        self.shapes: List[Optional[geometry.shape]] = rawPolysGeometryList
-        self.id = rawCellId
+@dataclass
+class EntitiesGeometry:
+    """
+    Polygons of the Entities stored by z-plane: geometries[z][i] is the polygon of the Entity entity_ids[i] on the
+    z-plane z, or None if the Entity has no polygon there
+    """
 
-    def get_feature_id(self):
-        return self.id
+    entity_ids: np.ndarray
+    geometries: List[np.ndarray]
 
-    def get_boundaries(self, zPlane: int = 0):
-        return self.shapes[zPlane]
+    def get_entities_count(self) -> int:
+        return len(self.entity_ids)
 
-    def get_true_polygons(self):
-        return list(filter(lambda shape: shape is not None, self.shapes))
-
-    def get_full_cell(self) -> List:
-        """Add empty polygon on z planes without polygons"""
-        output = []
-        for shape in self.shapes:
-            if shape is not None:
-                output.append(shape)
-            else:
-                output.append(geometry.Polygon(((0, 0), (0, 0), (0, 0))))
-        return output
+    def get_z_planes_count(self) -> int:
+        return len(self.geometries)
 
     def __eq__(self, other):
-        if isinstance(other, Feature):
-            return other.id == self.id and other.shapes == self.shapes
+        if isinstance(other, EntitiesGeometry):
+            return (
+                np.array_equal(self.entity_ids, other.entity_ids)
+                and len(self.geometries) == len(other.geometries)
+                and all(np.array_equal(a, b) for a, b in zip(self.geometries, other.geometries))
+            )
         return False
+
+    def select(self, entity_ids: np.ndarray) -> "EntitiesGeometry":
+        """Entities with the given ids, in the order of the ids"""
+        idx = pd.Index(self.entity_ids).get_indexer(entity_ids)
+        if (idx < 0).any():
+            raise KeyError(f"Entities {np.asarray(entity_ids)[idx < 0][:10].tolist()} are not found")
+        return self.take(idx)
+
+    def take(self, indexes: np.ndarray) -> "EntitiesGeometry":
+        """Entities at the given positions, in the order of the positions"""
+        return EntitiesGeometry(self.entity_ids[indexes], [geometries[indexes] for geometries in self.geometries])
+
+    @staticmethod
+    def concat(items: Sequence["EntitiesGeometry"], z_planes_count: int) -> "EntitiesGeometry":
+        """Entities of all the items, in the order of the items"""
+        if not items:
+            return EntitiesGeometry(np.empty(0, dtype=np.int64), [np.empty(0, dtype=object)] * z_planes_count)
+        return EntitiesGeometry(
+            np.concatenate([item.entity_ids for item in items]),
+            [np.concatenate([item.geometries[z] for item in items]) for z in range(z_planes_count)],
+        )
+
+    @staticmethod
+    def from_polygons(
+        entity_ids: np.ndarray, z_indexes: np.ndarray, polygons: np.ndarray, z_planes_count: int
+    ) -> "EntitiesGeometry":
+        """Groups the polygon rows by Entity, the Entities keep the order of their first appearance"""
+        codes, unique_ids = pd.factorize(entity_ids)
+        geometries = []
+        for z in range(z_planes_count):
+            z_geometries = np.full(len(unique_ids), None, dtype=object)
+            rows = np.flatnonzero(z_indexes == z)
+            z_geometries[codes[rows]] = polygons[rows]
+            geometries.append(z_geometries)
+        return EntitiesGeometry(np.asarray(unique_ids, dtype=np.int64), geometries)
@@ -0,0 +1,26 @@
+import tempfile
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from vpt_core.io.vzgfs import filesystem_path_split
+
+
+@contextmanager
+def temp_directory(temp_path: Optional[str], name: str) -> Iterator[str]:
+    """
+    Directory for the temporary files of a command, removed on exit. It is created as the name subdirectory of
+    temp_path, which may be on any supported filesystem, or as a local temporary directory if temp_path is None.
+    """
+    if temp_path is None:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            yield temp_dir
+        return
+
+    fs, path = filesystem_path_split(temp_path)
+    temp_dir = f"{temp_path.rstrip(fs.sep)}{fs.sep}{name}"
+    path = fs.sep.join([path.rstrip(fs.sep), name])
+    fs.mkdirs(path, exist_ok=True)
+    try:
+        yield temp_dir
+    finally:
+        fs.rm(path, recursive=True)
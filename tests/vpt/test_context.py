@@ -47,3 +47,32 @@ def test_log() -> None:
     text = test_file.read_text()
     for x in test_strings:
         assert x in text
+
+
+def test_pipeline_run() -> None:
+    def proc(x, shift):
+        return x + shift
+
+    for workers in [1, 3]:
+        with Context(dask_args={"workers": workers}) as c:
+            results = []
+            c.pipeline_run(proc, iter(range(20)), results.append, 100)
+            assert results == list(range(100, 120))
+
+
+def test_pipeline_run_context() -> None:
+    test_file = OUTPUT_FOLDER / "test_pipeline_log.txt"
+    test_file.unlink(missing_ok=True)
+    test_strings = ["_p1_", "_p2_", "_p3_"]
+    with Context(dask_args={"workers": 2}, log_args={"fname": str(test_file)}) as c:
+
+        def write(s):
+            log.info(s)
+            return current_context().name
+
+        results = []
+        c.pipeline_run(write, iter(test_strings), results.append)
+    assert results == [f"./task-{i}" for i in range(len(test_strings))]
+    text = test_file.read_text()
+    for x in test_strings:
+        assert x in text
@@ -1,4 +1,5 @@
 import csv
+import json
 import os.path
 import tempfile
 from argparse import Namespace
@@ -6,6 +7,8 @@ from pathlib import Path
 from typing import Optional
 
 import geopandas as gpd
+import pandas as pd
+import pyarrow.parquet as pq
 import pytest
 from geopandas import GeoDataFrame
 from vpt_core.segmentation.seg_result import SegmentationResult
@@ -15,6 +18,8 @@ from vpt_core.utils.segmentation_utils import assert_df_equals
 from tests.vpt import OUTPUT_FOLDER, TEST_DATA_ROOT
 from vpt.convert_geometry.main import convert_geometry
 from vpt.convert_geometry import cmd_args
+from vpt.utils.geoparquet import BBOX_COLUMN, BBOX_FIELDS
+from vpt.utils.input_utils import read_parquet_by_groups
 
 
 class ConvertCase(BaseCase):
@@ -177,6 +182,76 @@ def test_convert_geometry(case: ConvertCase) -> None:
     case.asset_parquet_equality()
 
 
+def test_convert_geometry_spatial_row_groups() -> None:
+    outputs = []
+    for spatial_row_groups in (False, True):
+        output_path = str(OUTPUT_FOLDER / f"cvt_spatial_{spatial_row_groups}.parquet")
+        args = Namespace(
+            input_boundaries=str(TEST_DATA_ROOT / "cells_cellpose.parquet"),
+            output_boundaries=output_path,
+            entity_fusion_strategy="harmonize",
+            output_entity_type="cell",
+            id_mapping_file=None,
+            max_row_group_size=17500,
+            overwrite=True,
+            input_micron_to_mosaic=None,
+            convert_to_3D=False,
+            number_z_planes=None,
+            spacing_z_planes=None,
+            spatial_row_groups=spatial_row_groups,
+        )
+        Path(output_path).parent.mkdir(exist_ok=True, parents=True)
+        convert_geometry(args)
+        outputs.append(gpd.read_parquet(output_path))
+
+    expected, result = outputs
+    geo_metadata = json.loads(pq.read_schema(output_path).metadata[b"geo"])
+    assert geo_metadata["columns"]["Geometry"]["covering"]["bbox"]["xmin"] == [BBOX_COLUMN, "xmin"]
+    bbox = pq.read_table(output_path, columns=[BBOX_COLUMN]).column(BBOX_COLUMN).to_pylist()
+    bounds = result["Geometry"].bounds
+    for field, column in zip(BBOX_FIELDS, ["minx", "miny", "maxx", "maxy"]):
+        assert [item[field] for item in bbox] == bounds[column].tolist()
+
+    # the EntityIDs are generated on every run, the polygons are compared by their detection ids
+    id_field = SegmentationResult.detection_id_field
+    result = result.drop(columns=[BBOX_COLUMN], errors="ignore").sort_values(id_field).reset_index(drop=True)
+    expected = expected.sort_values(id_field).reset_index(drop=True)
+    assert (pd.factorize(result["EntityID"])[0] == pd.factorize(expected["EntityID"])[0]).all()
+    columns = [column for column in expected.columns if column not in ("EntityID", "Geometry")]
+    assert result[columns].equals(expected[columns])
+    assert result["Geometry"].geom_equals_exact(expected["Geometry"], 0).all()
+
+
+def test_convert_geometry_drops_bbox_covering() -> None:
+    spatial_path = str(OUTPUT_FOLDER / "cvt_bbox_spatial.parquet")
+    output_path = str(OUTPUT_FOLDER / "cvt_bbox_transformed.parquet")
+    Path(spatial_path).parent.mkdir(exist_ok=True, parents=True)
+    for input_path, path, transform_path, spatial_row_groups in [
+        (str(TEST_DATA_ROOT / "cells_cellpose.parquet"), spatial_path, None, True),
+        (spatial_path, output_path, str(TEST_DATA_ROOT / "micron_to_mosaic_pixel_transform.csv"), False),
+    ]:
+        args = Namespace(
+            input_boundaries=input_path,
+            output_boundaries=path,
+            entity_fusion_strategy="harmonize",
+            output_entity_type="cell",
+            id_mapping_file=None,
+            max_row_group_size=17500,
+            overwrite=True,
+            input_micron_to_mosaic=transform_path,
+            convert_to_3D=False,
+            number_z_planes=None,
+            spacing_z_planes=None,
+            spatial_row_groups=spatial_row_groups,
+        )
+        convert_geometry(args)
+
+    # the geometries are transformed, the bbox covering of the input is not written by the default writer
+    assert BBOX_COLUMN not in pq.read_schema(output_path).names
+    result = pd.concat(read_parquet_by_groups(output_path, tuple(gpd.read_parquet(output_path).total_bounds)))
+    assert len(result) == len(gpd.read_parquet(output_path))
+
+
 CONVERT_CASES_ARGS = [
     ConvertCase(
         name="hdf5",
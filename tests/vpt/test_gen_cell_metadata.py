@@ -1,3 +1,4 @@
+import json
 import os
 import tempfile
 from argparse import Namespace
@@ -5,9 +6,12 @@ from argparse import Namespace
 import geopandas as gpd
 import numpy as np
 import pandas
+import pyarrow as pa
+import pyarrow.parquet as pq
 import pytest
+import shapely
 from shapely import geometry
-from shapely.geometry import Polygon
+from shapely.geometry import MultiPolygon, Polygon
 from vpt_core.io.output_tools import save_geodataframe
 from vpt_core.io.vzgfs import initialize_filesystem, vzg_open, retrying_attempts, io_with_retries
 from vpt_core.segmentation.seg_result import SegmentationResult
@@ -15,13 +19,19 @@ from vpt_core.utils.copy_utils import _copy_between_filesystems
 
 from tests.vpt import TEST_DATA_ROOT
 from tests.vpt.temp_dir import LocalTempDir, TempDir
-from vpt.derive_cell_metadata.cell_metadata import create_metadata_table
+from vpt.derive_cell_metadata.cell_metadata import create_metadata_table, get_anisotropy
+from vpt.derive_cell_metadata.row_group_metadata import create_metadata_table_by_row_groups, split_by_row_groups
 from vpt.derive_cell_metadata.run_derive_cell_metadata import main_derive_cell_metadata
 from vpt.partition_transcripts.cell_x_gene import cell_by_gene_matrix
+from vpt.partition_transcripts.run_partition_transcripts import main_partition_transcripts
 from vpt.utils.boundaries import Boundaries
 from vpt.utils.cellsreader import CellsReader, cell_reader_factory
 from vpt.utils.cellsreader.geo_reader import CellsGeoReader
 from vpt.utils.cellsreader.parquet_reader import CellsParquetReader
+from vpt.utils.cellsreader.spatial_reader import HILBERT_ORDER, Z_ORDER, get_entity_centers, hilbert_keys, z_order_keys
+from vpt.utils.geoparquet import get_row_groups_in_bbox, save_spatial_segmentation_results
+from vpt.utils.input_utils import read_parquet_by_groups
+from vpt.utils.raw_cell import EntitiesGeometry
 
 DATA_ROOT = TEST_DATA_ROOT / "test_gen_cell_metadata"
 gj_file = DATA_ROOT / "sample.geojson"
@@ -111,13 +121,242 @@ def test_cells_reader_row_groups(fov_size: int):
     readers = [CellsParquetReader(input_boundaries), CellsGeoReader(geojson_path)]
     readers[1]._initialize_with_data(all_cells_data)
 
-    readed_data = [[] for _ in readers]
-    for i, reader in enumerate(readers):
+    readed_data = []
+    for reader in readers:
         reader._set_cells_per_fov(fov_size)
-        for fov_i in range(reader.get_fovs_count()):
-            readed_data[i].extend(reader.read_fov(fov_i))
+        fovs = [reader.read_fov(fov_i) for fov_i in range(reader.get_fovs_count())]
+        readed_data.append(EntitiesGeometry.concat(fovs, reader.get_z_planes_count()))
 
-    assert len(readed_data[0]) == len(readed_data[1])
+    assert readed_data[0].get_entities_count() == readed_data[1].get_entities_count()
     assert readed_data[0] == readed_data[1]
 
     td.cleanup()
+
+
+@pytest.mark.parametrize("input_boundaries", [TEST_DATA_ROOT / "cells_cellpose.parquet", gj_file], ids=str)
+def test_read_entities_geometry(input_boundaries):
+    reader = cell_reader_factory(str(input_boundaries))
+    fovs = [reader.read_fov(fov_i) for fov_i in range(reader.get_fovs_count())]
+
+    entities = reader.read_entities_geometry()
+    assert entities.entity_ids.dtype == np.int64
+    assert entities.get_z_planes_count() == reader.get_z_planes_count()
+    assert EntitiesGeometry.concat(fovs, reader.get_z_planes_count()) == entities
+
+
+def test_anisotropy():
+    rng = np.random.default_rng(0)
+    polygons = [shapely.convex_hull(shapely.multipoints(rng.normal(0, [5, 2], (20, 2)))) for _ in range(30)]
+    polygons += [shapely.box(0, 0, 1, 3), shapely.LineString([(0, 0), (1, 1)]), shapely.Point(2, 2)]
+    entity_idx = np.arange(len(polygons)) * 2
+
+    anisotropy = get_anisotropy(np.array(polygons, dtype=object), entity_idx, len(polygons) * 2)
+
+    for i, polygon in enumerate(polygons[:-2]):
+        rectangle = np.array(polygon.minimum_rotated_rectangle.exterior.coords)
+        sides = np.sqrt(np.sum(np.diff(rectangle, axis=0) ** 2, axis=1))
+        assert np.isclose(anisotropy[2 * i], np.max(sides) / np.min(sides), rtol=1e-9)
+    assert np.isclose(anisotropy[2 * 30], 3)
+    assert np.isnan(anisotropy[2 * 31]) and np.isnan(anisotropy[2 * 32])
+    assert np.isnan(anisotropy[1::2]).all()
+
+
+def test_metadata_skipped_polygons():
+    square = MultiPolygon([shapely.box(0, 0, 2, 2)])
+    data = gpd.GeoDataFrame(
+        {
+            "ID": range(5),
+            "EntityID": [3, 3, 3, 1, 2],
+            "ZIndex": [0, 1, 2, 0, 1],
+            "ZLevel": [1.5, 3.0, 4.5, 1.5, 3.0],
+            "Geometry": [
+                square,
+                MultiPolygon([shapely.box(4, 0, 6, 1)]),
+                MultiPolygon([shapely.box(0, 0, 1e-6, 1e-6)]),
+                MultiPolygon(),
+                square,
+            ],
+        }
+    ).set_geometry("Geometry")
+    reader = CellsGeoReader(data=data)
+    tbl = create_metadata_table(Boundaries(reader), reader.get_z_depth_per_level(), np.array([7, 8, 9]))
+
+    assert tbl.index.tolist() == [1, 2, 3]
+    assert tbl.loc[1].drop("fov").isna().all()
+    assert tbl.loc[2, "volume"] == 4 * 1.5 and tbl.loc[2, "transcript_count"] == 8
+    # the tiny polygon on the last z-plane is left out
+    assert tbl.loc[3, "volume"] == 4 * 1.5 + 2 * 1.5
+    assert tbl.loc[3, ["min_x", "min_y", "max_x", "max_y"]].tolist() == [0, 0, 6, 2]
+    assert tbl.loc[3, ["center_x", "center_y"]].tolist() == [3, 0.75]
+    assert tbl.loc[3, "perimeter_area_ratio"] == (8 / 4 + 6 / 2) / 2
+    assert np.isclose(tbl.loc[3, "anisotropy"], 3)
+    assert np.isclose(tbl.loc[3, "solidity"], 1)
+
+
+def test_metadata_by_row_groups():
+    data = pandas.read_parquet(TEST_DATA_ROOT / "cells_cellpose.parquet").sort_values("EntityID", kind="stable")
+    with tempfile.TemporaryDirectory() as td:
+        path = os.path.join(td, "boundaries.parquet")
+        pq.write_table(pa.Table.from_pandas(data, preserve_index=False), path, row_group_size=3)
+        reader = CellsParquetReader(path)
+
+        entity_ids, tasks = split_by_row_groups(reader, rows_per_task=5)
+        # every Entity is computed by one task, the Entities at the task edges are completed from the next row group
+        assert sorted(np.concatenate([entity_idx for _, entity_idx in tasks])) == list(range(len(entity_ids)))
+        assert sum(len(row_groups) for row_groups, _ in tasks) > reader.get_row_groups_count()
+
+        barcodes = pandas.Series(np.arange(len(entity_ids)) * 2, index=entity_ids)
+        expected = create_metadata_table(Boundaries(reader), reader.get_z_depth_per_level(), barcodes)
+        result = create_metadata_table_by_row_groups(path, barcodes, rows_per_task=5)
+        del reader
+
+    assert expected.equals(result)
+
+
+def test_parquet_reader_reads_row_group_once():
+    data = pandas.read_parquet(TEST_DATA_ROOT / "cells_cellpose.parquet")
+    with tempfile.TemporaryDirectory() as td:
+        path = os.path.join(td, "boundaries.parquet")
+        pq.write_table(pa.Table.from_pandas(data, preserve_index=False), path, row_group_size=7)
+        expected_reader = CellsParquetReader(path)
+        expected_reader._set_cells_per_fov(len(data))
+        expected = expected_reader.read_fov(0)
+
+        reader = CellsParquetReader(path)
+        reader._set_cells_per_fov(1)
+        reads = []
+        read_row_group = reader.pq_data.read_row_group
+        reader.pq_data.read_row_group = lambda i, **kwargs: reads.append(i) or read_row_group(i, **kwargs)
+        fovs = [reader.read_fov(fov_i) for fov_i in range(reader.get_fovs_count())]
+        entities = EntitiesGeometry.concat(fovs, reader.get_z_planes_count())
+        del reader, expected_reader
+
+    assert entities == expected
+    assert sorted(reads) == list(range(int(np.ceil(len(data) / 7))))
+
+
+def test_geo_reader_fovs():
+    data = gpd.read_parquet(TEST_DATA_ROOT / "cells_cellpose.parquet").sample(frac=1, random_state=0)
+    reader = CellsGeoReader(data=data)
+    reader._set_cells_per_fov(len(data))
+    expected = reader.read_fov(0)
+    reader._set_cells_per_fov(3)
+    fovs = [reader.read_fov(fov_i) for fov_i in range(reader.get_fovs_count())]
+    entities = EntitiesGeometry.concat(fovs, reader.get_z_planes_count())
+
+    assert reader.get_fovs_count() == int(np.ceil(data["EntityID"].nunique() / 3))
+    assert all(fov.get_entities_count() <= 3 for fov in fovs)
+    assert entities == expected
+    assert entities.entity_ids.tolist() == sorted(data["EntityID"].unique())
+    for i, entity_id in enumerate(entities.entity_ids):
+        rows = data[data["EntityID"] == entity_id]
+        assert sorted(rows["ZIndex"]) == [z for z, shapes in enumerate(entities.geometries) if shapes[i] is not None]
+
+
+def test_curve_keys():
+    x, y = np.meshgrid(np.arange(8), np.arange(8))
+    x, y = x.ravel(), y.ravel()
+    for curve_keys in (hilbert_keys, z_order_keys):
+        keys = curve_keys(x, y, 3)
+        assert sorted(keys) == list(range(64))
+    # consecutive points of the Hilbert curve are neighbours on the grid
+    order = np.argsort(hilbert_keys(x, y, 3))
+    assert (np.abs(np.diff(x[order])) + np.abs(np.diff(y[order])) == 1).all()
+    assert z_order_keys(np.array([1, 0, 1]), np.array([0, 1, 1]), 1).tolist() == [1, 2, 3]
+
+
+@pytest.mark.parametrize("fov_order", [HILBERT_ORDER, Z_ORDER], ids=str)
+def test_spatial_fov_order(fov_order: str):
+    def get_fovs_area(fovs):
+        areas = []
+        for fov in fovs:
+            centers = get_entity_centers(fov)
+            areas.append(np.prod(np.nanmax(centers, axis=0) - np.nanmin(centers, axis=0)))
+        return sum(areas)
+
+    reader = cell_reader_factory(str(TEST_DATA_ROOT / "cells_cellpose.parquet"), fov_order)
+    reader._set_cells_per_fov(10)
+    fovs = [reader.read_fov(fov_i) for fov_i in range(reader.get_fovs_count())]
+
+    expected = reader.read_entities_geometry()
+    id_order = np.argsort(expected.entity_ids)
+    id_fovs = [expected.take(id_order[i : i + 10]) for i in range(0, len(id_order), 10)]
+    assert len(fovs) == len(id_fovs)
+    assert all(fov.get_entities_count() == 10 for fov in fovs[:-1])
+    entities = EntitiesGeometry.concat(fovs, reader.get_z_planes_count())
+    assert entities.select(expected.entity_ids) == expected
+    assert get_fovs_area(fovs) < get_fovs_area(id_fovs) / 2
+
+
+def test_bbox_pushdown():
+    data = gpd.read_parquet(TEST_DATA_ROOT / "cells_cellpose.parquet")
+    bbox = (20, 20, 60, 60)
+    bounds = data["Geometry"].bounds
+    in_bbox = (bounds["minx"] <= 60) & (bounds["maxx"] >= 20) & (bounds["miny"] <= 60) & (bounds["maxy"] >= 20)
+    with tempfile.TemporaryDirectory() as td:
+        path = os.path.join(td, "boundaries.parquet")
+        save_spatial_segmentation_results(data, path, 20)
+        metadata = pq.ParquetFile(path).metadata
+        row_groups = get_row_groups_in_bbox(metadata, bbox)
+        assert 0 < len(row_groups) < metadata.num_row_groups
+        assert get_row_groups_in_bbox(pq.ParquetFile(TEST_DATA_ROOT / "cells_cellpose.parquet").metadata, bbox) == [0]
+
+        rows = pandas.concat(read_parquet_by_groups(path, bbox))
+        assert sorted(rows["ID"]) == sorted(data.loc[in_bbox, "ID"])
+
+        # a bbox column that is not declared as the covering of the geometry column is not used for pruning
+        table = pq.read_table(path)
+        geo_metadata = json.loads(table.schema.metadata[b"geo"])
+        del geo_metadata["columns"]["Geometry"]["covering"]
+        undeclared_path = os.path.join(td, "undeclared_bbox.parquet")
+        pq.write_table(
+            table.replace_schema_metadata({**table.schema.metadata, b"geo": json.dumps(geo_metadata).encode()}),
+            undeclared_path,
+            row_group_size=20,
+        )
+        undeclared_metadata = pq.ParquetFile(undeclared_path).metadata
+        assert get_row_groups_in_bbox(undeclared_metadata, bbox) == list(range(undeclared_metadata.num_row_groups))
+
+        reader = CellsParquetReader(path, bbox)
+        entity_ids = reader.read_entities_geometry().entity_ids
+        fovs = [reader.read_fov(fov_i) for fov_i in range(reader.get_fovs_count())]
+        del reader
+
+    assert set(data.loc[in_bbox, "EntityID"]) <= set(entity_ids)
+    assert len(entity_ids) < data["EntityID"].nunique()
+    assert sorted(np.concatenate([fov.entity_ids for fov in fovs])) == sorted(entity_ids)
+
+
+def test_metadata_transcript_count_of_spatial_row_groups():
+    data = gpd.read_parquet(TEST_DATA_ROOT / "cells_cellpose.parquet")
+    with tempfile.TemporaryDirectory() as td:
+        boundaries_path = os.path.join(td, "boundaries.parquet")
+        save_spatial_segmentation_results(data, boundaries_path, 20)
+        assert pq.ParquetFile(boundaries_path).metadata.num_row_groups > 1
+
+        entity_by_gene_path = os.path.join(td, "cell_by_gene.csv")
+        main_partition_transcripts(
+            Namespace(
+                input_boundaries=boundaries_path,
+                input_transcripts=str(TEST_DATA_ROOT / "detected_transcripts.csv"),
+                output_entity_by_gene=entity_by_gene_path,
+                output_transcripts=None,
+                chunk_size=10000,
+                overwrite=True,
+            )
+        )
+        metadata_path = os.path.join(td, "cell_metadata.csv")
+        main_derive_cell_metadata(
+            Namespace(
+                input_boundaries=boundaries_path,
+                output_metadata=metadata_path,
+                input_entity_by_gene=entity_by_gene_path,
+                overwrite=True,
+            )
+        )
+        entity_by_gene = pandas.read_csv(entity_by_gene_path, index_col=0)
+        metadata = pandas.read_csv(metadata_path, index_col=0)
+
+    # the counts of the Entities are matched by EntityID, not by the order of the row groups
+    assert entity_by_gene.sum(axis=1).sum() > 0
+    assert metadata["transcript_count"].equals(entity_by_gene.sum(axis=1).reindex(metadata.index).astype(float))
@@ -1,16 +1,30 @@
 import tempfile
 from pathlib import Path
-from typing import List
+from typing import List, Tuple
 
 import cv2
 import numpy as np
 import pytest
+import shapely
 import tifffile
 from geopandas import GeoDataFrame
-from shapely.geometry import MultiPolygon
+import rasterio
+from rasterio.features import rasterize
+from scipy import ndimage
+from shapely.affinity import translate
+from shapely.geometry import MultiPolygon, Point
 from vpt_core.utils.base_case import BaseCase
 
+from vpt.sum_signals.block_sums import (
+    block_high_pass_filter,
+    get_entity_brightness,
+    get_entity_measures,
+    get_level_factor,
+    high_pass_filter,
+    split_by_tiles,
+)
 from vpt.sum_signals.main import get_cell_brightness_in_image
+from vpt.sum_signals.statistics import StatisticsSpec
 
 
 class GetCellBrightnessInImageCase(BaseCase):
@@ -90,3 +104,118 @@ def test_1d_poly_does_not_crash():
         img_path = (Path(td) / "image.tiff").as_posix()
         tifffile.imwrite(img_path, image)
         get_cell_brightness_in_image(str(img_path), ((row["EntityID"], row["Geometry"]) for _, row in gdf.iterrows()))
+
+
+def _brightness_per_cell(image: np.ndarray, geometries: List, exact_high_pass: bool) -> Tuple[np.ndarray, np.ndarray]:
+    image_high_pass = block_high_pass_filter(image)
+    raw, high_pass = [], []
+    for cell in geometries:
+        left, top, right, bottom = cell.bounds
+        rows = slice(int(top), int(top) + int(bottom - top + 1))
+        columns = slice(int(left), int(left) + int(right - left + 1))
+        window = image[rows, columns]
+        mask = rasterize([translate(cell, -left, -top)], out_shape=window.shape, all_touched=True)
+        raw.append(np.sum(window * mask))
+        if exact_high_pass:
+            high_pass.append(np.sum(high_pass_filter(window) * mask))
+        else:
+            high_pass.append(np.sum(image_high_pass[rows, columns] * mask))
+    return np.array(raw, dtype=float), np.array(high_pass)
+
+
+@pytest.mark.parametrize("block_size, exact_high_pass", [(64, True), (1024, True), (64, False), (1024, False)])
+def test_entity_brightness_by_blocks(block_size: int, exact_high_pass: bool) -> None:
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 65535, (300, 260)).astype(np.uint16)
+    points = shapely.points(rng.uniform(0, [260, 300], (150, 2)))
+    cells = shapely.get_parts(shapely.voronoi_polygons(shapely.multipoints(points)))
+    # adjacent cells share the touched pixels, cells of another kind overlap them
+    geometries = [cell for cell in shapely.intersection(cells, shapely.box(0.5, 0.5, 259, 299)) if not cell.is_empty]
+    geometries += [Point(x, y).buffer(r) for x, y, r in rng.uniform([20, 20, 0.5], [240, 280, 15], (40, 3))]
+    entity_ids = np.arange(len(geometries)) + 100
+
+    with tempfile.TemporaryDirectory() as td:
+        img_path = (Path(td) / "image.tiff").as_posix()
+        tifffile.imwrite(img_path, image)
+        raw, high_pass = get_entity_brightness(
+            img_path, entity_ids, np.array(geometries, dtype=object), block_size, exact_high_pass
+        )
+
+    expected_raw, expected_high_pass = _brightness_per_cell(image, geometries, exact_high_pass)
+    assert np.array_equal(raw.index, entity_ids)
+    assert np.array_equal(raw.to_numpy(), expected_raw)
+    if exact_high_pass:
+        assert np.array_equal(high_pass.to_numpy(), expected_high_pass)
+    else:
+        assert np.allclose(high_pass.to_numpy(), expected_high_pass, rtol=1e-12, atol=0)
+
+
+def test_split_by_tiles() -> None:
+    geometries = np.array(
+        [
+            shapely.box(10.5, 10, 30, 30),
+            None,
+            shapely.box(70, 5, 140, 20),
+            MultiPolygon(),
+            shapely.box(63.9, 63.9, 70, 70),
+            shapely.box(64, 0, 66, 2),
+        ],
+        dtype=object,
+    )
+    tiles = split_by_tiles(geometries, tile_size=64)
+
+    assert [idx.tolist() for idx in tiles] == [[0, 4], [2, 5]]
+
+
+def test_entity_measures() -> None:
+    rng = np.random.default_rng(1)
+    image = rng.integers(0, 65535, (200, 180)).astype(np.uint16)
+    points = shapely.points(rng.uniform(0, [180, 200], (60, 2)))
+    cells = shapely.get_parts(shapely.voronoi_polygons(shapely.multipoints(points)))
+    geometries = [cell for cell in shapely.intersection(cells, shapely.box(0.5, 0.5, 179, 199)) if not cell.is_empty]
+    spec = StatisticsSpec(("sum", "count", "variance", "max"), (0, 0.25, 0.5, 1))
+
+    with tempfile.TemporaryDirectory() as td:
+        img_path = (Path(td) / "image.tiff").as_posix()
+        tifffile.imwrite(img_path, image)
+        measures = get_entity_measures(
+            img_path, np.arange(len(geometries)), np.array(geometries, dtype=object), spec, 64
+        )
+
+    assert list(measures.columns) == ["sum", "count", "sum_squares", "max", "q0", "q25", "q50", "q100"]
+    for i, cell in enumerate(geometries):
+        left, top, right, bottom = cell.bounds
+        window = image[int(top) : int(top) + int(bottom - top + 1), int(left) : int(left) + int(right - left + 1)]
+        mask = rasterize([translate(cell, -left, -top)], out_shape=window.shape, all_touched=True)
+        pixels = window[mask > 0].astype(np.float64)
+        assert measures["sum"][i] == np.sum(pixels)
+        assert measures["count"][i] == len(pixels)
+        assert measures["sum_squares"][i] == np.sum(pixels**2)
+        assert measures["max"][i] == np.max(pixels)
+        assert np.allclose(measures.loc[i, ["q0", "q25", "q50", "q100"]], np.quantile(pixels, [0, 0.25, 0.5, 1]))
+
+
+def test_entity_measures_from_pyramid_level() -> None:
+    rng = np.random.default_rng(2)
+    image = ndimage.gaussian_filter(rng.uniform(0, 60000, (256, 240)), 4).astype(np.uint16)
+    level = image.reshape(128, 2, 120, 2).mean(axis=(1, 3)).astype(np.uint16)
+    geometries = np.array([Point(x, y).buffer(r) for x, y, r in rng.uniform([40, 40, 10], [200, 215, 30], (20, 3))])
+    spec = StatisticsSpec(("sum", "count"))
+
+    with tempfile.TemporaryDirectory() as td:
+        img_path = (Path(td) / "image.ome.tif").as_posix()
+        with tifffile.TiffWriter(img_path) as tiff:
+            tiff.write(image, subifds=1, tile=(64, 64))
+            tiff.write(level, subfiletype=1, tile=(64, 64))
+        with rasterio.open(img_path) as file:
+            assert get_level_factor(file, 0) == 1
+            assert get_level_factor(file, 1) == 2
+            assert get_level_factor(file, 2) == 4
+
+        entity_ids = np.arange(len(geometries))
+        full = get_entity_measures(img_path, entity_ids, geometries, spec)
+        approximate = get_entity_measures(img_path, entity_ids, geometries, spec, pyramid_level=1)
+
+    errors = (approximate - full).abs() / full
+    assert (errors.median() < 0.02).all()
+    assert (errors.max() < 0.1).all()
@@ -1,17 +1,30 @@
+import gzip
 import os
 from argparse import Namespace
 from functools import partial
 
 import numpy
 import pandas as pd
+import pyarrow as pa
 import pytest
+from pyarrow import parquet as pq
 from geopandas import gpd
-from vpt_core.io.vzgfs import io_with_retries
+from fsspec import FSTimeoutError
+from scipy import sparse
+from tenacity import Retrying, stop_after_attempt
+from vpt_core.io.vzgfs import io_with_retries, vzg_open
 from vpt_core.utils.copy_utils import _copy_between_filesystems
 
 from tests.vpt import OUTPUT_FOLDER, TEST_DATA_ROOT
 from tests.vpt.temp_dir import LocalTempDir, TempDir
+from vpt.app.context import Context
+from vpt.partition_transcripts import checkpoint
+from vpt.partition_transcripts.cell_x_gene import process_chunk
 from vpt.partition_transcripts.run_partition_transcripts import main_partition_transcripts
+from vpt.partition_transcripts import tiled_partition
+from vpt.partition_transcripts.tiled_partition import TileGrid
+from vpt.utils import input_utils
+from vpt.utils.entity_by_gene_io import EntityByGeneMatrix, read_entity_by_gene, write_entity_by_gene
 
 
 def get_arguments(temp_path: TempDir):
@@ -155,3 +168,409 @@ def test_no_cells(temp_dir: TempDir):
         main_partition_transcripts(args)
     finally:
         temp_dir.clear_dir()
+
+
+def test_entity_index_assign():
+    from shapely.geometry import Polygon
+
+    from vpt.partition_transcripts.entity_index import EntityIndex
+
+    square = Polygon([(0, 0), (10, 0), (10, 10), (0, 10)])
+    shifted = Polygon([(5, 5), (15, 5), (15, 15), (5, 15)])
+    empty = Polygon(((0, 0), (0, 0), (0, 0)))
+    entity_index = EntityIndex([[square, shifted], [empty, shifted]], 2)
+
+    x = numpy.array([1, 7, 12, 1, 7, 7, 20])
+    y = numpy.array([1, 7, 12, 1, 7, 7, 20])
+    z = numpy.array([0, 0, 0, 1, 1, 2, 0])
+    points_idx, entity_idx, assignment = entity_index.assign(x, y, z)
+
+    pairs = sorted(zip(points_idx.tolist(), entity_idx.tolist()))
+    assert pairs == [(0, 0), (1, 0), (1, 1), (2, 1), (4, 1)]
+    assert assignment.tolist() == [0, 1, 1, -1, 1, -1, -1]
+
+
+def test_entity_by_gene_accumulator():
+    from vpt.partition_transcripts.entity_by_gene import ChunkCounts, EntityByGeneAccumulator
+
+    accumulator = EntityByGeneAccumulator(numpy.array([30, 10, 20, 10]))
+    accumulator.add(
+        ChunkCounts(
+            entity_idx=numpy.array([0, 1, 3]),
+            gene_idx=numpy.array([0, 1, 1]),
+            counts=numpy.array([2, 1, 4]),
+            genes=numpy.array(["b", "a"], dtype=object),
+            barcode_ids=numpy.array([5, 2]),
+        )
+    )
+    accumulator.add(
+        ChunkCounts(
+            entity_idx=numpy.array([2, 0]),
+            gene_idx=numpy.array([0, 1]),
+            counts=numpy.array([3, 1]),
+            genes=numpy.array(["c", "b"], dtype=object),
+            barcode_ids=numpy.array([7, 5]),
+        )
+    )
+    cell_by_gene = accumulator.to_dataframe()
+
+    assert list(cell_by_gene.index) == [10, 20, 30]
+    assert list(cell_by_gene.columns) == ["a", "b", "c"]
+    assert cell_by_gene.values.tolist() == [[5, 0, 0], [0, 0, 3], [0, 3, 0]]
+
+
+@pytest.mark.parametrize("temp_dir", [LocalTempDir()], ids=str)
+def test_partition_parquet_transcripts(temp_dir: TempDir):
+    try:
+        csv_args = get_arguments(temp_dir)
+        main_partition_transcripts(csv_args)
+
+        path = temp_dir.get_temp_path()
+        sep = temp_dir.get_sep()
+        transcripts = io_with_retries(csv_args.input_transcripts, "r", pd.read_csv)
+        parquet_args = Namespace(
+            **{
+                **vars(csv_args),
+                "input_transcripts": sep.join([path, "detected_transcripts.parquet"]),
+                "output_entity_by_gene": sep.join([path, "parquet_cell_by_gene.csv"]),
+                "output_transcripts": sep.join([path, "detected_transcripts_cell_id.parquet"]),
+                "chunk_size": 1000,
+            }
+        )
+        io_with_retries(parquet_args.input_transcripts, "wb", partial(transcripts.to_parquet, index=False))
+        main_partition_transcripts(parquet_args)
+
+        csv_matrix = io_with_retries(csv_args.output_entity_by_gene, "r", pd.read_csv)
+        parquet_matrix = io_with_retries(parquet_args.output_entity_by_gene, "r", pd.read_csv)
+        assert csv_matrix.equals(parquet_matrix)
+
+        csv_transcripts = io_with_retries(csv_args.output_transcripts, "r", pd.read_csv)
+        parquet_transcripts = io_with_retries(parquet_args.output_transcripts, "rb", pd.read_parquet)
+        assert parquet_transcripts["cell_id"].dtype == numpy.int64
+        assert numpy.array_equal(csv_transcripts["cell_id"].values, parquet_transcripts["cell_id"].values)
+    finally:
+        temp_dir.clear_dir()
+
+
+@pytest.mark.parametrize("temp_dir", [LocalTempDir()], ids=str)
+def test_partition_by_tiles(temp_dir: TempDir):
+    try:
+        args = get_arguments(temp_dir)
+        main_partition_transcripts(args)
+
+        path = temp_dir.get_temp_path()
+        sep = temp_dir.get_sep()
+        tiled_args = Namespace(
+            **{
+                **vars(args),
+                "output_entity_by_gene": sep.join([path, "tiled_cell_by_gene.csv"]),
+                "output_transcripts": sep.join([path, "tiled_detected_transcripts_cell_id.csv"]),
+                "tile_size": 50.0,
+                "temp_path": sep.join([path, "tiles"]),
+                "label_pixel_size": 0.5,
+                # the transcripts of a tile are spilled by several chunks
+                "chunk_size": 1000,
+            }
+        )
+        main_partition_transcripts(tiled_args)
+
+        for expected, result in [
+            (args.output_entity_by_gene, tiled_args.output_entity_by_gene),
+            (args.output_transcripts, tiled_args.output_transcripts),
+        ]:
+            assert io_with_retries(expected, "r", lambda f: f.read()) == io_with_retries(
+                result, "r", lambda f: f.read()
+            )
+    finally:
+        temp_dir.clear_dir()
+
+
+@pytest.mark.parametrize("pixel_size", [0.3, 1.0, 7.0])
+def test_raster_entity_index_matches_exact(pixel_size: float):
+    from shapely.geometry import Polygon
+
+    from vpt.partition_transcripts.entity_index import EntityIndex, RasterEntityIndex
+
+    square = Polygon([(0, 0), (10, 0), (10, 10), (0, 10)])
+    shifted = Polygon([(5, 5), (15, 5), (15, 15), (5, 15)])
+    with_hole = Polygon([(20, 0), (30, 0), (30, 10), (20, 10)], [[(22, 2), (28, 2), (28, 8), (22, 8)]])
+    empty = Polygon(((0, 0), (0, 0), (0, 0)))
+    geometry_list = [[square, shifted, with_hole], [empty, shifted, empty]]
+
+    rng = numpy.random.default_rng(0)
+    grid = numpy.arange(-2, 33, 0.5)
+    x = numpy.concatenate([rng.uniform(-2, 32, 5000), numpy.repeat(grid, len(grid))])
+    y = numpy.concatenate([rng.uniform(-2, 17, 5000), numpy.tile(grid, len(grid))])
+    z = numpy.concatenate([rng.integers(0, 3, 5000), numpy.zeros(len(grid) ** 2, dtype=int)])
+
+    expected = EntityIndex(geometry_list, 2).assign(x, y, z)
+    result = RasterEntityIndex(geometry_list, 2, pixel_size).assign(x, y, z)
+
+    assert sorted(zip(*expected[:2])) == sorted(zip(*result[:2]))
+    assert numpy.array_equal(expected[2], result[2])
+
+
+@pytest.mark.parametrize("temp_dir", [LocalTempDir()], ids=str)
+def test_partition_compressed_transcripts(temp_dir: TempDir):
+    try:
+        args = get_arguments(temp_dir)
+        main_partition_transcripts(args)
+
+        compressed_args = Namespace(
+            **{
+                **vars(args),
+                "output_entity_by_gene": temp_dir.get_sep().join([temp_dir.get_temp_path(), "gz_cell_by_gene.csv"]),
+                "output_transcripts": args.output_transcripts + ".gz",
+            }
+        )
+        main_partition_transcripts(compressed_args)
+
+        expected = io_with_retries(args.output_transcripts, "rb", lambda f: f.read())
+        result = io_with_retries(compressed_args.output_transcripts, "rb", lambda f: f.read())
+        assert result[:2] == b"\x1f\x8b"
+        assert gzip.decompress(result) == expected
+    finally:
+        temp_dir.clear_dir()
+
+
+@pytest.mark.parametrize("extension", [".csv", ".mtx", ".h5ad", ".parquet"])
+@pytest.mark.parametrize("temp_dir", [LocalTempDir()], ids=str)
+def test_entity_by_gene_formats(temp_dir: TempDir, extension: str):
+    try:
+        matrix = numpy.array([[0, 3, 0], [0, 0, 0], [1, 0, 2], [0, 0, 0]], dtype=numpy.int64)
+        entity_by_gene = EntityByGeneMatrix(
+            sparse.csr_matrix(matrix), numpy.array([40, 10, 30, 20], dtype=numpy.int64), ["gene_b", "Blank-1", "gene_a"]
+        )
+        path = os.path.join(temp_dir.get_temp_path(), f"cell_by_gene{extension}")
+        write_entity_by_gene(path, entity_by_gene)
+
+        result = read_entity_by_gene(path)
+        assert result.genes == entity_by_gene.genes
+        assert numpy.array_equal(result.entity_ids, entity_by_gene.entity_ids)
+        assert numpy.array_equal(result.matrix.toarray(), matrix)
+        assert numpy.array_equal(result.get_entity_sums(), [3, 0, 3, 0])
+    finally:
+        temp_dir.clear_dir()
+
+
+@pytest.mark.parametrize("extension", [".mtx", ".parquet"])
+@pytest.mark.parametrize("temp_dir", [LocalTempDir()], ids=str)
+def test_partition_sparse_entity_by_gene(temp_dir: TempDir, extension: str):
+    try:
+        args = get_arguments(temp_dir)
+        args.output_transcripts = None
+        main_partition_transcripts(args)
+
+        sparse_args = Namespace(**{**vars(args), "output_entity_by_gene": args.output_entity_by_gene + extension})
+        main_partition_transcripts(sparse_args)
+
+        expected = pd.read_csv(args.output_entity_by_gene, index_col=0)
+        result = read_entity_by_gene(sparse_args.output_entity_by_gene).to_dataframe()
+        assert numpy.array_equal(expected.index, result.index)
+        assert list(expected.columns) == list(result.columns)
+        assert numpy.array_equal(expected.to_numpy(), result.to_numpy())
+    finally:
+        temp_dir.clear_dir()
+
+
+@pytest.mark.parametrize("temp_dir", [LocalTempDir()], ids=str)
+@pytest.mark.parametrize("transcripts_extension", ["csv", "parquet"])
+def test_partition_resumed_from_checkpoint(temp_dir: TempDir, transcripts_extension: str, monkeypatch):
+    try:
+        args = get_arguments(temp_dir)
+        path = temp_dir.get_temp_path()
+        sep = temp_dir.get_sep()
+        if transcripts_extension == "parquet":
+            transcripts = io_with_retries(args.input_transcripts, "r", pd.read_csv)
+            args.input_transcripts = sep.join([path, "detected_transcripts.parquet"])
+            io_with_retries(args.input_transcripts, "wb", partial(transcripts.to_parquet, index=False))
+        args.chunk_size = 1000
+        main_partition_transcripts(args)
+
+        checkpoint_args = Namespace(
+            **{
+                **vars(args),
+                "output_entity_by_gene": sep.join([path, "checkpoint_cell_by_gene.csv"]),
+                "output_transcripts": sep.join([path, "checkpoint_detected_transcripts_cell_id.csv"]),
+                "checkpoint_path": sep.join([path, "checkpoint"]),
+                "checkpoint_interval": 2,
+            }
+        )
+
+        processed_chunks = []
+
+        def process_chunk_until(interrupt_at: int):
+            def interrupted_process_chunk(chunk_df, *process_args):
+                processed_chunks.append(len(chunk_df))
+                if len(processed_chunks) == interrupt_at:
+                    raise RuntimeError("interrupted")
+                return process_chunk(chunk_df, *process_args)
+
+            return interrupted_process_chunk
+
+        monkeypatch.setattr(checkpoint, "process_chunk", process_chunk_until(4))
+        with pytest.raises(RuntimeError):
+            main_partition_transcripts(checkpoint_args)
+        assert os.path.exists(os.path.join(checkpoint_args.checkpoint_path, checkpoint.STATE_FILE))
+
+        # the rerun only processes the transcripts after the last checkpoint
+        processed_chunks.clear()
+        monkeypatch.setattr(checkpoint, "process_chunk", process_chunk_until(0))
+        main_partition_transcripts(checkpoint_args)
+        assert len(processed_chunks) == 4
+        assert not os.path.exists(checkpoint_args.checkpoint_path)
+
+        for expected, result in [
+            (args.output_entity_by_gene, checkpoint_args.output_entity_by_gene),
+            (args.output_transcripts, checkpoint_args.output_transcripts),
+        ]:
+            assert io_with_retries(expected, "r", lambda f: f.read()) == io_with_retries(
+                result, "r", lambda f: f.read()
+            )
+    finally:
+        temp_dir.clear_dir()
+
+
+@pytest.mark.parametrize("temp_dir", [LocalTempDir()], ids=str)
+@pytest.mark.parametrize(
+    "mode_args",
+    [{}, {"tile_size": 50.0}, {"checkpoint_path": "checkpoint", "checkpoint_interval": 2}],
+    ids=["chunks", "tiles", "checkpoint"],
+)
+def test_partition_several_boundaries(temp_dir: TempDir, mode_args: dict):
+    try:
+        args = get_arguments(temp_dir)
+        path = temp_dir.get_temp_path()
+        sep = temp_dir.get_sep()
+        args.chunk_size = 1000
+
+        nuclei_boundaries = sep.join([path, "nuclei.parquet"])
+        nuclei = pq.read_table(str(TEST_DATA_ROOT / "cells_onez.parquet"))
+        nuclei = nuclei.set_column(nuclei.schema.get_field_index("Type"), "Type", pa.array(["nuclei"] * len(nuclei)))
+        io_with_retries(nuclei_boundaries, "wb", partial(pq.write_table, nuclei))
+        nuclei_args = Namespace(
+            **{
+                **vars(args),
+                "input_boundaries": nuclei_boundaries,
+                "output_entity_by_gene": sep.join([path, "nuclei_by_gene.csv"]),
+                "output_transcripts": sep.join([path, "nuclei_detected_transcripts.csv"]),
+            }
+        )
+        main_partition_transcripts(args)
+        main_partition_transcripts(nuclei_args)
+
+        if "checkpoint_path" in mode_args:
+            mode_args = {**mode_args, "checkpoint_path": sep.join([path, mode_args["checkpoint_path"]])}
+        both_args = Namespace(
+            **{
+                **vars(args),
+                "input_boundaries": [args.input_boundaries, nuclei_boundaries],
+                "output_entity_by_gene": [
+                    sep.join([path, "both_cell_by_gene.csv"]),
+                    sep.join([path, "both_nuclei_by_gene.mtx"]),
+                ],
+                "output_transcripts": sep.join([path, "both_detected_transcripts.csv"]),
+                **mode_args,
+            }
+        )
+        main_partition_transcripts(both_args)
+
+        for single_output, both_output in zip(
+            [args.output_entity_by_gene, nuclei_args.output_entity_by_gene], both_args.output_entity_by_gene
+        ):
+            expected = read_entity_by_gene(single_output).to_dataframe()
+            assert expected.equals(read_entity_by_gene(both_output).to_dataframe())
+
+        cells_transcripts = io_with_retries(args.output_transcripts, "r", pd.read_csv)
+        nuclei_transcripts = io_with_retries(nuclei_args.output_transcripts, "r", pd.read_csv)
+        both_transcripts = io_with_retries(both_args.output_transcripts, "r", pd.read_csv)
+        assert list(both_transcripts.columns) == list(cells_transcripts.columns) + ["nuclei_id"]
+        assert both_transcripts.drop(columns="nuclei_id").equals(cells_transcripts)
+        assert both_transcripts["nuclei_id"].equals(nuclei_transcripts["cell_id"].rename("nuclei_id"))
+    finally:
+        temp_dir.clear_dir()
+
+
+class TimeoutOnceFile:
+    """File that raises FSTimeoutError once, on the first read after limit bytes were read"""
+
+    def __init__(self, f, limit: int, failures: list):
+        self._f = f
+        self._limit = limit
+        self._failures = failures
+        self._read_size = 0
+
+    def read(self, *args):
+        if not self._failures and self._read_size > self._limit:
+            self._failures.append(self._read_size)
+            raise FSTimeoutError()
+        data = self._f.read(*args)
+        self._read_size += len(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+    def __iter__(self):
+        return iter(self._f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._f.close()
+
+
+@pytest.mark.parametrize("temp_dir", [LocalTempDir()], ids=str)
+@pytest.mark.parametrize("transcripts_extension", ["csv", "parquet"])
+def test_transcripts_chunks_retry(temp_dir: TempDir, transcripts_extension: str, monkeypatch):
+    try:
+        args = get_arguments(temp_dir)
+        path = args.input_transcripts
+        if transcripts_extension == "parquet":
+            transcripts = io_with_retries(path, "r", pd.read_csv)
+            path = temp_dir.get_sep().join([temp_dir.get_temp_path(), "detected_transcripts.parquet"])
+            io_with_retries(path, "wb", partial(transcripts.to_parquet, index=False, row_group_size=1000))
+        expected = pd.concat(input_utils.read_transcripts_by_chunks(path, 1000))
+
+        # a read that times out in the middle of the file is continued after the rows that were already yielded
+        failures: list = []
+        limit = os.path.getsize(path) // 2
+        monkeypatch.setattr(input_utils, "vzg_open", lambda *a: TimeoutOnceFile(vzg_open(*a), limit, failures))
+        monkeypatch.setattr(input_utils, "retrying_attempts", lambda: Retrying(stop=stop_after_attempt(2)))
+        result = pd.concat(input_utils.read_transcripts_by_chunks(path, 1000))
+        assert len(failures) == 1
+        pd.testing.assert_frame_equal(expected.reset_index(drop=True), result.reset_index(drop=True))
+    finally:
+        temp_dir.clear_dir()
+
+
+def test_tile_grid_crossing():
+    rng = numpy.random.default_rng(0)
+    corners = rng.uniform(-10, 110, (200, 2))
+    bounds = numpy.hstack([corners, corners + rng.uniform(0, 40, (200, 2))])
+    grid = TileGrid.from_bounds((0, 0, 100, 100), 15.0)
+
+    crossing = grid.crossing(bounds)
+    assert len(crossing) == grid.get_tiles_count()
+    for tile_idx, boxes in enumerate(crossing):
+        row, column = divmod(tile_idx, grid.columns)
+        # the boxes outside of the grid are clipped to the border tiles
+        min_x = -numpy.inf if column == 0 else column * 15.0
+        max_x = numpy.inf if column == grid.columns - 1 else (column + 1) * 15.0
+        min_y = -numpy.inf if row == 0 else row * 15.0
+        max_y = numpy.inf if row == grid.rows - 1 else (row + 1) * 15.0
+        expected = numpy.flatnonzero(
+            (bounds[:, 0] < max_x) & (bounds[:, 2] >= min_x) & (bounds[:, 1] < max_y) & (bounds[:, 3] >= min_y)
+        )
+        assert boxes.tolist() == expected.tolist()
+    assert all(len(boxes) == 0 for boxes in grid.crossing(numpy.empty((0, 4))))
+
+
+def test_tiles_temp_path_on_cluster(monkeypatch):
+    # the local temporary directory is not shared with the workers of a remote cluster
+    monkeypatch.setattr(
+        tiled_partition, "current_context", lambda: Context(dask_args={"address": "tcp://127.0.0.1:8786"})
+    )
+    with pytest.raises(ValueError):
+        tiled_partition.construct_cell_x_gene_by_tiles("detected_transcripts.csv", [[]], [[]], ["cell_id"], 1000, 50.0)
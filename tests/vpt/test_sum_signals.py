@@ -1,17 +1,24 @@
 import argparse
 import io
+import os
+import tempfile
 
 import geopandas as gpd
 import numpy as np
 import pandas as pd
 import pytest
+import shapely
 import tifffile
-from shapely.geometry import MultiPolygon
+from shapely.geometry import MultiPolygon, Polygon
 from vpt_core.io.vzgfs import initialize_filesystem, vzg_open, retrying_attempts, io_with_retries
 from vpt_core.utils.base_case import BaseCase
 
 from tests.vpt.temp_dir import LocalTempDir, TempDir
+from vpt.app.context import Context
+from vpt.sum_signals.geometry_cache import GeometryCache
+from vpt.sum_signals import main
 from vpt.sum_signals.main import sum_signals
+from vpt.utils.temp_files import temp_directory
 
 
 class SumSignalsCaseScheme:
@@ -159,3 +166,118 @@ def test_sum_signals(scheme: SumSignalsCaseScheme, setup_from_scheme: SumSignals
     output_df = io_with_retries(setup_from_scheme.output_path, "r", lambda f: pd.read_csv(f, index_col=0))
 
     assert setup_from_scheme.answer.equals(output_df)
+
+
+def test_geometry_cache() -> None:
+    geometries = np.array(
+        [MultiPolygon([([(0, 0), (0, 1.5), (2.25, 0)], [])]), Polygon([(5, 5), (6, 5), (6, 7)]), MultiPolygon()]
+    )
+    with tempfile.TemporaryDirectory() as td:
+        cache = GeometryCache(td)
+        cache.write(2, np.array([7, 3, 5]), geometries)
+        cache.write(3, np.array([], dtype=np.int64), np.array([], dtype=object))
+
+        entity_idx, result = cache.read(2, 1, 3)
+        assert entity_idx.tolist() == [3, 5]
+        assert all(shapely.equals_exact(result, geometries[1:], tolerance=0))
+
+        entity_idx, result = cache.read(3, 0, 0)
+        assert len(entity_idx) == 0 and len(result) == 0
+
+
+@pytest.mark.parametrize("scheme", SUM_SIGNALS_TEST_SCHEMES[:1], ids=str)
+def test_sum_signals_statistics(scheme: SumSignalsCaseScheme, setup_from_scheme: SumSignalsCase):
+    output_path = setup_from_scheme.output_path.replace(".csv", ".parquet")
+    args = argparse.Namespace(
+        input_images=setup_from_scheme.regex,
+        input_boundaries=setup_from_scheme.boundaries_path,
+        input_micron_to_mosaic=setup_from_scheme.transform_path,
+        output_csv=output_path,
+        overwrite=True,
+        statistics=["sum", "mean", "max", "variance", "count"],
+        quantiles=[0.5],
+    )
+    sum_signals(args)
+
+    output_df = io_with_retries(output_path, "rb", pd.read_parquet)
+    answer = pd.DataFrame(
+        {
+            "EntityID": [10439330, 10439331],
+            "c1_raw": [21.0**2 * 2, 0],
+            "c1_mean": [1.0, 0],
+            "c1_max": [1.0, 0],
+            "c1_variance": [0.0, 0],
+            "c1_count": [21.0**2 * 2, 21**2],
+            "c1_q50": [1.0, 0],
+        }
+    )
+    assert answer.equals(output_df)
+
+
+@pytest.mark.parametrize("scheme", SUM_SIGNALS_TEST_SCHEMES, ids=str)
+def test_sum_signals_several_boundaries(scheme: SumSignalsCaseScheme, setup_from_scheme: SumSignalsCase):
+    # nuclei inside the cells of the scheme, both are measured from the same image blocks
+    nuclei = scheme.boundaries.copy()
+    nuclei["Type"] = "nucleus"
+    nuclei["Geometry"] = [MultiPolygon([([(45, 45), (55, 45), (55, 55), (45, 55)], [])])] * len(nuclei)
+    nuclei_path = setup_from_scheme.boundaries_path.replace("boundaries", "nuclei")
+    io_with_retries(nuclei_path, "wb", nuclei.to_parquet)
+    nuclei_output_path = setup_from_scheme.output_path.replace("output", "nuclei_output")
+
+    args = argparse.Namespace(
+        input_images=setup_from_scheme.regex,
+        input_boundaries=[setup_from_scheme.boundaries_path, nuclei_path],
+        input_micron_to_mosaic=setup_from_scheme.transform_path,
+        output_csv=[setup_from_scheme.output_path, nuclei_output_path],
+        overwrite=True,
+    )
+    sum_signals(args)
+
+    output_df = io_with_retries(setup_from_scheme.output_path, "r", lambda f: pd.read_csv(f, index_col=0))
+    assert setup_from_scheme.answer.equals(output_df)
+
+    nuclei_df = io_with_retries(nuclei_output_path, "r", lambda f: pd.read_csv(f, index_col=0))
+    answer = pd.DataFrame(
+        {"c1_raw": [11**2 * 2, 0], "c1_high_pass": [0, 0]}, dtype=np.float64, index=[10439330, 10439331]
+    )
+    assert answer.equals(nuclei_df)
+
+
+@pytest.mark.parametrize("scheme", SUM_SIGNALS_TEST_SCHEMES[:1], ids=str)
+def test_sum_signals_pyramid_level(scheme: SumSignalsCaseScheme, setup_from_scheme: SumSignalsCase):
+    report_path = setup_from_scheme.output_path.replace("output", "report")
+    args = argparse.Namespace(
+        input_images=setup_from_scheme.regex,
+        input_boundaries=setup_from_scheme.boundaries_path,
+        input_micron_to_mosaic=setup_from_scheme.transform_path,
+        output_csv=setup_from_scheme.output_path,
+        overwrite=True,
+        pyramid_level=1,
+        output_approximation_report=report_path,
+    )
+    sum_signals(args)
+
+    output_df = io_with_retries(setup_from_scheme.output_path, "r", lambda f: pd.read_csv(f, index_col=0))
+    assert np.allclose(output_df, setup_from_scheme.answer, rtol=0.15)
+
+    report = io_with_retries(report_path, "r", lambda f: pd.read_csv(f, index_col=0))
+    assert report.index.tolist() == ["c1_raw", "c1_high_pass"]
+    assert report.loc["c1_raw", "entities"] == 1
+    raw_error = abs(output_df.loc[10439330, "c1_raw"] / setup_from_scheme.answer.loc[10439330, "c1_raw"] - 1)
+    assert np.isclose(report.loc["c1_raw", "median_relative_error"], raw_error)
+
+
+def test_geometry_cache_temp_path(monkeypatch) -> None:
+    geometries = np.array([Polygon([(5, 5), (6, 5), (6, 7)]), Polygon([(0, 0), (1, 0), (1, 1)])])
+    with tempfile.TemporaryDirectory() as td:
+        with temp_directory(td, "sum_signals_geometry") as cache_path:
+            GeometryCache(cache_path).write(0, np.array([1, 0]), geometries)
+            entity_idx, result = GeometryCache(cache_path).read(0, 0, 2)
+            assert entity_idx.tolist() == [1, 0]
+            assert all(shapely.equals_exact(result, geometries, tolerance=0))
+        assert os.listdir(td) == []
+
+    # the local temporary directory is not shared with the workers of a remote cluster
+    monkeypatch.setattr(main, "current_context", lambda: Context(dask_args={"address": "tcp://127.0.0.1:8786"}))
+    with pytest.raises(ValueError):
+        main.get_entity_statistics([], [], [1, 0, 0, 1, 0, 0])